@@ -11,7 +11,8 @@ AI教育助手agent模块
 from .tools.ollama_service import OllamaLLM
 from .langchain_agent import (
     ContentGenerator,
-    langchain_agent
+    langchain_agent,
+    create_hedged_llm
 )
 
 from .tools import (
@@ -34,6 +35,7 @@ __all__ = [
     'OllamaLLM',
     'ContentGenerator',
     'langchain_agent',
+    'create_hedged_llm',
     
     # 工具类
     'Exercise',
@@ -0,0 +1,234 @@
+"""
+自适应并发控制（AIMD）
+
+准入控制的max_concurrent是固定值，而Ollama的吞吐取决于OLLAMA_NUM_PARALLEL、模型大小和硬件，
+远程提供商的限流策略也各不相同，固定的并发数总有地方不合适。自适应控制按提供商和模型分别调整
+准入闸门的并发上限（ConcurrencyGate.set_limit），以设置中的max_concurrent为起点：
+- 调整范围为[min_limit, max_limit]，设置中的max_concurrent高于max_limit时上界取max_concurrent
+- 每次调用结束后记录拿到槽位后的首token延迟（TTFT）、单个流的输出速度和是否失败
+- 每隔interval秒且至少有min_samples次调用时评估一次：
+  - 失败率超过error_rate、TTFT高于长期均值的ttft_tolerance倍，或输出速度低于长期均值的
+    speed_tolerance倍时，上限乘以decrease（乘性减）
+  - 指标正常且窗口内确实有请求因达到上限而排队时，上限加increase（加性增）
+  - 其他情况保持不变
+- 按上限记录窗口内的总吞吐（token/秒），吞吐最高的上限作为该闸门的工作点（operating_point）
+- 保留最近的调整记录供调参
+配置在settings/user_settings.json的global.adaptive_concurrency中。
+"""
+import time
+from collections import deque
+from dataclasses import dataclass
+from statistics import median
+from typing import Any, Deque, Dict, List, Optional
+from pydantic import BaseModel, Field
+from .admission import admission_controller, ConcurrencyGate
+from .circuit_breaker import is_failure
+from .errors import RateLimited
+from .metrics import LLMCallMetrics, llm_concurrency_limit
+
+# 长期均值的平滑系数
+BASELINE_ALPHA = 0.1
+
+
+class AdaptiveConcurrencyConfig(BaseModel):
+    """自适应并发控制配置"""
+    enabled: bool = True
+    min_limit: int = Field(default=1, ge=1)
+    max_limit: int = Field(default=16, ge=1)
+    max_limits: Dict[str, int] = {"ollama": 8}  # 按提供商覆盖max_limit
+    increase: int = Field(default=1, ge=1)  # 加性增的步长
+    decrease: float = Field(default=0.7, gt=0, lt=1)  # 乘性减的系数
+    interval: float = Field(default=10.0, gt=0)  # 两次评估的最短间隔（秒）
+    min_samples: int = Field(default=4, ge=1)  # 每次评估至少需要的调用数
+    ttft_tolerance: float = Field(default=1.5, gt=1)
+    speed_tolerance: float = Field(default=0.6, gt=0, lt=1)
+    error_rate: float = Field(default=0.1, ge=0, le=1)
+    history: int = Field(default=100, ge=0)  # 保留多少条调整记录
+
+
+@dataclass
+class CallSample:
+    """一次调用的观测值"""
+    ttft: Optional[float]  # 拿到槽位到首token的时间
+    speed: Optional[float]  # 单个流的输出速度（token/秒）
+    tokens: int
+    failed: bool
+
+
+class AdaptiveLimit:
+    """单个闸门的AIMD状态"""
+
+    def __init__(self, gate: ConcurrencyGate, limit: int):
+        self.gate = gate
+        self.limit = limit
+        self.samples: List[CallSample] = []
+        self.window_start = time.time()
+        self.baseline_ttft: Optional[float] = None
+        self.baseline_speed: Optional[float] = None
+        self.throughput: Dict[int, float] = {}  # 上限 -> 窗口总吞吐（token/秒）的平滑值
+        self.history: Deque[Dict[str, Any]] = deque()
+        self.stats = {"increases": 0, "decreases": 0, "holds": 0}
+
+    @property
+    def operating_point(self) -> Optional[int]:
+        if not self.throughput:
+            return None
+        return max(self.throughput, key=self.throughput.get)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "active": self.gate.active,
+            "waiting": self.gate.waiting,
+            "operating_point": self.operating_point,
+            "baseline_ttft": round(self.baseline_ttft, 4) if self.baseline_ttft is not None else None,
+            "baseline_tokens_per_second": round(self.baseline_speed, 2) if self.baseline_speed is not None else None,
+            "throughput_by_limit": {limit: round(value, 2) for limit, value in sorted(self.throughput.items())},
+            "pending_samples": len(self.samples),
+            **self.stats,
+            "history": list(self.history)
+        }
+
+
+def _smooth(baseline: Optional[float], value: Optional[float]) -> Optional[float]:
+    if value is None:
+        return baseline
+    if baseline is None:
+        return value
+    return (1 - BASELINE_ALPHA) * baseline + BASELINE_ALPHA * value
+
+
+class AdaptiveConcurrencyController:
+    """按观测到的延迟、吞吐和错误调整各闸门的并发上限"""
+
+    def __init__(self, config: Optional[AdaptiveConcurrencyConfig] = None):
+        self.config = config or AdaptiveConcurrencyConfig()
+        self._limits: Dict[str, AdaptiveLimit] = {}
+
+    def configure(self, config: Optional[Dict[str, Any]] = None) -> None:
+        """更新配置，并把学到的上限重新应用到闸门（准入控制重新读取设置时会重置上限）；
+        关闭时恢复设置中的max_concurrent"""
+        self.config = AdaptiveConcurrencyConfig(**(config or {}))
+        for state in self._limits.values():
+            state.history = deque(state.history, maxlen=self.config.history)
+            if self.config.enabled:
+                self._apply(state, self._clamp(state.gate, state.limit))
+            else:
+                state.gate.set_limit(state.gate.limits.max_concurrent)
+
+    def _max_limit(self, gate: ConcurrencyGate) -> int:
+        """上限的上界：配置的max_limit，设置中的max_concurrent更大时以设置为准"""
+        provider = gate.name.split("/", 1)[0]
+        return max(self.config.max_limits.get(provider, self.config.max_limit), gate.limits.max_concurrent)
+
+    def _clamp(self, gate: ConcurrencyGate, limit: int) -> int:
+        return max(self.config.min_limit, min(self._max_limit(gate), limit))
+
+    def _apply(self, state: AdaptiveLimit, limit: int) -> None:
+        state.limit = limit
+        state.gate.set_limit(limit)
+        llm_concurrency_limit.labels(gate=state.gate.name).set(limit)
+
+    def _state(self, gate: ConcurrencyGate) -> AdaptiveLimit:
+        state = self._limits.get(gate.name)
+        if state is None or state.gate is not gate:
+            state = AdaptiveLimit(gate, self._clamp(gate, gate.limits.max_concurrent))
+            state.history = deque(maxlen=self.config.history)
+            self._limits[gate.name] = state
+            self._apply(state, state.limit)
+        return state
+
+    def observe(
+        self,
+        provider: str,
+        model: str,
+        metrics: LLMCallMetrics,
+        outcome: str,
+        error: Optional[BaseException] = None
+    ) -> None:
+        """记录一次拿到过执行槽位的调用（取消的调用不计入）"""
+        if not self.config.enabled or metrics.admitted_at is None or outcome not in ("success", "error"):
+            return
+        if outcome == "error" and not (is_failure(error) or isinstance(error, RateLimited)):
+            # 4xx、输出解析失败等与负载无关
+            return
+        ttft = metrics.first - metrics.admitted_at if metrics.first is not None else None
+        speed = None
+        if metrics.first is not None and metrics.last > metrics.first:
+            speed = metrics.tokens / (metrics.last - metrics.first)
+        sample = CallSample(ttft, speed, metrics.tokens, outcome == "error")
+        for gate in admission_controller.gates(provider, model):
+            state = self._state(gate)
+            state.samples.append(sample)
+            self._evaluate(state)
+
+    def _evaluate(self, state: AdaptiveLimit) -> None:
+        now = time.time()
+        elapsed = now - state.window_start
+        if len(state.samples) < self.config.min_samples or elapsed < self.config.interval:
+            return
+        samples, state.samples = state.samples, []
+        state.window_start = now
+        saturated, state.gate.saturated = state.gate.saturated, False
+
+        error_rate = sum(1 for sample in samples if sample.failed) / len(samples)
+        ttfts = [sample.ttft for sample in samples if sample.ttft is not None and not sample.failed]
+        speeds = [sample.speed for sample in samples if sample.speed is not None and not sample.failed]
+        ttft = median(ttfts) if ttfts else None
+        speed = median(speeds) if speeds else None
+        throughput = sum(sample.tokens for sample in samples) / elapsed
+        previous = state.throughput.get(state.limit)
+        state.throughput[state.limit] = throughput if previous is None else 0.7 * previous + 0.3 * throughput
+
+        reason = None
+        if error_rate > self.config.error_rate:
+            reason = f"失败率{error_rate:.0%}"
+        elif ttft is not None and state.baseline_ttft and ttft > state.baseline_ttft * self.config.ttft_tolerance:
+            reason = f"TTFT {ttft:.2f}s（基线{state.baseline_ttft:.2f}s）"
+        elif speed is not None and state.baseline_speed and speed < state.baseline_speed * self.config.speed_tolerance:
+            reason = f"输出速度{speed:.1f} token/s（基线{state.baseline_speed:.1f}）"
+
+        limit = state.limit
+        if reason is not None:
+            limit = self._clamp(state.gate, int(state.limit * self.config.decrease))
+            action = "decrease"
+        elif saturated:
+            limit = self._clamp(state.gate, state.limit + self.config.increase)
+            action = "increase"
+            reason = "指标正常且有请求排队"
+        else:
+            action = "hold"
+        if limit == state.limit:
+            action = "hold"
+        state.stats[f"{action}s"] += 1
+
+        # 长期均值每个窗口缓慢更新，逐步适应模型或硬件的变化
+        state.baseline_ttft = _smooth(state.baseline_ttft, ttft)
+        state.baseline_speed = _smooth(state.baseline_speed, speed)
+
+        if action != "hold":
+            print(f"自适应并发: {state.gate.name} 并发上限 {state.limit} -> {limit}（{reason}）")
+            self._apply(state, limit)
+        state.history.append({
+            "time": now,
+            "action": action,
+            "limit": state.limit,
+            "reason": reason,
+            "samples": len(samples),
+            "error_rate": round(error_rate, 4),
+            "ttft": round(ttft, 4) if ttft is not None else None,
+            "tokens_per_second": round(speed, 2) if speed is not None else None,
+            "throughput": round(throughput, 2),
+            "saturated": saturated
+        })
+
+    def get_stats(self) -> Dict[str, Any]:
+        """各闸门当前的并发上限、工作点和调整记录"""
+        return {
+            "enabled": self.config.enabled,
+            "gates": {name: state.summary() for name, state in self._limits.items()}
+        }
+
+
+# 全局自适应并发控制器
+adaptive_concurrency = AdaptiveConcurrencyController()
@@ -0,0 +1,225 @@
+"""
+LLM调用准入控制
+
+按提供商和模型两级限制同时进行的llm._call流式请求数：
+- 超出并发上限的请求进入有界等待队列，按先来先服务获得执行槽位
+- 队列已满时立即拒绝（AdmissionRejected），由API层返回429和Retry-After
+- 排队超过queue_timeout时同样拒绝，避免请求挂起数分钟
+限额配置在settings/user_settings.json中各提供商配置块的limits字段。
+"""
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Any, Optional, Tuple
+from pydantic import BaseModel, Field
+from .errors import AdmissionRejected
+
+
+class ConcurrencyLimits(BaseModel):
+    """并发限额"""
+    max_concurrent: int = Field(default=4, ge=1)  # 同时进行的请求数上限
+    max_queue: int = Field(default=32, ge=0)  # 等待队列长度上限
+    queue_timeout: float = Field(default=120.0, gt=0)  # 最长排队时间（秒）
+
+
+DEFAULT_LIMITS = {
+    # 本地Ollama并行能力有限，默认更保守
+    "ollama": ConcurrencyLimits(max_concurrent=2, max_queue=16),
+}
+
+
+class ConcurrencyGate:
+    """单个提供商或模型的并发闸门"""
+
+    def __init__(self, name: str, limits: ConcurrencyLimits):
+        self.name = name
+        self.limits = limits
+        self.limit = limits.max_concurrent
+        self.active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._service_time = 0.0  # 槽位占用时长的指数移动平均
+        self._recent_waits: Deque[float] = deque(maxlen=256)
+        self.saturated = False  # 是否有请求因达到上限而排队（由自适应并发控制读取并清零）
+        self.stats = {
+            "admitted": 0,
+            "queued": 0,
+            "rejected_queue_full": 0,
+            "rejected_timeout": 0,
+            "queue_wait_total": 0.0,
+            "queue_wait_max": 0.0,
+            "queue_peak": 0
+        }
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def retry_after(self) -> float:
+        """估算队列排空所需时间，作为Retry-After建议值"""
+        service_time = self._service_time or 5.0
+        return max(1.0, round((self.waiting + 1) / max(self.limit, 1) * service_time, 1))
+
+    def is_full(self) -> bool:
+        return self.active >= self.limit and self.waiting >= self.limits.max_queue
+
+    async def acquire(self, provider: str, model: str) -> float:
+        """获取执行槽位，返回排队时间"""
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self._record_admit(0.0)
+            return 0.0
+        if self.waiting >= self.limits.max_queue:
+            self.stats["rejected_queue_full"] += 1
+            raise AdmissionRejected(provider, model, "queue_full", self.retry_after())
+
+        self.saturated = True
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        self.stats["queued"] += 1
+        self.stats["queue_peak"] = max(self.stats["queue_peak"], self.waiting)
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, timeout=self.limits.queue_timeout)
+        except asyncio.TimeoutError:
+            self._remove_waiter(future)
+            self.stats["rejected_timeout"] += 1
+            raise AdmissionRejected(provider, model, "queue_timeout", self.retry_after())
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已分配到槽位但调用方被取消，归还槽位
+                self.release(0.0)
+            else:
+                self._remove_waiter(future)
+            raise
+        waited = time.perf_counter() - start
+        self._record_admit(waited)
+        return waited
+
+    def release(self, held: float) -> None:
+        """归还槽位并唤醒等待者"""
+        self.active = max(0, self.active - 1)
+        if held:
+            self._service_time = held if not self._service_time else 0.8 * self._service_time + 0.2 * held
+        self._wake()
+
+    def set_limit(self, limit: int) -> None:
+        """调整并发上限（上调时立即唤醒等待者）"""
+        self.limit = max(1, limit)
+        self._wake()
+
+    def _wake(self) -> None:
+        while self._waiters and self.active < self.limit:
+            future = self._waiters.popleft()
+            if not future.done():
+                self.active += 1
+                future.set_result(None)
+
+    def _remove_waiter(self, future: asyncio.Future) -> None:
+        try:
+            self._waiters.remove(future)
+        except ValueError:
+            pass
+
+    def _record_admit(self, waited: float) -> None:
+        self.stats["admitted"] += 1
+        self.stats["queue_wait_total"] += waited
+        self.stats["queue_wait_max"] = max(self.stats["queue_wait_max"], waited)
+        self._recent_waits.append(waited)
+
+    def get_stats(self) -> Dict[str, Any]:
+        waits = sorted(self._recent_waits)
+        p95 = waits[int(len(waits) * 0.95) - 1] if waits else 0.0
+        admitted = self.stats["admitted"]
+        return {
+            **self.stats,
+            "limit": self.limit,
+            "max_queue": self.limits.max_queue,
+            "active": self.active,
+            "waiting": self.waiting,
+            "queue_wait_avg": round(self.stats["queue_wait_total"] / admitted, 4) if admitted else 0.0,
+            "queue_wait_p95": round(p95, 4),
+            "avg_service_time": round(self._service_time, 3)
+        }
+
+
+class AdmissionController:
+    """按提供商和模型管理并发闸门"""
+
+    def __init__(self):
+        self._provider_gates: Dict[str, ConcurrencyGate] = {}
+        self._model_gates: Dict[Tuple[str, str], ConcurrencyGate] = {}
+
+    def _load_limits(self, provider: str, model: Optional[str] = None) -> ConcurrencyLimits:
+        """从提供商配置块的limits字段读取限额，模型可在per_model中单独覆盖"""
+        from .llm_providers import get_user_settings
+
+        values = DEFAULT_LIMITS.get(provider, ConcurrencyLimits()).dict()
+        limits = get_user_settings().get(provider, {}).get("limits") or {}
+        values.update({key: limits[key] for key in values if key in limits})
+        if model is not None:
+            per_model = limits.get("per_model") or {}
+            values.update(per_model.get(model) or {})
+        return ConcurrencyLimits(**values)
+
+    def gates(self, provider: str, model: str) -> Tuple[ConcurrencyGate, ConcurrencyGate]:
+        """提供商和模型的并发闸门（不存在时按设置创建）"""
+        provider_gate = self._provider_gates.get(provider)
+        if provider_gate is None:
+            provider_gate = ConcurrencyGate(provider, self._load_limits(provider))
+            self._provider_gates[provider] = provider_gate
+        key = (provider, model)
+        model_gate = self._model_gates.get(key)
+        if model_gate is None:
+            model_gate = ConcurrencyGate(f"{provider}/{model}", self._load_limits(provider, model))
+            self._model_gates[key] = model_gate
+        return provider_gate, model_gate
+
+    def reload(self) -> None:
+        """设置变化后重新读取限额（已有闸门上的排队请求保留）"""
+        for provider, gate in self._provider_gates.items():
+            gate.limits = self._load_limits(provider)
+            gate.set_limit(gate.limits.max_concurrent)
+        for (provider, model), gate in self._model_gates.items():
+            gate.limits = self._load_limits(provider, model)
+            gate.set_limit(gate.limits.max_concurrent)
+
+    def check(self, provider: str, model: str) -> None:
+        """快速检查是否还有排队余量，没有则立即拒绝（用于流式接口开始响应之前）"""
+        for gate in self.gates(provider, model):
+            if gate.is_full():
+                gate.stats["rejected_queue_full"] += 1
+                raise AdmissionRejected(provider, model, "queue_full", gate.retry_after())
+
+    @asynccontextmanager
+    async def slot(self, provider: str, model: str):
+        """在执行槽位内运行一次LLM调用"""
+        provider_gate, model_gate = self.gates(provider, model)
+        await model_gate.acquire(provider, model)
+        try:
+            await provider_gate.acquire(provider, model)
+        except BaseException:
+            model_gate.release(0.0)
+            raise
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            held = time.perf_counter() - start
+            provider_gate.release(held)
+            model_gate.release(held)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取各闸门的排队与并发统计"""
+        return {
+            "providers": {
+                name: gate.get_stats() for name, gate in self._provider_gates.items()
+            },
+            "models": {
+                gate.name: gate.get_stats() for gate in self._model_gates.values()
+            }
+        }
+
+
+# 全局准入控制器实例
+admission_controller = AdmissionController()
@@ -0,0 +1,441 @@
+"""
+离线批量生成（Batch API）
+
+夜间预生成题库等非交互任务不需要流式输出，逐个通过BaseLLM._call调用既慢又贵。
+批量模式把多条提示词打包成OpenAI兼容的批处理任务：
+- 上传JSONL输入文件（POST /files，purpose=batch），创建批处理（POST /batches）
+- 后台按间隔轮询状态（GET /batches/{id}），完成后下载输出和错误文件，
+  按custom_id把结果映射回每条请求
+- 任务状态和结果持久化在batchSaves/目录，服务重启后继续轮询未完成的任务
+支持两类请求：prompt（原样提交，返回文本）和exercises（按练习题生成器的提示词提交，
+结果解析为练习题列表）。只适用于提供批处理接口的OpenAI兼容服务（或本地替代服务）。
+配置在settings/user_settings.json的global.batch_jobs中。
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional
+import aiohttp
+from pydantic import BaseModel, Field
+from .http_pool import http_pool
+from .errors import ProviderAPIError
+
+# 批处理服务端的最终状态
+FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+class BatchJobConfig(BaseModel):
+    """批量任务配置"""
+    save_dir: str = "batchSaves"
+    poll_interval: float = Field(default=30.0, gt=0)  # 轮询间隔（秒）
+    completion_window: str = "24h"
+    endpoint: str = "/v1/chat/completions"  # 批处理中每条请求调用的接口
+    max_requests: int = Field(default=50000, ge=1)  # 单个任务最多的请求数
+
+
+@dataclass
+class BatchRequest:
+    """批量任务中的一条请求"""
+    custom_id: str
+    task: str  # prompt或exercises
+    prompt: str
+    params: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class BatchJob:
+    """批量任务记录"""
+    id: str
+    provider: str
+    model: str
+    requests: List[BatchRequest]
+    temperature: float = 0.7
+    max_tokens: Optional[int] = None
+    status: str = "submitting"
+    created_at: float = 0.0
+    updated_at: float = 0.0
+    batch_id: Optional[str] = None  # 服务端批处理ID
+    input_file_id: Optional[str] = None
+    output_file_id: Optional[str] = None
+    error_file_id: Optional[str] = None
+    request_counts: Dict[str, int] = field(default_factory=dict)
+    results: Dict[str, Dict[str, Any]] = field(default_factory=dict)  # custom_id -> 结果
+    error: Optional[str] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINAL_STATUSES
+
+    def summary(self) -> Dict[str, Any]:
+        """不含请求和结果内容的概要"""
+        return {
+            "id": self.id,
+            "provider": self.provider,
+            "model": self.model,
+            "status": self.status,
+            "requests": len(self.requests),
+            "request_counts": self.request_counts,
+            "results": len(self.results),
+            "batch_id": self.batch_id,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+            "error": self.error
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "BatchJob":
+        data = dict(data)
+        data["requests"] = [BatchRequest(**item) for item in data.get("requests", [])]
+        return cls(**data)
+
+
+class BatchClient:
+    """OpenAI兼容的文件和批处理接口"""
+
+    def __init__(self, provider: str, base_url: str, api_key: str):
+        self.provider = provider
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+
+    def _headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.api_key}"}
+
+    async def _json(self, response: aiohttp.ClientResponse) -> Dict[str, Any]:
+        if response.status != 200:
+            raise ProviderAPIError(response.status, await response.text())
+        return await response.json(content_type=None)
+
+    async def upload_file(self, content: bytes) -> str:
+        form = aiohttp.FormData()
+        form.add_field("purpose", "batch")
+        form.add_field("file", content, filename="batch_input.jsonl", content_type="application/jsonl")
+        session = http_pool.get_session(self.provider)
+        async with session.post(f"{self.base_url}/files", data=form, headers=self._headers()) as response:
+            return (await self._json(response))["id"]
+
+    async def create_batch(self, input_file_id: str, endpoint: str, completion_window: str) -> Dict[str, Any]:
+        payload = {
+            "input_file_id": input_file_id,
+            "endpoint": endpoint,
+            "completion_window": completion_window
+        }
+        session = http_pool.get_session(self.provider)
+        async with session.post(f"{self.base_url}/batches", json=payload, headers=self._headers()) as response:
+            return await self._json(response)
+
+    async def get_batch(self, batch_id: str) -> Dict[str, Any]:
+        session = http_pool.get_session(self.provider)
+        async with session.get(f"{self.base_url}/batches/{batch_id}", headers=self._headers()) as response:
+            return await self._json(response)
+
+    async def cancel_batch(self, batch_id: str) -> Dict[str, Any]:
+        session = http_pool.get_session(self.provider)
+        async with session.post(f"{self.base_url}/batches/{batch_id}/cancel", headers=self._headers()) as response:
+            return await self._json(response)
+
+    async def get_file_content(self, file_id: str) -> str:
+        session = http_pool.get_session(self.provider)
+        async with session.get(f"{self.base_url}/files/{file_id}/content", headers=self._headers()) as response:
+            if response.status != 200:
+                raise ProviderAPIError(response.status, await response.text())
+            return await response.text()
+
+
+def _extract_text(body: Dict[str, Any]) -> Optional[str]:
+    """从chat/completions或responses格式的响应体中取出文本"""
+    choices = body.get("choices")
+    if choices:
+        return (choices[0].get("message") or {}).get("content")
+    if "output_text" in body:
+        return body["output_text"]
+    for item in body.get("output", []):
+        for content in item.get("content", []):
+            if content.get("type") == "output_text":
+                return content.get("text")
+    return None
+
+
+class BatchJobManager:
+    """提交、轮询和收集批量任务"""
+
+    def __init__(self, config: Optional[BatchJobConfig] = None):
+        self.config = config or BatchJobConfig()
+        self._jobs: Dict[str, BatchJob] = {}
+        self._pollers: Dict[str, asyncio.Task] = {}
+        self._done: Dict[str, asyncio.Event] = {}
+        self._loaded = False
+
+    def configure(self, config: Optional[Dict[str, Any]] = None) -> None:
+        self.config = BatchJobConfig(**(config or {}))
+
+    def _path(self, job_id: str) -> str:
+        return os.path.join(self.config.save_dir, f"{job_id}.json")
+
+    def _save(self, job: BatchJob) -> None:
+        job.updated_at = time.time()
+        os.makedirs(self.config.save_dir, exist_ok=True)
+        path = self._path(job.id)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(asdict(job), f, ensure_ascii=False, indent=2)
+        os.replace(f"{path}.tmp", path)
+
+    def _load_all(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        if not os.path.isdir(self.config.save_dir):
+            return
+        for filename in os.listdir(self.config.save_dir):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.config.save_dir, filename), "r", encoding="utf-8") as f:
+                    job = BatchJob.from_dict(json.load(f))
+                self._jobs[job.id] = job
+            except Exception as e:
+                print(f"读取批量任务 {filename} 失败: {str(e)}")
+
+    def start(self) -> None:
+        """加载已保存的任务，继续轮询未完成的任务"""
+        self._load_all()
+        for job in self._jobs.values():
+            if job.batch_id and not job.finished:
+                self._start_polling(job)
+
+    async def stop(self) -> None:
+        for task in self._pollers.values():
+            task.cancel()
+        await asyncio.gather(*self._pollers.values(), return_exceptions=True)
+        self._pollers.clear()
+
+    @staticmethod
+    def _client(provider: str) -> BatchClient:
+        from .llm_providers import get_provider_config
+
+        if provider == "ollama":
+            raise ValueError("Ollama不支持批处理接口")
+        config = get_provider_config(provider)
+        if not config or not config.get("base_url"):
+            raise ValueError(f"未找到{provider}的配置信息")
+        return BatchClient(provider, config["base_url"], config.get("api_key", ""))
+
+    @staticmethod
+    def build_request(item: Dict[str, Any], index: int) -> BatchRequest:
+        """把接口提交的一条请求转换为批量请求"""
+        task = item.get("task", "prompt")
+        custom_id = str(item.get("custom_id") or f"request-{index}")
+        if task == "prompt":
+            if not item.get("prompt"):
+                raise ValueError(f"请求 {custom_id} 缺少prompt")
+            return BatchRequest(custom_id=custom_id, task=task, prompt=item["prompt"])
+        if task == "exercises":
+            from .tools.exercise_generator import ExerciseGenerator
+
+            if not item.get("topic"):
+                raise ValueError(f"请求 {custom_id} 缺少topic")
+            params = {
+                "topic": item["topic"],
+                "types": item.get("types") or ["选择题"],
+                "difficulty": item.get("difficulty", 3),
+                "count": item.get("count", 5)
+            }
+            return BatchRequest(
+                custom_id=custom_id,
+                task=task,
+                prompt=ExerciseGenerator.build_prompt(**params),
+                params=params
+            )
+        raise ValueError(f"不支持的批量任务类型: {task}")
+
+    def _input_file(self, job: BatchJob) -> bytes:
+        lines = []
+        for request in job.requests:
+            body = {
+                "model": job.model,
+                "messages": [{"role": "user", "content": request.prompt}],
+                "temperature": job.temperature
+            }
+            if job.max_tokens and job.max_tokens != -1:
+                body["max_tokens"] = job.max_tokens
+            lines.append(json.dumps({
+                "custom_id": request.custom_id,
+                "method": "POST",
+                "url": self.config.endpoint,
+                "body": body
+            }, ensure_ascii=False))
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+    async def submit(
+        self,
+        items: List[Dict[str, Any]],
+        provider: str,
+        model: Optional[str] = None,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None
+    ) -> BatchJob:
+        """提交一个批量任务，返回后在后台轮询"""
+        from .llm_providers import get_provider_config
+
+        self._load_all()
+        if not items:
+            raise ValueError("批量任务不能为空")
+        if len(items) > self.config.max_requests:
+            raise ValueError(f"单个批量任务最多{self.config.max_requests}条请求")
+        requests = [self.build_request(item, index) for index, item in enumerate(items)]
+        if len({request.custom_id for request in requests}) != len(requests):
+            raise ValueError("custom_id不能重复")
+        client = self._client(provider)
+        provider_config = get_provider_config(provider) or {}
+        job = BatchJob(
+            id=uuid.uuid4().hex[:12],
+            provider=provider,
+            model=model or provider_config.get("model_name", ""),
+            requests=requests,
+            temperature=provider_config.get("temperature", 0.7) if temperature is None else temperature,
+            max_tokens=provider_config.get("max_tokens") if max_tokens is None else max_tokens,
+            created_at=time.time()
+        )
+        self._jobs[job.id] = job
+        try:
+            job.input_file_id = await client.upload_file(self._input_file(job))
+            batch = await client.create_batch(job.input_file_id, self.config.endpoint, self.config.completion_window)
+        except Exception as e:
+            job.status = "failed"
+            job.error = f"提交批量任务失败: {str(e)}"
+            await asyncio.to_thread(self._save, job)
+            raise
+        self._apply(job, batch)
+        await asyncio.to_thread(self._save, job)
+        print(f"批量任务 {job.id} 已提交: {len(requests)}条请求 -> {provider}/{job.model} ({job.batch_id})")
+        self._start_polling(job)
+        return job
+
+    @staticmethod
+    def _apply(job: BatchJob, batch: Dict[str, Any]) -> None:
+        """更新服务端返回的批处理状态"""
+        job.batch_id = batch.get("id", job.batch_id)
+        job.status = batch.get("status", job.status)
+        job.output_file_id = batch.get("output_file_id") or job.output_file_id
+        job.error_file_id = batch.get("error_file_id") or job.error_file_id
+        job.request_counts = batch.get("request_counts") or job.request_counts
+        errors = (batch.get("errors") or {}).get("data")
+        if errors:
+            job.error = "; ".join(str(error.get("message", error)) for error in errors)
+
+    def _start_polling(self, job: BatchJob) -> None:
+        if job.id in self._pollers and not self._pollers[job.id].done():
+            return
+        self._done.setdefault(job.id, asyncio.Event())
+        self._pollers[job.id] = asyncio.create_task(self._poll(job))
+
+    async def _poll(self, job: BatchJob) -> None:
+        try:
+            try:
+                client = self._client(job.provider)
+            except ValueError as e:
+                # 重启后提供商配置已被删除等，无法继续查询
+                job.error = f"无法查询批量任务状态: {str(e)}"
+                print(f"批量任务 {job.id} 停止轮询: {job.error}")
+                await asyncio.to_thread(self._save, job)
+                return
+            while not job.finished:
+                await asyncio.sleep(self.config.poll_interval)
+                try:
+                    batch = await client.get_batch(job.batch_id)
+                except Exception as e:
+                    print(f"查询批量任务 {job.id} 状态失败: {str(e)}")
+                    continue
+                previous = job.status
+                self._apply(job, batch)
+                if job.finished:
+                    await self._collect(client, job)
+                if job.status != previous or job.finished:
+                    await asyncio.to_thread(self._save, job)
+            print(f"批量任务 {job.id} 结束: {job.status}，{len(job.results)}条结果")
+        finally:
+            self._pollers.pop(job.id, None)
+            self._done.setdefault(job.id, asyncio.Event()).set()
+
+    async def _collect(self, client: BatchClient, job: BatchJob) -> None:
+        """下载输出和错误文件，按custom_id写入结果"""
+        requests = {request.custom_id: request for request in job.requests}
+        for file_id in (job.output_file_id, job.error_file_id):
+            if not file_id:
+                continue
+            try:
+                content = await client.get_file_content(file_id)
+            except Exception as e:
+                job.error = f"下载批量任务结果失败: {str(e)}"
+                continue
+            for line in content.splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                custom_id = record.get("custom_id")
+                if custom_id not in requests:
+                    continue
+                job.results[custom_id] = self._result(requests[custom_id], record)
+
+    @staticmethod
+    def _result(request: BatchRequest, record: Dict[str, Any]) -> Dict[str, Any]:
+        response = record.get("response") or {}
+        body = response.get("body") or {}
+        error = record.get("error") or body.get("error")
+        if error:
+            return {"error": str(error.get("message", error) if isinstance(error, dict) else error)}
+        if response.get("status_code", 200) != 200:
+            return {"error": f"HTTP {response.get('status_code')}"}
+        text = _extract_text(body) or ""
+        result: Dict[str, Any] = {"text": text}
+        if request.task == "exercises":
+            from .tools.exercise_generator import ExerciseGenerator
+
+            result["exercises"] = ExerciseGenerator.parse_exercises(text, request.params.get("count", 5))
+        return result
+
+    def get(self, job_id: str) -> BatchJob:
+        self._load_all()
+        job = self._jobs.get(job_id)
+        if job is None:
+            raise KeyError(f"批量任务 {job_id} 不存在")
+        return job
+
+    def list_jobs(self) -> List[Dict[str, Any]]:
+        self._load_all()
+        jobs = sorted(self._jobs.values(), key=lambda job: job.created_at, reverse=True)
+        return [job.summary() for job in jobs]
+
+    def results(self, job_id: str) -> List[Dict[str, Any]]:
+        """按提交顺序返回每条请求的结果，未完成的请求结果为None"""
+        job = self.get(job_id)
+        return [
+            {"custom_id": request.custom_id, "task": request.task, "params": request.params,
+             "result": job.results.get(request.custom_id)}
+            for request in job.requests
+        ]
+
+    async def wait(self, job_id: str, timeout: Optional[float] = None) -> BatchJob:
+        """等待任务结束"""
+        job = self.get(job_id)
+        if not job.finished:
+            event = self._done.setdefault(job_id, asyncio.Event())
+            await asyncio.wait_for(event.wait(), timeout)
+        return job
+
+    async def cancel(self, job_id: str) -> BatchJob:
+        job = self.get(job_id)
+        if job.finished or not job.batch_id:
+            return job
+        self._apply(job, await self._client(job.provider).cancel_batch(job.batch_id))
+        await asyncio.to_thread(self._save, job)
+        return job
+
+
+# 全局批量任务管理器
+batch_jobs = BatchJobManager()
@@ -0,0 +1,199 @@
+"""
+流式生成的端到端取消
+
+原来停止生成只是把会话标记为停止，由生成循环在两个chunk之间检查，上游的流式请求
+要等下一个token到达才会结束；浏览器关闭标签页后也没有人察觉。现在每个流式接口的
+生成链都在独立任务中运行：
+- 客户端断开（定期检查request.is_disconnected()，或向客户端写入失败）
+- /api/stop_generation
+- 服务关闭
+都会直接取消该任务，CancelledError沿生成器链传到正在等待的aiohttp读取，
+立即关闭到提供商的连接，Ollama随之停止生成，释放GPU和API配额。
+从发出取消到任务（含上游连接）结束的耗时记入stream_cancel_latency_seconds。
+配置在settings/user_settings.json的global.cancellation中。
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Any, AsyncGenerator, Deque, Dict, List, Optional, Set
+from pydantic import BaseModel, Field
+from .metrics import stream_cancellations, stream_cancel_latency
+
+# 取消原因
+REASON_STOP = "stop"
+REASON_DISCONNECT = "disconnect"
+REASON_SHUTDOWN = "shutdown"
+
+_DONE = object()
+
+
+class CancellationConfig(BaseModel):
+    """取消配置"""
+    disconnect_poll_interval: float = Field(default=0.5, gt=0)  # 检查客户端是否断开的间隔（秒）
+    shutdown_timeout: float = Field(default=5.0, ge=0)  # 服务关闭时等待生成任务结束的时间
+    history: int = Field(default=100, ge=0)  # 保留最近多少次取消的耗时
+
+
+class CancelScope:
+    """一次可取消的流式生成"""
+
+    def __init__(self, key: str, kind: str):
+        self.key = key
+        self.kind = kind
+        self.started = time.time()
+        self.reason: Optional[str] = None
+        self.requested: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def cancel(self, reason: str) -> bool:
+        """取消生成任务，任务已结束或已在取消中时返回False"""
+        if self.reason is not None or self.task is None or self.task.done():
+            return False
+        self.reason = reason
+        self.requested = time.perf_counter()
+        self.task.cancel()
+        return True
+
+    @property
+    def completed(self) -> bool:
+        """生成任务是否完整结束（没有被取消，也没有出错）"""
+        return (
+            self.reason is None
+            and self.task is not None
+            and self.task.done()
+            and not self.task.cancelled()
+            and self.task.exception() is None
+        )
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "key": self.key,
+            "kind": self.kind,
+            "duration": round(time.time() - self.started, 1),
+            "cancelling": self.reason
+        }
+
+
+class CancellationManager:
+    """管理进行中的流式生成及其取消"""
+
+    def __init__(self, config: Optional[CancellationConfig] = None):
+        self.config = config or CancellationConfig()
+        self._scopes: Dict[str, Set[CancelScope]] = {}
+        self._latencies: Deque[Dict[str, Any]] = deque(maxlen=self.config.history)
+        self.stats: Dict[str, int] = {REASON_STOP: 0, REASON_DISCONNECT: 0, REASON_SHUTDOWN: 0}
+
+    def configure(self, config: Optional[Dict[str, Any]] = None) -> None:
+        self.config = CancellationConfig(**(config or {}))
+        self._latencies = deque(self._latencies, maxlen=self.config.history)
+
+    async def run(
+        self,
+        key: str,
+        source: AsyncGenerator[Any, None],
+        request=None,
+        kind: str = "stream",
+        stopped: Any = None,
+        scope: Optional[CancelScope] = None
+    ) -> AsyncGenerator[Any, None]:
+        """在独立任务中运行source并转发其输出
+
+        key用于/api/stop_generation按会话取消；传入request时定期检查客户端是否断开。
+        因停止请求或服务关闭而结束时，如果给了stopped则最后产出stopped告知客户端。
+        客户端断开或被停止时转发正常结束，调用方需要区分完整结束和中途取消时，
+        传入scope（由scope()创建），转发结束后检查scope.completed和scope.reason。
+        """
+        scope = scope or CancelScope(key, kind)
+        queue: asyncio.Queue = asyncio.Queue()
+
+        async def produce():
+            try:
+                async for item in source:
+                    queue.put_nowait(item)
+            finally:
+                await source.aclose()
+
+        scope.task = asyncio.create_task(produce())
+        scope.task.add_done_callback(lambda task: self._finished(scope, task, queue))
+        self._scopes.setdefault(key, set()).add(scope)
+        watcher = asyncio.create_task(self._watch(scope, request)) if request is not None else None
+        try:
+            while True:
+                item = await queue.get()
+                if item is _DONE:
+                    break
+                yield item
+            if scope.task.cancelled():
+                if stopped is not None and scope.reason in (REASON_STOP, REASON_SHUTDOWN):
+                    yield stopped
+            elif scope.task.exception() is not None:
+                raise scope.task.exception()
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            # 转发方先结束（写入客户端失败、接口被取消）时同样视为客户端断开
+            scope.cancel(REASON_DISCONNECT)
+            scopes = self._scopes.get(key)
+            if scopes is not None:
+                scopes.discard(scope)
+                if not scopes:
+                    del self._scopes[key]
+
+    def scope(self, key: str, kind: str = "stream") -> CancelScope:
+        """创建传给run()的取消范围"""
+        return CancelScope(key, kind)
+
+    async def _watch(self, scope: CancelScope, request) -> None:
+        """定期检查客户端是否断开"""
+        while not scope.task.done():
+            await asyncio.sleep(self.config.disconnect_poll_interval)
+            if await request.is_disconnected():
+                if scope.cancel(REASON_DISCONNECT):
+                    print(f"客户端已断开，取消生成: {scope.key}")
+                return
+
+    def _finished(self, scope: CancelScope, task: asyncio.Task, queue: asyncio.Queue) -> None:
+        """生成任务结束（此时上游连接已关闭），记录取消耗时"""
+        queue.put_nowait(_DONE)
+        # 转发方已离开时，任务中的异常也视为已处理
+        task.cancelled() or task.exception()
+        if scope.requested is None:
+            return
+        latency = time.perf_counter() - scope.requested
+        self.stats[scope.reason] += 1
+        stream_cancellations.inc(reason=scope.reason, kind=scope.kind)
+        stream_cancel_latency.observe(latency, reason=scope.reason)
+        self._latencies.append({"key": scope.key, "reason": scope.reason, "latency": round(latency, 4)})
+
+    def cancel(self, key: str, reason: str = REASON_STOP) -> bool:
+        """取消指定会话的所有生成"""
+        return sum(scope.cancel(reason) for scope in list(self._scopes.get(key, ()))) > 0
+
+    async def shutdown(self) -> None:
+        """服务关闭：取消全部生成并等待上游连接关闭"""
+        tasks: List[asyncio.Task] = []
+        for scopes in list(self._scopes.values()):
+            for scope in list(scopes):
+                if scope.cancel(REASON_SHUTDOWN):
+                    tasks.append(scope.task)
+        if tasks:
+            print(f"服务关闭，取消 {len(tasks)} 个进行中的生成")
+            if self.config.shutdown_timeout:
+                await asyncio.wait(tasks, timeout=self.config.shutdown_timeout)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """进行中的生成、各原因的取消次数和最近的取消耗时"""
+        latencies = sorted(item["latency"] for item in self._latencies)
+        return {
+            "active": [scope.summary() for scopes in self._scopes.values() for scope in scopes],
+            "cancelled": dict(self.stats),
+            "latency": {
+                "p50": latencies[len(latencies) // 2] if latencies else None,
+                "max": latencies[-1] if latencies else None
+            },
+            "recent": list(self._latencies)
+        }
+
+
+# 全局取消管理器
+cancellation = CancellationManager()
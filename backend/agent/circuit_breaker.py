@@ -0,0 +1,246 @@
+"""
+提供商熔断器与分阶段超时
+
+原来提供商调用没有设置超时：提供商挂起时请求一直占着执行槽位，直到连接被服务器断开，
+流式生成器里的循环甚至会永远等下去；提供商持续出错时新请求仍然排队发过去。
+- 分阶段超时（按提供商配置，0表示不限制）：
+  connect为建立连接的超时；first_token为拿到执行槽位后等待首token的超时（含发送请求、
+  Ollama加载模型和预填充）；idle为相邻token之间的最长间隔
+- 熔断器（按提供商）：最近window秒内至少min_calls次调用且失败率达到failure_rate时打开，
+  打开期间直接拒绝（CircuitOpen，API层返回503和Retry-After）；open_seconds后半开，
+  放行half_open_calls个探测调用，成功则关闭，失败则重新打开
+- 只有超时、连接错误和5xx（或流中的错误事件）计为失败；4xx、限流和取消不计入
+状态在/health中可见。
+配置在settings/user_settings.json的global.circuit_breaker中。
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Any, AsyncGenerator, Deque, Dict, Optional, Tuple
+import aiohttp
+from pydantic import BaseModel, Field
+from .errors import CircuitOpen, ProviderAPIError, ProviderTimeout
+from .metrics import llm_timeouts, llm_circuit_state, llm_circuit_rejections
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class PhaseTimeouts(BaseModel):
+    """单个提供商的分阶段超时（秒，0表示不限制）"""
+    connect: float = Field(default=10.0, ge=0)
+    first_token: float = Field(default=120.0, ge=0)
+    idle: float = Field(default=60.0, ge=0)
+
+
+class CircuitBreakerConfig(BaseModel):
+    """熔断器与超时配置"""
+    enabled: bool = True
+    window: float = Field(default=60.0, gt=0)  # 统计失败率的时间窗口（秒）
+    min_calls: int = Field(default=5, ge=1)  # 窗口内至少多少次调用才判断失败率
+    failure_rate: float = Field(default=0.5, gt=0, le=1)
+    open_seconds: float = Field(default=30.0, gt=0)  # 打开多久后进入半开
+    half_open_calls: int = Field(default=1, ge=1)  # 半开时同时放行的探测调用数
+    timeouts: Dict[str, PhaseTimeouts] = {
+        "default": PhaseTimeouts(),
+        # 本地模型冷加载可能需要几分钟
+        "ollama": PhaseTimeouts(first_token=300.0)
+    }
+
+
+async def _next_token(stream: AsyncGenerator[str, None], limit: float) -> str:
+    """等待下一个token，limit秒内没有输出时抛出asyncio.TimeoutError
+
+    超时直接加在消费方的任务上（asyncio.timeout），不为每个token新建任务，上游生成器链
+    与消费方共用上下文变量和取消；Python 3.11以下退回wait_for。
+    """
+    if not limit:
+        return await stream.__anext__()
+    if not hasattr(asyncio, "timeout"):
+        return await asyncio.wait_for(stream.__anext__(), limit)
+    async with asyncio.timeout(limit):
+        return await stream.__anext__()
+
+
+def is_failure(error: Optional[BaseException]) -> bool:
+    """错误是否说明提供商本身不可用"""
+    if isinstance(error, ProviderAPIError):
+        return error.status is None or error.status >= 500
+    return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientError, ConnectionError))
+
+
+class CircuitBreaker:
+    """单个提供商的熔断器"""
+
+    def __init__(self, provider: str, manager: "CircuitBreakerManager"):
+        self.provider = provider
+        self.manager = manager
+        self.state = CLOSED
+        self.opened_at: Optional[float] = None
+        self.probes = 0  # 半开时进行中的探测调用数
+        self.calls: Deque[Tuple[float, bool]] = deque()  # (时间, 是否失败)
+        self.stats = {"successes": 0, "failures": 0, "rejected": 0, "opened": 0}
+        self.last_error: Optional[str] = None
+
+    @property
+    def config(self) -> CircuitBreakerConfig:
+        return self.manager.config
+
+    def _set_state(self, state: str) -> None:
+        if state != self.state:
+            print(f"{self.provider}熔断器: {self.state} -> {state}")
+        self.state = state
+        llm_circuit_state.labels(provider=self.provider).set(STATE_VALUES[state])
+
+    def retry_after(self) -> float:
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.opened_at + self.config.open_seconds - time.time())
+
+    def allow(self, model: str) -> None:
+        """调用前检查，熔断器打开时抛出CircuitOpen"""
+        if not self.config.enabled:
+            return
+        if self.state == OPEN and self.retry_after() <= 0:
+            self._set_state(HALF_OPEN)
+            self.probes = 0
+        if self.state == OPEN or (self.state == HALF_OPEN and self.probes >= self.config.half_open_calls):
+            self.stats["rejected"] += 1
+            llm_circuit_rejections.inc(provider=self.provider)
+            raise CircuitOpen(self.provider, model, self.retry_after() or self.config.open_seconds)
+        if self.state == HALF_OPEN:
+            self.probes += 1
+
+    def record(self, outcome: str, error: Optional[BaseException] = None) -> None:
+        """记录一次已放行调用的结果（outcome与LLMCallMetrics相同）"""
+        if not self.config.enabled:
+            return
+        half_open = self.state == HALF_OPEN
+        if half_open:
+            self.probes = max(0, self.probes - 1)
+        if outcome == "success":
+            failed = False
+            self.stats["successes"] += 1
+        elif outcome == "error" and is_failure(error):
+            failed = True
+            self.stats["failures"] += 1
+            self.last_error = f"{error.__class__.__name__}: {str(error)}"[:200]
+        else:
+            # 取消、限流、4xx等不说明提供商是否可用
+            return
+        if half_open:
+            if failed:
+                self._open()
+            else:
+                self.calls.clear()
+                self.opened_at = None
+                self._set_state(CLOSED)
+            return
+        now = time.time()
+        self.calls.append((now, failed))
+        while self.calls and self.calls[0][0] < now - self.config.window:
+            self.calls.popleft()
+        if self.state == CLOSED and failed and len(self.calls) >= self.config.min_calls:
+            failures = sum(1 for _, bad in self.calls if bad)
+            if failures / len(self.calls) >= self.config.failure_rate:
+                self._open()
+
+    def _open(self) -> None:
+        self.opened_at = time.time()
+        self.stats["opened"] += 1
+        self._set_state(OPEN)
+        print(f"{self.provider}近期失败率过高，熔断{self.config.open_seconds:g}秒: {self.last_error}")
+
+    def summary(self) -> Dict[str, Any]:
+        failures = sum(1 for _, bad in self.calls if bad)
+        return {
+            "state": self.state,
+            "retry_after": round(self.retry_after(), 2) if self.state == OPEN else None,
+            "window_calls": len(self.calls),
+            "window_failures": failures,
+            "last_error": self.last_error,
+            **self.stats
+        }
+
+
+class CircuitBreakerManager:
+    """各提供商的熔断器和超时配置"""
+
+    def __init__(self, config: Optional[CircuitBreakerConfig] = None):
+        self.config = config or CircuitBreakerConfig()
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self.timeout_counts: Dict[str, Dict[str, int]] = {}
+
+    def configure(self, config: Optional[Dict[str, Any]] = None) -> None:
+        self.config = CircuitBreakerConfig(**(config or {}))
+
+    def get(self, provider: str) -> CircuitBreaker:
+        breaker = self._breakers.get(provider)
+        if breaker is None:
+            breaker = CircuitBreaker(provider, self)
+            self._breakers[provider] = breaker
+        return breaker
+
+    def timeouts(self, provider: str) -> PhaseTimeouts:
+        return self.config.timeouts.get(provider) or self.config.timeouts.get("default") or PhaseTimeouts()
+
+    def client_timeout(self, provider: str, read: bool = False) -> aiohttp.ClientTimeout:
+        """请求使用的aiohttp超时：只限制建立连接（流式输出由deadlines控制）；
+        read为True时用于非流式请求，读取响应的超时取first_token"""
+        timeouts = self.timeouts(provider)
+        return aiohttp.ClientTimeout(
+            total=None,
+            sock_connect=timeouts.connect or None,
+            sock_read=(timeouts.first_token or None) if read else None
+        )
+
+    def _timed_out(self, provider: str, phase: str) -> None:
+        counts = self.timeout_counts.setdefault(provider, {})
+        counts[phase] = counts.get(phase, 0) + 1
+        llm_timeouts.inc(provider=provider, phase=phase)
+
+    async def deadlines(
+        self,
+        provider: str,
+        model: str,
+        stream: AsyncGenerator[str, None]
+    ) -> AsyncGenerator[str, None]:
+        """为流式输出加上首token和token间隔超时"""
+        timeouts = self.timeouts(provider)
+        phase = "first_token"
+        try:
+            while True:
+                limit = timeouts.first_token if phase == "first_token" else timeouts.idle
+                try:
+                    token = await _next_token(stream, limit)
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError as e:
+                    if isinstance(e, aiohttp.ClientError):
+                        # 建立连接超时（aiohttp的ServerTimeoutError）
+                        self._timed_out(provider, "connect")
+                        raise
+                    self._timed_out(provider, phase)
+                    raise ProviderTimeout(provider, model, phase, limit) from e
+                phase = "idle"
+                yield token
+        finally:
+            await stream.aclose()
+
+    def get_states(self) -> Dict[str, str]:
+        """各提供商熔断器的状态"""
+        return {provider: breaker.state for provider, breaker in self._breakers.items()}
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "config": self.config.dict(),
+            "breakers": {provider: breaker.summary() for provider, breaker in self._breakers.items()},
+            "timeouts": self.timeout_counts
+        }
+
+
+# 全局熔断器
+circuit_breakers = CircuitBreakerManager()
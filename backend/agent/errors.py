@@ -0,0 +1,80 @@
+"""
+LLM调用相关的异常类型
+"""
+import asyncio
+from typing import Optional
+
+
+class AdmissionRejected(Exception):
+    """并发等待队列已满或排队超时，请求被拒绝"""
+
+    def __init__(self, provider: str, model: str, reason: str, retry_after: float):
+        self.provider = provider
+        self.model = model
+        self.reason = reason  # queue_full/queue_timeout/rate_limited/circuit_open
+        self.retry_after = retry_after
+        super().__init__(
+            f"{provider}/{model} 当前请求过多（{reason}），请在{max(retry_after, 1):.0f}秒后重试"
+        )
+
+
+class RateLimited(AdmissionRejected):
+    """提供商限流（本地令牌桶等待过久，或多次收到429），请求被拒绝"""
+
+    def __init__(self, provider: str, model: str, retry_after: float):
+        super().__init__(provider, model, "rate_limited", retry_after)
+
+
+class ProviderRateLimited(Exception):
+    """提供商返回429（尚未产出token），调用入口释放执行槽位，等待retry_after秒后重试"""
+
+    def __init__(self, provider: str, model: str, retry_after: float, detail: str):
+        self.provider = provider
+        self.model = model
+        self.retry_after = retry_after
+        self.detail = detail
+        super().__init__(f"{provider}/{model} 被限流: {detail}")
+
+
+class CircuitOpen(AdmissionRejected):
+    """提供商近期错误率过高，熔断器打开期间直接拒绝请求"""
+
+    def __init__(self, provider: str, model: str, retry_after: float):
+        super().__init__(provider, model, "circuit_open", retry_after)
+
+
+class ProviderTimeout(asyncio.TimeoutError):
+    """提供商在规定时间内没有产出首token（first_token）或相邻token间隔过长（idle）"""
+
+    def __init__(self, provider: str, model: str, phase: str, seconds: float):
+        self.provider = provider
+        self.model = model
+        self.phase = phase
+        self.seconds = seconds
+        super().__init__(f"{provider}/{model} 等待{'首token' if phase == 'first_token' else '下一个token'}超过{seconds:g}秒")
+
+
+class ProviderAPIError(ValueError):
+    """提供商返回错误状态码，或在流中返回错误事件（status为None）"""
+
+    def __init__(self, status: Optional[int], detail: str):
+        self.status = status
+        self.detail = detail
+        if status is None:
+            super().__init__(f"API错误: {detail}")
+        else:
+            super().__init__(f"API错误 ({status}): {detail}")
+
+
+class OutputParseError(ValueError):
+    """模型输出不符合预期格式，无法解析"""
+
+
+class RetryExhausted(Exception):
+    """重试次数或总时长预算耗尽"""
+
+    def __init__(self, operation: str, attempts: int, last_error: BaseException):
+        self.operation = operation
+        self.attempts = attempts
+        self.last_error = last_error
+        super().__init__(f"{operation}失败，已尝试{attempts}次: {last_error}")
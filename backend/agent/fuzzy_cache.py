@@ -0,0 +1,286 @@
+"""
+近似重复请求缓存
+
+"Python 列表"、"python列表"、"Python 的列表"这类只在写法上不同的主题会命中同一条缓存：
+- 规范化：NFKC（全角/半角折叠）、大小写折叠、去掉标点和空白、去掉"的"等虚词
+- 字符n-gram集合上计算MinHash签名（numpy向量化），按band分桶做LSH检索候选
+- 候选按签名相似度排序，再用n-gram集合的Jaccard相似度确认，超过阈值即视为同一请求
+每个接口单独建索引，非主题参数（题型、难度、模型等）必须完全一致才会匹配。
+缓存保存结果的深拷贝，命中时也返回深拷贝，调用方修改返回的结果不会影响缓存。
+全部在本地计算，不依赖向量服务。配置在settings/user_settings.json的global.fuzzy_cache中。
+"""
+import copy
+import hashlib
+import json
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Set, Tuple
+import numpy as np
+from pydantic import BaseModel, Field
+
+_MERSENNE_PRIME = np.uint64((1 << 31) - 1)
+# 对主题有区分意义的标点（C++、C#）不折叠
+_KEEP_CHARS = set("+#")
+
+
+class FuzzyEndpointPolicy(BaseModel):
+    """单个接口的近似缓存策略"""
+    enabled: bool = True
+    threshold: float = Field(default=0.8, gt=0, le=1)  # n-gram Jaccard相似度阈值
+    ttl: float = Field(default=7 * 24 * 3600, gt=0)  # 条目有效期（秒）
+
+
+class FuzzyCacheConfig(BaseModel):
+    """近似缓存配置"""
+    enabled: bool = True
+    ngram: int = Field(default=2, ge=1)  # 字符n-gram长度
+    num_perm: int = Field(default=64, ge=8)  # MinHash签名长度
+    bands: int = Field(default=16, ge=1)  # LSH分桶数，num_perm需能被整除
+    max_entries: int = Field(default=1000, ge=1)  # 每个接口最多保存的条目数
+    stopwords: List[str] = ["的", "之", "是什么", "什么是", "介绍", "关于"]
+    endpoints: Dict[str, FuzzyEndpointPolicy] = {
+        "concept_analyze": FuzzyEndpointPolicy(),
+        "knowledge_graph_generate": FuzzyEndpointPolicy(),
+        "exercises": FuzzyEndpointPolicy(threshold=0.85, ttl=24 * 3600)
+    }
+
+
+def normalize_text(text: str, stopwords: List[str] = ()) -> str:
+    """折叠全角、大小写、标点和空白"""
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    for word in sorted(stopwords, key=len, reverse=True):
+        text = text.replace(word, "")
+    return "".join(
+        char for char in text
+        if char in _KEEP_CHARS or not unicodedata.category(char).startswith(("P", "Z", "C"))
+    )
+
+
+def char_ngrams(text: str, n: int) -> Set[str]:
+    """字符n-gram集合，短于n的文本整体作为一个n-gram"""
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class MinHasher:
+    """向量化MinHash：一次计算一个n-gram集合在所有置换下的最小哈希"""
+
+    def __init__(self, num_perm: int, seed: int = 1):
+        rng = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self._a = rng.randint(1, int(_MERSENNE_PRIME), size=(num_perm, 1)).astype(np.uint64)
+        self._b = rng.randint(0, int(_MERSENNE_PRIME), size=(num_perm, 1)).astype(np.uint64)
+
+    def signature(self, grams: Set[str]) -> np.ndarray:
+        if not grams:
+            return np.full(self.num_perm, int(_MERSENNE_PRIME), dtype=np.uint64)
+        hashed = np.fromiter(
+            (zlib.crc32(gram.encode("utf-8")) for gram in grams),
+            dtype=np.uint64,
+            count=len(grams)
+        )
+        # (a*x + b) mod p，a、b小于2^31且x小于2^32，uint64不会溢出
+        return ((self._a * hashed + self._b) % _MERSENNE_PRIME).min(axis=1)
+
+
+@dataclass
+class FuzzyEntry:
+    """一条近似缓存记录"""
+    text: str
+    normalized: str
+    grams: Set[str]
+    signature: np.ndarray
+    value: Any
+    created: float
+    hits: int = 0
+
+
+class EndpointIndex:
+    """单个接口的MinHash/LSH索引"""
+
+    def __init__(self, config: FuzzyCacheConfig):
+        self.config = config
+        self.rows = config.num_perm // config.bands
+        self._entries: "OrderedDict[int, Tuple[str, FuzzyEntry]]" = OrderedDict()
+        self._buckets: Dict[Tuple[str, int, bytes], Set[int]] = {}
+        self._next_id = 0
+
+    def _band_keys(self, context: str, signature: np.ndarray) -> List[Tuple[str, int, bytes]]:
+        return [
+            (context, band, signature[band * self.rows:(band + 1) * self.rows].tobytes())
+            for band in range(self.config.bands)
+        ]
+
+    def _remove(self, entry_id: int) -> None:
+        context, entry = self._entries.pop(entry_id)
+        for key in self._band_keys(context, entry.signature):
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def query(
+        self,
+        context: str,
+        grams: Set[str],
+        signature: np.ndarray,
+        policy: FuzzyEndpointPolicy
+    ) -> Optional[Tuple[FuzzyEntry, float]]:
+        """查找最相似且超过阈值的条目"""
+        candidates: Set[int] = set()
+        for key in self._band_keys(context, signature):
+            candidates |= self._buckets.get(key, set())
+        if not candidates:
+            return None
+        now = time.time()
+        ids = []
+        for entry_id in candidates:
+            if now - self._entries[entry_id][1].created > policy.ttl:
+                self._remove(entry_id)
+            else:
+                ids.append(entry_id)
+        if not ids:
+            return None
+        # 按签名一致比例（Jaccard的MinHash估计）排序，再用精确Jaccard确认
+        signatures = np.stack([self._entries[entry_id][1].signature for entry_id in ids])
+        estimates = (signatures == signature).mean(axis=1)
+        for position in np.argsort(-estimates):
+            entry_id = ids[position]
+            entry = self._entries[entry_id][1]
+            similarity = jaccard(grams, entry.grams)
+            if similarity >= policy.threshold:
+                self._entries.move_to_end(entry_id)
+                return entry, similarity
+        return None
+
+    def add(self, context: str, entry: FuzzyEntry) -> None:
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = (context, entry)
+        for key in self._band_keys(context, entry.signature):
+            self._buckets.setdefault(key, set()).add(entry_id)
+        while len(self._entries) > self.config.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class FuzzyRequestCache:
+    """按接口的近似重复请求缓存"""
+
+    def __init__(self, config: Optional[FuzzyCacheConfig] = None):
+        self.configure_model(config or FuzzyCacheConfig())
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    def configure_model(self, config: FuzzyCacheConfig) -> None:
+        if config.num_perm % config.bands:
+            raise ValueError("num_perm必须能被bands整除")
+        previous = getattr(self, "config", None)
+        self.config = config
+        if previous is not None and self._signature_params(previous) == self._signature_params(config):
+            # 签名计算方式不变时保留已有索引
+            for index in self._indexes.values():
+                index.config = config
+            return
+        self._hasher = MinHasher(config.num_perm)
+        self._indexes: Dict[str, EndpointIndex] = {}
+
+    @staticmethod
+    def _signature_params(config: FuzzyCacheConfig) -> Tuple:
+        return config.ngram, config.num_perm, config.bands, tuple(config.stopwords)
+
+    def configure(self, config: Optional[Dict[str, Any]] = None) -> None:
+        self.configure_model(FuzzyCacheConfig(**(config or {})))
+
+    def policy(self, endpoint: str) -> Optional[FuzzyEndpointPolicy]:
+        if not self.config.enabled:
+            return None
+        policy = self.config.endpoints.get(endpoint)
+        return policy if policy is not None and policy.enabled else None
+
+    @staticmethod
+    def _context_key(context: Optional[Dict[str, Any]]) -> str:
+        """非主题参数必须完全一致"""
+        payload = json.dumps(context or {}, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+    def _prepare(self, text: str) -> Tuple[str, Set[str], np.ndarray]:
+        normalized = normalize_text(text, self.config.stopwords)
+        grams = char_ngrams(normalized, self.config.ngram)
+        return normalized, grams, self._hasher.signature(grams)
+
+    def _stats(self, endpoint: str) -> Dict[str, int]:
+        return self.stats.setdefault(endpoint, {"hits": 0, "exact_hits": 0, "misses": 0, "stores": 0})
+
+    def lookup(self, endpoint: str, text: str, context: Optional[Dict[str, Any]] = None) -> Optional[Any]:
+        """查找近似的历史请求，返回其结果"""
+        policy = self.policy(endpoint)
+        if policy is None:
+            return None
+        normalized, grams, signature = self._prepare(text)
+        index = self._indexes.get(endpoint)
+        match = index.query(self._context_key(context), grams, signature, policy) if index else None
+        stats = self._stats(endpoint)
+        if match is None:
+            stats["misses"] += 1
+            return None
+        entry, similarity = match
+        entry.hits += 1
+        stats["hits"] += 1
+        if entry.normalized == normalized:
+            stats["exact_hits"] += 1
+        print(f"近似缓存命中[{endpoint}]: '{text}' ≈ '{entry.text}' (相似度 {similarity:.2f})")
+        return copy.deepcopy(entry.value)
+
+    def store(self, endpoint: str, text: str, value: Any, context: Optional[Dict[str, Any]] = None) -> None:
+        """保存一次请求的结果"""
+        if self.policy(endpoint) is None:
+            return
+        normalized, grams, signature = self._prepare(text)
+        if not grams:
+            return
+        index = self._indexes.get(endpoint)
+        if index is None:
+            index = EndpointIndex(self.config)
+            self._indexes[endpoint] = index
+        index.add(self._context_key(context), FuzzyEntry(
+            text=text,
+            normalized=normalized,
+            grams=grams,
+            signature=signature,
+            value=copy.deepcopy(value),
+            created=time.time()
+        ))
+        self._stats(endpoint)["stores"] += 1
+
+    def clear(self) -> None:
+        self._indexes.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取各接口的命中统计"""
+        result = {}
+        for endpoint, stats in self.stats.items():
+            lookups = stats["hits"] + stats["misses"]
+            index = self._indexes.get(endpoint)
+            result[endpoint] = {
+                **stats,
+                "entries": len(index) if index else 0,
+                "hit_rate": round(stats["hits"] / lookups, 4) if lookups else 0.0
+            }
+        return result
+
+
+# 全局近似缓存实例
+fuzzy_cache = FuzzyRequestCache()
@@ -0,0 +1,192 @@
+"""
+按任务的生成参数
+
+设置中的max_tokens为-1时请求不带长度限制，模型跑题时一次只需几行的图谱拓展也可能生成几分钟。
+每个工具调用LLM时带上任务名（task），按任务的生成参数：
+- max_tokens：该任务的输出上限（Ollama的num_predict），提供商配置了更小的上限时以提供商为准
+- temperature：该任务的采样温度，未设置时沿用提供商配置
+- stop：停止序列，在客户端匹配，输出中保留停止序列本身（解析器依赖闭合标签），
+  匹配后立即关闭响应，上游随连接断开停止生成
+- item_marker/max_items：以item_marker开头的行达到max_items行时停止（如第N个<node|行之后）；
+  结构化输出模式下按解析出的条目数停止
+按任务统计输出被长度上限截断、被停止序列和条目数提前结束的次数。
+配置在settings/user_settings.json的global.generation_profiles中，只需写出要覆盖的字段。
+"""
+from typing import Any, Dict, List, Optional
+from pydantic import BaseModel, Field
+from .metrics import generation_stops
+from .tokens import estimate_tokens
+
+# 提供商表示"达到长度上限"的结束原因
+LENGTH_REASONS = ("length", "max_tokens", "max_output_tokens")
+
+
+class GenerationProfile(BaseModel):
+    """单个任务的生成参数"""
+    max_tokens: Optional[int] = Field(default=None, gt=0)  # None表示沿用提供商配置
+    temperature: Optional[float] = Field(default=None, ge=0, le=2)
+    stop: List[str] = []
+    item_marker: Optional[str] = None  # 按行计数的条目前缀
+    max_items: Optional[int] = Field(default=None, gt=0)
+
+    def resolve_max_tokens(self, configured: Optional[int]) -> Optional[int]:
+        """与提供商配置的上限合并，-1或None表示不限制"""
+        if configured is None or configured == -1:
+            return self.max_tokens or configured
+        return min(configured, self.max_tokens) if self.max_tokens else configured
+
+    def resolve_temperature(self, configured: float) -> float:
+        return configured if self.temperature is None else self.temperature
+
+
+DEFAULT_PROFILES: Dict[str, Dict[str, Any]] = {
+    "main_outline": {"max_tokens": 2048},
+    "chapter_outline": {"max_tokens": 2048},
+    "section": {"max_tokens": 4096},
+    "exercises": {"max_tokens": 4096},
+    "concept_analyze": {"max_tokens": 2048, "temperature": 0.3, "stop": ["</应用>"]},
+    "knowledge_graph": {"max_tokens": 1024, "item_marker": "<node|", "max_items": 6},
+    "knowledge_relation": {"max_tokens": 256, "temperature": 0.3, "item_marker": "<relation|", "max_items": 1},
+    "simulation": {"max_tokens": 8192, "stop": ["</html>"]},
+    "resources_search": {"max_tokens": 2048, "temperature": 0.3},
+    "micro_batch": {"max_tokens": 8192}  # 多个小请求合并的调用，见micro_batcher
+}
+
+
+class GenerationProfilesConfig(BaseModel):
+    """按任务的生成参数配置"""
+    enabled: bool = True
+    profiles: Dict[str, Dict[str, Any]] = {}  # 覆盖默认参数的字段
+
+
+class GenerationGuard:
+    """一次调用中执行停止条件并记录结束原因"""
+
+    def __init__(self, task: str, profile: GenerationProfile):
+        self.task = task
+        self.profile = profile
+        self.reason: Optional[str] = None  # 提供商返回的结束原因
+        self.stopped: Optional[str] = None  # stop_sequence或item_limit
+        self.tokens = 0
+        self._text = ""
+        self._line = ""
+        self._items = 0
+        self._longest_stop = max((len(stop) for stop in profile.stop), default=0)
+
+    def observe(self, reason: Optional[str]) -> None:
+        """记录提供商返回的结束原因"""
+        if reason:
+            self.reason = reason
+
+    def feed(self, token: str) -> str:
+        """返回token中应输出的部分，满足停止条件时设置stopped"""
+        if self.stopped or not token:
+            return ""
+        cut = len(token)
+        if self.profile.stop:
+            # 停止序列可能跨token，从上一段末尾开始查找
+            start = max(0, len(self._text) - self._longest_stop + 1)
+            window = self._text[start:] + token
+            for stop in self.profile.stop:
+                index = window.find(stop)
+                if index != -1:
+                    cut = min(cut, start + index + len(stop) - len(self._text))
+                    self.stopped = "stop_sequence"
+        if self.profile.item_marker and self.profile.max_items:
+            position = 0
+            while True:
+                newline = token.find("\n", position, cut)
+                if newline == -1:
+                    self._line += token[position:cut]
+                    break
+                line, self._line = self._line + token[position:newline], ""
+                position = newline + 1
+                if line.strip().startswith(self.profile.item_marker):
+                    self._items += 1
+                    if self._items >= self.profile.max_items:
+                        cut = position
+                        self.stopped = "item_limit"
+                        break
+        token = token[:cut]
+        self._text += token
+        self.tokens += estimate_tokens(token)
+        return token
+
+    @property
+    def truncated(self) -> bool:
+        return self.stopped is None and self.reason in LENGTH_REASONS
+
+
+class GenerationProfileManager:
+    """任务生成参数与提前结束统计"""
+
+    def __init__(self, config: Optional[GenerationProfilesConfig] = None):
+        self.config = config or GenerationProfilesConfig()
+        self.profiles: Dict[str, GenerationProfile] = {}
+        self.stats: Dict[str, Dict[str, int]] = {}
+        self._build()
+
+    def configure(self, config: Optional[Dict[str, Any]] = None) -> None:
+        self.config = GenerationProfilesConfig(**(config or {}))
+        self._build()
+
+    def _build(self) -> None:
+        profiles = {}
+        for task in {**DEFAULT_PROFILES, **self.config.profiles}:
+            fields = {**DEFAULT_PROFILES.get(task, {}), **(self.config.profiles.get(task) or {})}
+            try:
+                profiles[task] = GenerationProfile(**fields)
+            except Exception as e:
+                print(f"任务 {task} 的生成参数无效，使用默认值: {str(e)}")
+                profiles[task] = GenerationProfile(**DEFAULT_PROFILES.get(task, {}))
+        self.profiles = profiles
+
+    def get(self, task: Optional[str]) -> Optional[GenerationProfile]:
+        if not task or not self.config.enabled:
+            return None
+        return self.profiles.get(task)
+
+    def guard(self, task: Optional[str]) -> Optional[GenerationGuard]:
+        """为一次调用创建停止条件，任务没有生成参数时返回None"""
+        profile = self.get(task)
+        return GenerationGuard(task, profile) if profile is not None else None
+
+    def _stats(self, task: str) -> Dict[str, int]:
+        return self.stats.setdefault(task, {
+            "calls": 0,
+            "truncated": 0,  # 达到max_tokens被截断
+            "stop_sequence": 0,
+            "item_limit": 0,
+            "output_tokens": 0
+        })
+
+    def record(self, guard: GenerationGuard, outcome: str) -> None:
+        """调用结束时记录结束原因"""
+        stats = self._stats(guard.task)
+        stats["calls"] += 1
+        stats["output_tokens"] += guard.tokens
+        reason = "truncated" if guard.truncated else guard.stopped
+        if reason is not None and outcome == "success":
+            self.stopped_early(guard.task, reason)
+            if reason == "truncated":
+                print(f"任务 {guard.task} 的输出达到上限 {guard.profile.max_tokens} tokens 被截断")
+
+    def stopped_early(self, task: str, reason: str) -> None:
+        """记录一次提前结束（结构化输出按条目数停止时由调用方记录）"""
+        self._stats(task)[reason] += 1
+        generation_stops.inc(task=task, reason=reason)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """各任务的生成参数和截断率"""
+        return {
+            "enabled": self.config.enabled,
+            "profiles": {task: profile.dict() for task, profile in self.profiles.items()},
+            "tasks": {
+                task: {**stats, "truncation_rate": round(stats["truncated"] / stats["calls"], 4) if stats["calls"] else None}
+                for task, stats in self.stats.items()
+            }
+        }
+
+
+# 全局生成参数管理器
+generation_profiles = GenerationProfileManager()
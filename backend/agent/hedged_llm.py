@@ -0,0 +1,175 @@
+"""
+对冲与故障转移LLM
+
+把多个已配置的提供商组合成一个LLM：
+- 先请求主提供商；超过阈值（默认取主提供商首token延迟的p95）仍没有首token时，
+  向下一个备用提供商发出对冲请求
+- 哪个流先产出首token就使用哪个，其余请求立即取消（关闭上游连接）
+- 在产出首token之前出错时自动切换到下一个备用提供商
+产出首token之后的错误不再切换，避免向调用方输出两段不同的内容。
+配置在settings/user_settings.json的global.hedging中。
+"""
+import asyncio
+import time
+from typing import Any, AsyncGenerator, Dict, List, Optional
+from langchain.llms.base import LLM
+from pydantic import BaseModel, Field
+from .latency import ttft_tracker
+
+
+class HedgingConfig(BaseModel):
+    """对冲请求配置"""
+    enabled: bool = True
+    providers: List[str] = []  # 备用提供商顺序，为空时使用所有已配置API密钥的远程提供商
+    hedge_delay: Optional[float] = Field(default=None, gt=0)  # 固定的对冲阈值（秒），为空时按p95首token延迟
+    percentile: float = Field(default=0.95, gt=0, le=1)
+    default_delay: float = Field(default=3.0, gt=0)  # 样本不足时使用的阈值（秒）
+    min_delay: float = Field(default=0.5, ge=0)
+    max_delay: float = Field(default=10.0, gt=0)
+    min_samples: int = Field(default=20, ge=1)  # 使用分位数阈值所需的最少样本数
+    max_hedges: int = Field(default=1, ge=0)  # 最多额外发出的对冲请求数（不含故障转移）
+    failover: bool = True  # 首token之前出错时是否切换到备用提供商
+
+
+class HedgedLLM(LLM):
+    """主提供商加备用提供商的组合LLM"""
+    primary: Any
+    backups: List[Any] = []
+    hedging: Any = None
+    stats: Dict[str, int] = {}
+
+    def __init__(self, **kwargs):
+        """初始化"""
+        super().__init__(**kwargs)
+        self.hedging = self.hedging or HedgingConfig()
+        self.stats = {
+            "calls": 0,
+            "hedged": 0,
+            "failovers": 0,
+            "primary_wins": 0,
+            "backup_wins": 0,
+            "failed": 0
+        }
+
+    @property
+    def _llm_type(self) -> str:
+        # 对外表现为主提供商（准入检查、日志等使用）
+        return self.primary._llm_type
+
+    @property
+    def config(self):
+        return self.primary.config
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {
+            "primary": f"{self.primary._llm_type}/{self.primary.config.model_name}",
+            "backups": [f"{llm._llm_type}/{llm.config.model_name}" for llm in self.backups]
+        }
+
+    def hedge_delay(self) -> float:
+        """发出对冲请求前等待主提供商首token的时间"""
+        if self.hedging.hedge_delay:
+            return self.hedging.hedge_delay
+        provider, model = self.primary._llm_type, self.primary.config.model_name
+        if ttft_tracker.count(provider, model) < self.hedging.min_samples:
+            return self.hedging.default_delay
+        delay = ttft_tracker.percentile(provider, model, self.hedging.percentile)
+        return min(self.hedging.max_delay, max(self.hedging.min_delay, delay))
+
+    @staticmethod
+    async def _produce(index: int, llm, prompt: str, kwargs: Dict[str, Any], queue: asyncio.Queue) -> None:
+        """把单个提供商的流写入共享队列"""
+        try:
+            async for token in llm._call(prompt, **kwargs):
+                await queue.put(("token", index, token))
+            await queue.put(("done", index, None))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await queue.put(("error", index, e))
+
+    async def _call(
+        self,
+        prompt: str,
+        **kwargs: Any
+    ) -> AsyncGenerator[str, None]:
+        """对冲调用：使用最先产出首token的流"""
+        candidates = [self.primary] + list(self.backups)
+        queue: asyncio.Queue = asyncio.Queue()
+        tasks: Dict[int, asyncio.Task] = {}
+        hedges = 0
+        winner: Optional[int] = None
+        self.stats["calls"] += 1
+
+        def launch() -> bool:
+            index = len(tasks)
+            if index >= len(candidates):
+                return False
+            tasks[index] = asyncio.create_task(
+                self._produce(index, candidates[index], prompt, kwargs, queue)
+            )
+            return True
+
+        def cancel_others(keep: int) -> None:
+            for index, task in tasks.items():
+                if index != keep and not task.done():
+                    task.cancel()
+
+        launch()
+        delay = self.hedge_delay()
+        started = time.perf_counter()
+        try:
+            while True:
+                timeout = None
+                if winner is None and hedges < self.hedging.max_hedges and len(tasks) < len(candidates):
+                    timeout = max(0.0, started + delay - time.perf_counter())
+                try:
+                    kind, index, value = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    # 主提供商迟迟没有首token，发出对冲请求
+                    hedges += 1
+                    self.stats["hedged"] += 1
+                    launch()
+                    started = time.perf_counter()
+                    continue
+
+                if winner is None:
+                    if kind == "error":
+                        print(f"{candidates[index]._llm_type}调用失败: {str(value)}")
+                        running = [task for task in tasks.values() if not task.done()]
+                        if self.hedging.failover and launch():
+                            self.stats["failovers"] += 1
+                            started = time.perf_counter()
+                        elif not running:
+                            self.stats["failed"] += 1
+                            raise value
+                        continue
+                    # 首个产出内容（或正常结束）的流胜出，其余请求取消
+                    winner = index
+                    cancel_others(winner)
+                    self.stats["primary_wins" if winner == 0 else "backup_wins"] += 1
+                    if winner:
+                        print(f"对冲请求由{candidates[winner]._llm_type}胜出")
+
+                if index != winner:
+                    continue
+                if kind == "token":
+                    yield value
+                elif kind == "done":
+                    return
+                else:
+                    raise value
+        finally:
+            for task in tasks.values():
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取对冲统计"""
+        return {
+            **self._identifying_params,
+            "hedge_delay": round(self.hedge_delay(), 3),
+            **self.stats
+        }
@@ -0,0 +1,154 @@
+"""
+LLM提供商HTTP连接池
+
+为每个提供商维护一个长生命周期的aiohttp.ClientSession，由FastAPI的lifespan
+统一创建和关闭，所有提供商类（OllamaLLM、DeepSeekLLM、OpenAILLM、OpenRouterLLM
+以及OllamaService）共享，避免每次调用都重新建立连接池、DNS解析和TLS握手。
+"""
+import asyncio
+from typing import Dict, Any, Optional, Iterable, Tuple
+import aiohttp
+from pydantic import BaseModel, Field
+
+
+class HTTPPoolConfig(BaseModel):
+    """连接池配置"""
+    limit: int = Field(default=100, ge=0)  # 每个提供商的总连接数上限，0表示不限
+    limit_per_host: int = Field(default=16, ge=0)  # 每个主机的连接数上限
+    keepalive_timeout: float = Field(default=60.0, gt=0)  # 空闲连接保活时间（秒）
+    dns_cache_ttl: int = Field(default=300, ge=0)  # DNS缓存时间（秒）
+    prewarm: bool = True  # 启动时是否预热连接
+    prewarm_connections: int = Field(default=2, ge=1)  # 每个提供商预热的连接数
+    prewarm_timeout: float = Field(default=5.0, gt=0)  # 预热超时时间（秒）
+
+
+class ProviderSessionPool:
+    """按提供商划分的共享会话池"""
+
+    def __init__(self, config: Optional[HTTPPoolConfig] = None):
+        self.config = config or HTTPPoolConfig()
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        self._loops: Dict[str, asyncio.AbstractEventLoop] = {}
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    def configure(self, config: Optional[Dict[str, Any]] = None) -> None:
+        """根据用户设置更新连接池配置（仅影响之后新建的会话）"""
+        self.config = HTTPPoolConfig(**(config or {}))
+
+    def _new_stats(self) -> Dict[str, int]:
+        return {
+            "requests": 0,
+            "connections_opened": 0,
+            "connections_reused": 0,
+            "dns_cache_hits": 0,
+            "dns_cache_misses": 0
+        }
+
+    def _create_trace_config(self, provider: str) -> aiohttp.TraceConfig:
+        """创建用于统计连接复用情况的追踪配置"""
+        stats = self._stats.setdefault(provider, self._new_stats())
+
+        def counter(key: str):
+            async def handler(session, context, params):
+                stats[key] += 1
+            return handler
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(counter("requests"))
+        trace_config.on_connection_create_end.append(counter("connections_opened"))
+        trace_config.on_connection_reuseconn.append(counter("connections_reused"))
+        trace_config.on_dns_cache_hit.append(counter("dns_cache_hits"))
+        trace_config.on_dns_cache_miss.append(counter("dns_cache_misses"))
+        return trace_config
+
+    def _create_session(self, provider: str) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=self.config.limit,
+            limit_per_host=self.config.limit_per_host,
+            keepalive_timeout=self.config.keepalive_timeout,
+            use_dns_cache=self.config.dns_cache_ttl > 0,
+            ttl_dns_cache=self.config.dns_cache_ttl or None
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            trace_configs=[self._create_trace_config(provider)]
+        )
+
+    def get_session(self, provider: str) -> aiohttp.ClientSession:
+        """获取提供商的共享会话，不存在时按需创建
+
+        会话与创建它的事件循环绑定，如果当前运行的事件循环已变化
+        （例如脚本中多次调用asyncio.run），则为当前循环重新创建会话。
+        """
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(provider)
+        if session is None or session.closed or self._loops.get(provider) is not loop:
+            session = self._create_session(provider)
+            self._sessions[provider] = session
+            self._loops[provider] = loop
+        return session
+
+    async def prewarm(self, provider: str, url: str) -> int:
+        """预先建立到提供商的连接，返回成功预热的连接数"""
+        session = self.get_session(provider)
+
+        async def open_connection() -> bool:
+            try:
+                async with session.get(url) as response:
+                    await response.read()
+                    return True
+            except Exception as e:
+                print(f"预热 {provider} 连接失败: {str(e)}")
+                return False
+
+        results = await asyncio.gather(*[
+            open_connection() for _ in range(self.config.prewarm_connections)
+        ])
+        return sum(1 for ok in results if ok)
+
+    async def prewarm_all(self, targets: Iterable[Tuple[str, str]]) -> Dict[str, int]:
+        """并发预热多个提供商，受prewarm_timeout限制"""
+        targets = list(targets)
+        if not targets:
+            return {}
+        try:
+            counts = await asyncio.wait_for(
+                asyncio.gather(*[self.prewarm(provider, url) for provider, url in targets]),
+                timeout=self.config.prewarm_timeout
+            )
+        except asyncio.TimeoutError:
+            print(f"连接预热超时（{self.config.prewarm_timeout}s），跳过剩余预热")
+            return {}
+        return {provider: count for (provider, _), count in zip(targets, counts)}
+
+    async def close(self) -> None:
+        """关闭所有会话"""
+        sessions = list(self._sessions.values())
+        self._sessions.clear()
+        self._loops.clear()
+        for session in sessions:
+            if not session.closed:
+                await session.close()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取各提供商连接池的统计信息"""
+        stats = {}
+        for provider, values in self._stats.items():
+            session = self._sessions.get(provider)
+            connections = values["connections_opened"] + values["connections_reused"]
+            stats[provider] = {
+                **values,
+                "reuse_ratio": (
+                    round(values["connections_reused"] / connections, 4)
+                    if connections else 0.0
+                ),
+                "active": session is not None and not session.closed
+            }
+        return {
+            "config": self.config.dict(),
+            "providers": stats
+        }
+
+
+# 全局连接池实例
+http_pool = ProviderSessionPool()
@@ -24,8 +24,13 @@ from .llm_providers import (
     OpenAILLM,
     OpenRouterLLM
 )
-from .llm_providers import api_config, get_provider_config, get_user_settings
+from .llm_providers import api_config, get_provider_config, get_user_settings, get_settings_section
 import os,sys
+import time
+from .metrics import tutorial_stage_duration
+from .tools.ollama_session import ollama_sessions
+from .cancellation import cancellation
+from .llm_registry import llm_registry
 
 # 默认配置
 DEFAULT_PROVIDER = api_config.default_provider
@@ -74,6 +79,32 @@ def create_llm(provider: str = None, **kwargs) -> LLM:
         raise ValueError(f"不支持的LLM提供商: {provider}")
 
 
+def create_hedged_llm(primary: Optional[LLM] = None) -> LLM:
+    """创建带对冲请求和故障转移的LLM，没有可用的备用提供商时直接返回主LLM"""
+    from .hedged_llm import HedgedLLM, HedgingConfig
+
+    config = HedgingConfig(**get_settings_section("hedging"))
+    primary = primary or create_llm()
+    if not config.enabled:
+        return primary
+    settings = get_user_settings()
+    providers = config.providers or [
+        name for name in ["deepseek", "openai", "openrouter"]
+        if (settings.get(name) or {}).get("api_key")
+    ]
+    backups = []
+    for provider in providers:
+        if provider == primary._llm_type:
+            continue
+        try:
+            backups.append(create_llm(provider))
+        except ValueError as e:
+            print(f"创建备用提供商 {provider} 失败: {str(e)}")
+    if not backups:
+        return primary
+    return HedgedLLM(primary=primary, backups=backups, hedging=config)
+
+
 
 
 class ContentGenerator:
@@ -108,11 +139,16 @@ class ContentGenerator:
         self.session_states = {}
 
     def stop_generation(self, session_id: str) -> bool:
-        """停止指定会话的生成过程"""
+        """停止指定会话的生成过程
+
+        流式接口中的生成任务被直接取消，上游请求立即关闭；
+        非流式调用仍由生成循环在两个chunk之间检查会话状态。
+        """
+        cancelled = cancellation.cancel(session_id)
         if session_id in self.session_states:
             self.session_states[session_id] = False
             return True
-        return False
+        return cancelled
 
     def format_json_to_text(self, data: dict) -> str:
         """将JSON数据转换为自然语言描述"""
@@ -233,17 +269,22 @@ class ContentGenerator:
         tutorial_data: Optional[dict] = None,
         use_web_search: bool = False,
     ) -> AsyncGenerator[str, None]:
-        """处理用户消息并生成内容"""
-        # 使用当前加载的模型配置
-        current_model = api_config.get_model_name()
-        if current_model:
-            self.llm.config.model_name = current_model
-            print(f"使用模型: {current_model}")
+        """处理用户消息并生成内容
+
+        model为请求指定的模型（见llm_registry），各阶段从LLM实例池取用对应的实例，
+        未指定时按任务路由或使用默认提供商当前配置的模型。
+        """
+        outline_llm = llm_registry.get(model, task="main_outline")
+        chapter_llm = llm_registry.get(model, task="chapter_outline")
+        section_llm = llm_registry.get(model, task="section")
+        print(f"使用模型: {outline_llm._llm_type}/{outline_llm.config.model_name}")
 
         print(f"开始处理会话 {session_id} 的消息")
         
         # 初始化会话状态
         self.session_states[session_id] = True
+        # 同一教程的多次生成共用提示词前缀，统计复用KV缓存节省的预填充
+        prefix_session = ollama_sessions.begin(session_id)
 
         # 开始渐进式生成
         try:
@@ -278,7 +319,8 @@ class ContentGenerator:
                             "message": "已获取网络参考信息"
                         }
                 
-                async for data in generate_main_outline(message, self.llm, web_context=web_context):
+                stage_start = time.perf_counter()
+                async for data in generate_main_outline(message, outline_llm, web_context=web_context):
                     # 检查是否需要停止生成
                     if not self.session_states.get(session_id, True):
                         yield {
@@ -313,6 +355,8 @@ class ContentGenerator:
                                     }
                                 }
 
+                tutorial_stage_duration.observe(time.perf_counter() - stage_start, stage="chapters")
+
                 if not chapters:
                     yield {
                         "type": "error",
@@ -381,7 +425,8 @@ class ContentGenerator:
                                     "message": "已获取网络参考信息"
                                 }
 
-                        async for data in generate_chapter_outline(message, chapter, self.llm, context=context_text, web_context=chapter_web_context):
+                        stage_start = time.perf_counter()
+                        async for data in generate_chapter_outline(message, chapter, chapter_llm, context=context_text, web_context=chapter_web_context):
                             # 检查是否需要停止生成
                             if not self.session_states.get(session_id, True):
                                 yield {
@@ -418,6 +463,7 @@ class ContentGenerator:
                                                 "description": section.description
                                             }
                                         }
+                        tutorial_stage_duration.observe(time.perf_counter() - stage_start, stage="sections")
 
             # 3. 生成详细内容
             print("\n开始生成详细内容...")
@@ -451,7 +497,8 @@ class ContentGenerator:
                                     "message": "已获取网络参考信息"
                                 }
 
-                        async for data in generate_section_content(message, section, self.llm, context=context_text, web_context=section_web_context):
+                        stage_start = time.perf_counter()
+                        async for data in generate_section_content(message, section, section_llm, context=context_text, web_context=section_web_context):
                             # 检查是否需要停止生成
                             if not self.session_states.get(session_id, True):
                                 yield {
@@ -480,6 +527,7 @@ class ContentGenerator:
                                             "content": full_content
                                         }
                                     }
+                        tutorial_stage_duration.observe(time.perf_counter() - stage_start, stage="content")
                     content_count += 1
 
             yield {
@@ -511,6 +559,8 @@ class ContentGenerator:
                 "type": "error",
                 "message": f"生成过程出错: {error} ({location})"
             }
+        finally:
+            ollama_sessions.end(prefix_session)
 
 
 # 创建代理实例
@@ -0,0 +1,49 @@
+"""
+LLM调用延迟统计
+
+记录每个提供商/模型最近的首token延迟（TTFT），供对冲请求计算触发阈值。
+"""
+from collections import deque
+from typing import Deque, Dict, Any, Optional, Tuple
+
+
+class LatencyTracker:
+    """按提供商和模型保存最近的延迟样本"""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples: Dict[Tuple[str, str], Deque[float]] = {}
+
+    def record(self, provider: str, model: str, seconds: float) -> None:
+        key = (provider, model)
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = deque(maxlen=self.window)
+            self._samples[key] = samples
+        samples.append(seconds)
+
+    def count(self, provider: str, model: str) -> int:
+        return len(self._samples.get((provider, model), ()))
+
+    def percentile(self, provider: str, model: str, q: float) -> Optional[float]:
+        """获取分位数，没有样本时返回None"""
+        samples = self._samples.get((provider, model))
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))
+        return ordered[index]
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            f"{provider}/{model}": {
+                "samples": len(samples),
+                "p50": round(self.percentile(provider, model, 0.5), 3),
+                "p95": round(self.percentile(provider, model, 0.95), 3)
+            }
+            for (provider, model), samples in self._samples.items() if samples
+        }
+
+
+# 首token延迟统计
+ttft_tracker = LatencyTracker()
@@ -1,4 +1,4 @@
-from typing import Dict, Any, Optional, AsyncGenerator
+from typing import Dict, Any, Mapping, Optional, AsyncGenerator
 import json
 import aiohttp
 import os
@@ -6,26 +6,54 @@ from langchain.llms.base import LLM
 from pydantic import Field, BaseModel
 from pydantic_settings import BaseSettings
 import sys
-def get_user_settings() -> dict:
-    """获取用户设置"""
-    settings_path = "settings/user_settings.json"
+import asyncio
+from .http_pool import http_pool
+from .admission import admission_controller
+from .stream_decoder import SSEDecoder, iter_stream_tokens
+from .rate_limiter import rate_limiter, RateReservation
+from .tokens import estimate_tokens
+from .latency import ttft_tracker
+from .response_cache import response_cache
+from .metrics import LLMCallMetrics, llm_active_streams, llm_retries
+from .errors import CircuitOpen, ProviderAPIError, ProviderRateLimited, RateLimited
+from .structured_output import structured_output, MODE_SCHEMA, MODE_JSON_OBJECT
+from .generation_profiles import generation_profiles, GenerationProfile
+from .settings_store import settings_store, freeze
+from .reasoning_filter import reasoning_manager
+from .circuit_breaker import circuit_breakers
+from .adaptive_concurrency import adaptive_concurrency
+def _load_global_settings() -> Mapping[str, Any]:
+    """读取用户设置中的global字段（内存快照，只读）"""
+    return settings_store.snapshot().global_settings()
+
+def _build_user_settings() -> Mapping[str, Any]:
+    global_settings = _load_global_settings()
+    # 从global字段中提取提供商配置
+    provider_settings = {}
+    for provider in ["ollama", "deepseek", "openai", "openrouter"]:
+        if provider in global_settings:
+            provider_settings[provider] = global_settings[provider]
+    # 添加default_provider
+    if "default_provider" in global_settings:
+        provider_settings["default_provider"] = global_settings["default_provider"]
+    return freeze(provider_settings)
+
+def get_user_settings() -> Mapping[str, Any]:
+    """获取用户设置（只读，按设置快照版本缓存）"""
     try:
-        with open(settings_path, "r", encoding="utf-8") as f:
-            settings = json.load(f)
-            global_settings = settings.get("global", {})
-            # 从global字段中提取提供商配置
-            provider_settings = {}
-            for provider in ["ollama", "deepseek", "openai", "openrouter"]:
-                if provider in global_settings:
-                    provider_settings[provider] = global_settings[provider]
-            # 添加default_provider
-            if "default_provider" in global_settings:
-                provider_settings["default_provider"] = global_settings["default_provider"]
-            return provider_settings
+        return settings_store.memoize("user_settings", _build_user_settings)
     except Exception as e:
         print(f"读取用户设置失败: {str(e)}")
         return {}
 
+def get_settings_section(section: str) -> Mapping[str, Any]:
+    """获取用户设置global字段下的指定配置段（如http_pool，只读）"""
+    try:
+        return settings_store.snapshot().section(section)
+    except Exception as e:
+        print(f"读取设置段 {section} 失败: {str(e)}")
+        return {}
+
 class BaseLLMConfig(BaseModel):
     """基础LLM配置"""
     base_url: str
@@ -46,6 +74,7 @@ class APIConfig(BaseSettings):
     # Ollama配置
     ollama: Dict[str, Any] = {
         "base_url": "http://localhost:11434",
+        "base_urls": [],
         "model_name": "deepseek-r1:8b",
         "temperature": 0.7,
         "max_tokens": 1024
@@ -66,8 +95,10 @@ class APIConfig(BaseSettings):
         
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        # 从用户设置中加载配置
-        settings = get_user_settings()
+        self.load_settings(get_user_settings())
+
+    def load_settings(self, settings: Mapping[str, Any]) -> None:
+        """从用户设置中加载配置"""
         if settings:
             # 更新默认提供商
             if "default_provider" in settings:
@@ -84,6 +115,7 @@ class APIConfig(BaseSettings):
                         # 确保ollama配置包含所有必要字段
                         self.ollama.update({
                             "base_url": config.get("base_url", self.ollama["base_url"]),
+                            "base_urls": list(config.get("base_urls", self.ollama["base_urls"])),
                             "model_name": config.get("model_name", self.ollama["model_name"]),
                             "temperature": config.get("temperature", self.ollama["temperature"]),
                             "max_tokens": config.get("max_tokens", self.ollama["max_tokens"])
@@ -115,12 +147,10 @@ def update_provider_config(provider: str, config: Dict[str, Any]) -> None:
     else:
         config['provider'] = provider  # Add provider field
         setattr(api_config, provider, LLMProviderConfig(**config))
+    # 运行时覆盖的配置需要重新派生
+    settings_store.forget(("provider_config", provider))
 
-def get_provider_config(provider: str) -> Dict[str, Any]:
-    """获取提供商配置"""
-    if provider not in ["ollama", "deepseek", "openai", "openrouter"]:
-        raise ValueError(f"不支持的LLM提供商: {provider}")
-    
+def _build_provider_config(provider: str) -> Optional[Mapping[str, Any]]:
     # 获取用户设置
     settings = get_user_settings()
     provider_settings = settings.get("providers", {})
@@ -130,15 +160,29 @@ def get_provider_config(provider: str) -> Dict[str, Any]:
         return provider_settings[provider]
     
     if provider == "ollama":
-        return api_config.ollama
+        return freeze(api_config.ollama)
     else:
         config = getattr(api_config, provider)
-        return config.dict() if config else None
+        return freeze(config.dict()) if config else None
+
+def get_provider_config(provider: str) -> Optional[Mapping[str, Any]]:
+    """获取提供商配置（只读，按设置快照版本缓存）"""
+    if provider not in ["ollama", "deepseek", "openai", "openrouter"]:
+        raise ValueError(f"不支持的LLM提供商: {provider}")
+    # 设置文件变化后先按新快照重新载入全局配置
+    settings_store.memoize("api_config", lambda: api_config.load_settings(get_user_settings()))
+    return settings_store.memoize(("provider_config", provider), lambda: _build_provider_config(provider))
 
 class BaseLLM(LLM):
     """基础LLM实现"""
     config: BaseLLMConfig
 
+    def __init__(self, **kwargs):
+        """用提供商配置（base_url、model_name、api_key等）初始化，不传时使用类上的默认配置"""
+        super().__init__()
+        if kwargs:
+            self.config = LLMProviderConfig(**{"provider": self._llm_type, **kwargs})
+
     @property
     def _llm_type(self) -> str:
         """返回LLM类型"""
@@ -159,54 +203,229 @@ class BaseLLM(LLM):
         prompt: str,
         **kwargs: Any
     ) -> AsyncGenerator[str, None]:
-        """调用API生成文本"""
-        async with aiohttp.ClientSession() as session:
-            # 根据不同提供商设置不同的API路径
-            if isinstance(self, OpenAILLM):
-                url = f"{self.config.base_url}/responses"
-            else:
-                url = f"{self.config.base_url}/chat/completions"
-                
-            headers = self._get_headers()
-            payload = self._get_payload(prompt)
-
-            async with session.post(
-                url,
-                json=payload,
-                headers=headers
-            ) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    raise ValueError(
-                        f"API错误 ({response.status}): {error_text}"
-                    )
-
-                async for line in response.content:
-                    if not line:
-                        continue
-                        
-                    text = line.decode('utf-8')
-                    if text.startswith('data: '):
-                        text = text[6:]
-                    if text == "[DONE]":
-                        break
-                        
-                    try:
-                        data = json.loads(text)
-                        if "error" in data:
-                            raise RuntimeError(data["error"])
-                            
-                        # 根据不同提供商处理不同的响应格式
-                        if isinstance(self, OpenAILLM):
-                            if "text" in data:
-                                yield data["text"]
-                        else:
-                            if "choices" in data and len(data["choices"]) > 0:
-                                content = data["choices"][0].get("delta", {}).get("content")
-                                if content:
-                                    yield content
-                    except json.JSONDecodeError:
-                        continue
+        """调用API生成文本
+
+        所有提供商共用的调用入口：先查响应缓存，未命中时通过准入控制
+        获取执行槽位（并发上限由自适应并发控制调整），再由各提供商的_stream发起实际的流式请求。提供商的熔断器打开时直接
+        拒绝（CircuitOpen），流式输出受首token和token间隔超时限制。
+        限流额度在获取执行槽位之前预约（_reserve），等待限流时不占槽位，也不计入超时和自适应并发的TTFT；
+        没有拿到响应流时退还预约。收到429时释放槽位，等待Retry-After后重新排队。
+        kwargs中的task为任务名，按该任务的生成参数限制输出长度和停止条件；
+        推理模型的<think>内容不输出，需要时通过on_reasoning回调单独接收。
+        """
+        metrics = LLMCallMetrics(self._llm_type, self.config.model_name)
+        task = kwargs.pop("task", None)
+        guard = generation_profiles.guard(task)
+        if guard is not None:
+            kwargs["generation"] = guard
+        reasoning = reasoning_manager.begin(
+            self._llm_type, self.config.model_name, task, kwargs.pop("on_reasoning", None)
+        )
+        if reasoning is not None:
+            kwargs["reasoning"] = reasoning
+        policy = response_cache.policy()
+        cache_key = None
+        if policy is not None:
+            key_kwargs = dict(kwargs)
+            if guard is not None:
+                key_kwargs["profile"] = guard.profile.dict()
+            if reasoning is not None:
+                key_kwargs["reasoning"] = {"keep": reasoning.keep, "think": reasoning.think}
+            cache_key = response_cache.make_key(self, prompt, key_kwargs)
+            entry = await response_cache.get(cache_key)
+            if entry is not None:
+                metrics.finish("cache_hit")
+                async for token in response_cache.replay(entry, policy):
+                    yield token
+                return
+
+        breaker = circuit_breakers.get(self._llm_type)
+        try:
+            breaker.allow(self.config.model_name)
+        except CircuitOpen as e:
+            metrics.finish("error", e)
+            raise
+        chunks = []
+        outcome, error = "error", None
+        reservation = None
+        try:
+            reservation = await self._reserve(prompt, **kwargs)
+            kwargs["rate_reservation"] = reservation
+            while True:
+                try:
+                    async with admission_controller.slot(self._llm_type, self.config.model_name):
+                        metrics.admitted()
+                        with llm_active_streams.labels(provider=self._llm_type, model=self.config.model_name).track():
+                            stream = circuit_breakers.deadlines(
+                                self._llm_type, self.config.model_name, self._stream(prompt, **kwargs)
+                            )
+                            visible = self._visible(stream, reasoning)
+                            try:
+                                async for token in visible:
+                                    if guard is not None:
+                                        token = guard.feed(token)
+                                        if not token and guard.stopped:
+                                            break
+                                    ttft = metrics.token(token)
+                                    if ttft is not None:
+                                        # 首token延迟包含排队时间，与调用方实际感受到的一致
+                                        ttft_tracker.record(self._llm_type, self.config.model_name, ttft)
+                                    chunks.append(token)
+                                    yield token
+                                    if guard is not None and guard.stopped:
+                                        break
+                            finally:
+                                # 满足停止条件时立即关闭响应，上游随连接断开停止生成
+                                await visible.aclose()
+                                await stream.aclose()
+                    break
+                except ProviderRateLimited as e:
+                    # 429时还没有产出token：释放槽位后等待Retry-After，再重新排队
+                    if reservation is None or not reservation.can_retry:
+                        print(f"{e.provider}/{e.model} 持续限流: {e.detail}")
+                        raise RateLimited(e.provider, e.model, e.retry_after) from e
+                    llm_retries.inc(operation="provider_request", error="RateLimited")
+                    print(f"{e.provider}/{e.model} 被限流，{e.retry_after:.1f}秒后重试（第{reservation.retries + 1}次）")
+                    await reservation.retry()
+            outcome = "success"
+        except (asyncio.CancelledError, GeneratorExit):
+            outcome = "cancelled"
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if reservation is not None:
+                reservation.release()
+            metrics.finish(outcome, error)
+            breaker.record(outcome, error)
+            adaptive_concurrency.observe(self._llm_type, self.config.model_name, metrics, outcome, error)
+            if guard is not None:
+                generation_profiles.record(guard, outcome)
+            if reasoning is not None:
+                reasoning_manager.finish(reasoning)
+        # 只有完整结束的流才写入缓存
+        if cache_key is not None and chunks:
+            await response_cache.put(cache_key, chunks)
+
+    @staticmethod
+    async def _visible(stream: AsyncGenerator[str, None], reasoning) -> AsyncGenerator[str, None]:
+        """去掉推理内容后的输出"""
+        async for token in stream:
+            if reasoning is not None:
+                token = reasoning.feed(token)
+            if token:
+                yield token
+        if reasoning is not None:
+            tail = reasoning.flush()
+            if tail:
+                yield tail
+
+    async def _reserve(self, prompt: str, **kwargs: Any) -> Optional[RateReservation]:
+        """在提供商/API Key的令牌桶上等待并预约额度（提示词和最大输出的token数）"""
+        generation = kwargs.get("generation")
+        profile = generation.profile if generation is not None else None
+        limiter = rate_limiter.get(self._llm_type, self.config.api_key)
+        max_tokens = profile.resolve_max_tokens(self.config.max_tokens) if profile else self.config.max_tokens
+        reserved = estimate_tokens(prompt) + max(max_tokens or 0, 0)
+        return await limiter.reserve(self.config.model_name, reserved)
+
+    async def _stream(
+        self,
+        prompt: str,
+        **kwargs: Any
+    ) -> AsyncGenerator[str, None]:
+        """发起OpenAI兼容的流式请求
+
+        使用_call预约的限流额度（kwargs中的rate_reservation），流结束后按实际用量结算；
+        收到429时抛出ProviderRateLimited，由_call释放执行槽位后重试（此时尚未产出任何token）。
+        """
+        session = http_pool.get_session(self._llm_type)
+        # 根据不同提供商设置不同的API路径
+        if isinstance(self, OpenAILLM):
+            url = f"{self.config.base_url}/responses"
+        else:
+            url = f"{self.config.base_url}/chat/completions"
+
+        headers = self._get_headers()
+        generation = kwargs.get("generation")
+        profile = generation.profile if generation is not None else None
+        payload = self._get_payload(prompt, kwargs.get("output_schema"), profile)
+        model = self.config.model_name
+        limiter = rate_limiter.get(self._llm_type, self.config.api_key)
+        reservation = kwargs.get("rate_reservation")
+
+        reasoning = kwargs.get("reasoning")
+        if reasoning is not None and reasoning.think is False and isinstance(self, OpenRouterLLM):
+            # 任务不需要思考时不返回推理token
+            payload["reasoning"] = {"exclude": True}
+
+        def extract_token(data: Dict[str, Any]) -> Optional[str]:
+            if generation is not None:
+                generation.observe(self._finish_reason(data))
+            if reasoning is not None:
+                reasoning.reasoning(self._extract_reasoning(data))
+            return self._extract_token(data)
+
+        if reservation is not None:
+            reservation.sent = True
+        async with session.post(
+            url,
+            json=payload,
+            headers=headers,
+            timeout=circuit_breakers.client_timeout(self._llm_type)
+        ) as response:
+            if response.status == 429:
+                error_text = await response.text()
+                raise ProviderRateLimited(self._llm_type, model, limiter.on_rate_limited(response.headers), error_text)
+            limiter.update_from_headers(response.headers)
+            if response.status != 200:
+                error_text = await response.text()
+                raise ProviderAPIError(response.status, error_text)
+
+            output_tokens = 0
+            try:
+                async for token in iter_stream_tokens(
+                    response.content,
+                    SSEDecoder(),
+                    extract_token
+                ):
+                    output_tokens += estimate_tokens(token)
+                    yield token
+            finally:
+                if reservation is not None:
+                    reservation.settle(estimate_tokens(prompt) + output_tokens)
+
+    def _extract_token(self, data: Dict[str, Any]) -> Optional[str]:
+        """从流式事件中提取文本"""
+        if "error" in data:
+            raise ProviderAPIError(None, str(data["error"]))
+        # 根据不同提供商处理不同的响应格式
+        if isinstance(self, OpenAILLM):
+            return data.get("text")
+        choices = data.get("choices")
+        if choices:
+            return choices[0].get("delta", {}).get("content")
+        return None
+
+    def _extract_reasoning(self, data: Dict[str, Any]) -> Optional[str]:
+        """提供商在单独字段中返回的推理内容（DeepSeek的reasoning_content、OpenRouter的reasoning）"""
+        choices = data.get("choices")
+        if not choices:
+            return None
+        delta = choices[0].get("delta") or {}
+        return delta.get("reasoning_content") or delta.get("reasoning")
+
+    def _finish_reason(self, data: Dict[str, Any]) -> Optional[str]:
+        """从流式事件中提取结束原因"""
+        if isinstance(self, OpenAILLM):
+            if data.get("type") == "response.incomplete":
+                return ((data.get("response") or {}).get("incomplete_details") or {}).get("reason")
+            return None
+        choices = data.get("choices")
+        if choices:
+            return choices[0].get("finish_reason")
+        return None
 
     def _get_headers(self) -> Dict[str, str]:
         """获取请求头"""
@@ -215,26 +434,47 @@ class BaseLLM(LLM):
             "Authorization": f"Bearer {self.config.api_key}"
         }
 
-    def _get_payload(self, prompt: str) -> Dict[str, Any]:
-        """获取请求负载"""
+    def _get_payload(
+        self,
+        prompt: str,
+        output_schema: Optional[Dict[str, Any]] = None,
+        profile: Optional[GenerationProfile] = None
+    ) -> Dict[str, Any]:
+        """获取请求负载，output_schema为{"name", "schema"}时请求结构化输出，profile为任务的生成参数"""
+        temperature = profile.resolve_temperature(self.config.temperature) if profile else self.config.temperature
+        max_tokens = profile.resolve_max_tokens(self.config.max_tokens) if profile else self.config.max_tokens
         # 根据不同提供商设置不同的请求格式
         if isinstance(self, OpenAILLM):
             payload = {
                 "model": self.config.model_name,
                 "input": prompt,
-                "temperature": self.config.temperature
+                "temperature": temperature
             }
         else:
             payload = {
                 "model": self.config.model_name,
                 "messages": [{"role": "user", "content": prompt}],
                 "stream": True,
-                "temperature": self.config.temperature
+                "temperature": temperature
             }
         
         # 只有当max_tokens不为-1时才添加该参数
-        if self.config.max_tokens != -1:
-            payload["max_tokens"] = self.config.max_tokens
+        if max_tokens != -1:
+            payload["max_tokens"] = max_tokens
+
+        if output_schema:
+            mode = structured_output.provider_mode(self._llm_type, self.config.model_name)
+            json_schema = {"name": output_schema["name"], "schema": output_schema["schema"], "strict": False}
+            if isinstance(self, OpenAILLM):
+                # Responses接口的结构化输出参数在text.format中
+                if mode == MODE_SCHEMA:
+                    payload["text"] = {"format": {"type": "json_schema", **json_schema}}
+                elif mode == MODE_JSON_OBJECT:
+                    payload["text"] = {"format": {"type": "json_object"}}
+            elif mode == MODE_SCHEMA:
+                payload["response_format"] = {"type": "json_schema", "json_schema": json_schema}
+            elif mode == MODE_JSON_OBJECT:
+                payload["response_format"] = {"type": "json_object"}
             
         return payload
 
@@ -0,0 +1,208 @@
+"""
+按模型复用的LLM实例池
+
+原来所有工具都绑定在启动时创建的langchain_agent.llm上，请求中的model字段被忽略，
+process_message还会按请求改写共享实例的config.model_name，多个用户同时请求时互相覆盖。
+LLM实例池：
+- 按（提供商, 模型, 选项）缓存LLM实例，首次使用时创建，之后复用；同一实例上绑定的工具
+  （ExerciseGenerator等）也一并缓存
+- 请求的model可以是"提供商::模型"（如deepseek::deepseek-chat、openrouter::openai/gpt-4o）、
+  只写提供商或只写模型名；只写模型名时，与某个提供商当前配置的模型相同则使用该提供商
+  （OpenRouter的模型ID本身带"/"，如deepseek/deepseek-r1-0528:free），否则兼容旧的
+  "提供商/模型"写法，再退回默认提供商。未指定时按routes中该任务的配置，再退回默认提供商
+  当前配置的模型，这样可以让快速的小工具用便宜的模型、教程生成用大模型
+- 提供商配置（地址、API密钥等）在设置中变化后，下次取用时重新创建实例
+- 实例数超过max_instances时淘汰最久未使用的
+配置在settings/user_settings.json的global.llm_registry中。
+"""
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+from pydantic import BaseModel, Field
+from .llm_providers import get_provider_config, get_user_settings
+from .settings_store import settings_store
+
+PROVIDERS = ("ollama", "deepseek", "openai", "openrouter")
+
+# 显式指定提供商的分隔符（"/"会出现在OpenRouter的模型ID中）
+PROVIDER_SEPARATOR = "::"
+
+# 表示"未指定模型"的取值（前端未设置时会把undefined拼进查询参数）
+UNSET_MODELS = ("", "default", "undefined", "null", "none")
+
+
+class LLMRegistryConfig(BaseModel):
+    """LLM实例池配置"""
+    enabled: bool = True  # 关闭后忽略请求中的模型，全部使用默认提供商的默认模型
+    max_instances: int = Field(default=16, ge=1)
+    routes: Dict[str, str] = {}  # 任务 -> 默认使用的模型，如{"concept_analyze": "deepseek::deepseek-chat"}
+
+
+@dataclass
+class LLMEntry:
+    """池中的一个LLM实例及绑定在其上的工具"""
+    provider: str
+    model: str
+    llm: Any
+    fingerprint: Any  # 创建时的提供商配置，变化后重新创建
+    hedged: bool = False
+    created_at: float = field(default_factory=time.time)
+    last_used: float = field(default_factory=time.time)
+    uses: int = 0
+    tools: Dict[Any, Any] = field(default_factory=dict)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "provider": self.provider,
+            "model": self.model,
+            "hedged": self.hedged,
+            "uses": self.uses,
+            "tools": sorted(getattr(factory, "__name__", str(factory)) for factory in self.tools),
+            "created_at": self.created_at,
+            "last_used": self.last_used
+        }
+
+
+def _is_unset(spec: Optional[str]) -> bool:
+    return spec is None or spec.strip().lower() in UNSET_MODELS
+
+
+class LLMRegistry:
+    """按（提供商, 模型, 选项）创建并复用LLM实例"""
+
+    def __init__(self, config: Optional[LLMRegistryConfig] = None):
+        self.config = config or LLMRegistryConfig()
+        self._entries: "OrderedDict[Hashable, LLMEntry]" = OrderedDict()
+        self.stats = {"hits": 0, "created": 0, "rebuilt": 0, "evicted": 0, "routed": 0}
+
+    def configure(self, config: Optional[Dict[str, Any]] = None) -> None:
+        self.config = LLMRegistryConfig(**(config or {}))
+        while len(self._entries) > self.config.max_instances:
+            self._evict()
+
+    def resolve(self, spec: Optional[str] = None, task: Optional[str] = None) -> Tuple[str, str]:
+        """把请求中的模型解析为（提供商, 模型名）"""
+        if not self.config.enabled:
+            spec = None
+        elif _is_unset(spec) and task and task in self.config.routes:
+            spec = self.config.routes[task]
+            self.stats["routed"] += 1
+        provider, model = None, None
+        if not _is_unset(spec):
+            provider, model = self._split(spec.strip())
+        provider = provider or get_user_settings().get("default_provider", "ollama")
+        if not model:
+            config = get_provider_config(provider)
+            model = (config or {}).get("model_name")
+            if not model:
+                raise ValueError(f"{provider}未配置默认模型")
+        return provider, model
+
+    @staticmethod
+    def _split(spec: str) -> Tuple[Optional[str], Optional[str]]:
+        """把非空的模型字符串拆为（提供商, 模型名），未写出的部分为None"""
+        head, separator, rest = spec.partition(PROVIDER_SEPARATOR)
+        if separator:
+            if head not in PROVIDERS:
+                raise ValueError(f"不支持的LLM提供商: {head}")
+            return head, rest.strip() or None
+        if spec in PROVIDERS:
+            return spec, None
+        default = get_user_settings().get("default_provider", "ollama")
+        # 与提供商当前配置的模型相同时使用该提供商，默认提供商优先
+        for provider in (default, *PROVIDERS):
+            if provider in PROVIDERS and (get_provider_config(provider) or {}).get("model_name") == spec:
+                return provider, spec
+        head, _, rest = spec.partition("/")
+        if head in PROVIDERS and rest and default != "openrouter":
+            # 旧的"提供商/模型"写法；默认提供商是OpenRouter时带"/"的都是它的模型ID
+            return head, rest
+        return None, spec
+
+    def _fingerprint(self, provider: str, hedged: bool) -> Any:
+        config = get_provider_config(provider)
+        if hedged:
+            # 备用提供商取自对冲配置和其他提供商的配置，设置变化后一律重新创建
+            return config, settings_store.snapshot().version
+        return config
+
+    def _evict(self) -> None:
+        _, entry = self._entries.popitem(last=False)
+        self.stats["evicted"] += 1
+        print(f"LLM实例池已满，淘汰 {entry.provider}/{entry.model}")
+
+    def entry(
+        self,
+        spec: Optional[str] = None,
+        task: Optional[str] = None,
+        hedged: bool = False,
+        **options: Any
+    ) -> LLMEntry:
+        """取出（必要时创建）对应的池中实例，options为覆盖提供商配置的参数（如temperature）"""
+        provider, model = self.resolve(spec, task)
+        key = (provider, model, hedged, tuple(sorted(options.items())))
+        fingerprint = self._fingerprint(provider, hedged)
+        entry = self._entries.get(key)
+        if entry is not None and entry.fingerprint != fingerprint:
+            print(f"{provider}的配置已变化，重新创建 {provider}/{model}")
+            del self._entries[key]
+            entry = None
+            self.stats["rebuilt"] += 1
+        if entry is None:
+            entry = LLMEntry(provider, model, self._create(provider, model, hedged, options), fingerprint, hedged)
+            self._entries[key] = entry
+            self.stats["created"] += 1
+            while len(self._entries) > self.config.max_instances:
+                self._evict()
+        else:
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+        entry.uses += 1
+        entry.last_used = time.time()
+        return entry
+
+    def _create(self, provider: str, model: str, hedged: bool, options: Dict[str, Any]):
+        # 延迟导入，避免与langchain_agent循环导入
+        from .langchain_agent import create_llm, create_hedged_llm
+
+        llm = create_llm(provider, **{**options, "model_name": model})
+        return create_hedged_llm(llm) if hedged else llm
+
+    def get(self, spec: Optional[str] = None, task: Optional[str] = None, hedged: bool = False, **options: Any):
+        """取出对应模型的LLM实例"""
+        return self.entry(spec, task, hedged, **options).llm
+
+    def tool(
+        self,
+        factory: Callable[[Any], Any],
+        spec: Optional[str] = None,
+        task: Optional[str] = None,
+        hedged: bool = False
+    ):
+        """取出绑定在对应模型LLM实例上的工具（factory(llm)只在首次使用时调用）"""
+        entry = self.entry(spec, task, hedged)
+        if factory not in entry.tools:
+            entry.tools[factory] = factory(entry.llm)
+        return entry.tools[factory]
+
+    def hedging_stats(self) -> Dict[str, Any]:
+        """池中对冲实例的统计"""
+        return {
+            f"{entry.provider}/{entry.model}": entry.llm.get_stats()
+            for entry in self._entries.values()
+            if entry.hedged and hasattr(entry.llm, "get_stats")
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "enabled": self.config.enabled,
+            "max_instances": self.config.max_instances,
+            "routes": dict(self.config.routes),
+            "instances": [entry.summary() for entry in reversed(self._entries.values())]
+        }
+
+
+# 全局LLM实例池
+llm_registry = LLMRegistry()
@@ -0,0 +1,357 @@
+"""
+Prometheus格式的运行指标
+
+计数器、仪表和直方图都在进程内存中累加，由/metrics接口以Prometheus文本格式输出：
+- 每个标签组合对应一个子指标，首次使用时创建，之后直接在子指标上累加，不加锁
+  （更新都是简单的数值加法，依赖GIL，开销与一次字典查找相当）
+- 直方图的桶在创建时固定，观测值用二分查找落桶，输出时再累加成累计计数
+可以在生产环境中常开。
+"""
+import functools
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from .tokens import estimate_tokens
+
+# 常用的桶边界（秒）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 20.0, 30.0, 60.0)
+INTER_TOKEN_BUCKETS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+DURATION_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+STORAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+RATE_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+CANCEL_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SHARE_BUCKETS = (0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+BATCH_SIZE_BUCKETS = (1, 2, 3, 4, 6, 8, 12, 16)
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(pairs: Sequence[Tuple[str, Any]]) -> str:
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    """指标基类：按标签值保存子指标"""
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], Any] = {}
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, **labels: Any):
+        """获取某个标签组合的子指标"""
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            # setdefault是原子操作，并发创建时只会保留一个
+            child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        self.labels(**labels).inc(amount)
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(list(zip(self.labelnames, key)))} {_format_value(child.value)}"
+            for key, child in list(self._children.items())
+        ]
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    @contextmanager
+    def track(self):
+        """在代码块执行期间加一"""
+        self.value += 1
+        try:
+            yield
+        finally:
+            self.value -= 1
+
+
+class Gauge(Counter):
+    """可增可减的当前值"""
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # 最后一个是+Inf桶
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self):
+        """观测代码块的执行时间"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(_Metric):
+    """预先分桶的直方图"""
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float, **labels: Any) -> None:
+        self.labels(**labels).observe(value)
+
+    def time(self, **labels: Any):
+        return self.labels(**labels).time()
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, child in list(self._children.items()):
+            pairs = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), list(child.counts)):
+                cumulative += count
+                labels = _format_labels(pairs + [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(pairs)} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{_format_labels(pairs)} {child.count}")
+        return lines
+
+
+class MetricsRegistry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"指标已存在: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """输出Prometheus文本格式"""
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# 全局指标注册表
+metrics_registry = MetricsRegistry()
+
+llm_requests = metrics_registry.counter(
+    "llm_requests_total", "LLM调用次数", ("provider", "model", "outcome")
+)
+llm_errors = metrics_registry.counter(
+    "llm_errors_total", "LLM调用错误次数（按异常类型）", ("provider", "model", "error")
+)
+llm_retries = metrics_registry.counter(
+    "llm_retries_total", "重试次数（按操作和异常类型）", ("operation", "error")
+)
+llm_output_tokens = metrics_registry.counter(
+    "llm_output_tokens_total", "输出token数（估算）", ("provider", "model")
+)
+llm_prefill_tokens = metrics_registry.counter(
+    "llm_prefill_tokens_total", "教程生成中Ollama预填充的token数（evaluated为实际计算，reused为复用前缀省下）", ("kind",)
+)
+llm_active_streams = metrics_registry.gauge(
+    "llm_active_streams", "正在进行的LLM流", ("provider", "model")
+)
+llm_queue_wait = metrics_registry.histogram(
+    "llm_queue_wait_seconds", "准入控制排队时间", ("provider", "model"), LATENCY_BUCKETS
+)
+llm_ttft = metrics_registry.histogram(
+    "llm_time_to_first_token_seconds", "首token延迟（含排队）", ("provider", "model"), LATENCY_BUCKETS
+)
+llm_inter_token = metrics_registry.histogram(
+    "llm_inter_token_latency_seconds", "相邻token的间隔", ("provider", "model"), INTER_TOKEN_BUCKETS
+)
+llm_tokens_per_second = metrics_registry.histogram(
+    "llm_tokens_per_second", "首token之后的输出速度", ("provider", "model"), RATE_BUCKETS
+)
+llm_stream_duration = metrics_registry.histogram(
+    "llm_stream_duration_seconds", "一次LLM调用的总时长（含排队）", ("provider", "model"), DURATION_BUCKETS
+)
+llm_reasoning_tokens = metrics_registry.counter(
+    "llm_reasoning_tokens_total", "推理（思考）token数（估算）", ("provider", "model")
+)
+llm_reasoning_share = metrics_registry.histogram(
+    "llm_reasoning_share", "单次调用中推理token的占比", ("provider", "model"), SHARE_BUCKETS
+)
+generation_stops = metrics_registry.counter(
+    "llm_generation_stops_total", "按任务统计输出提前结束的次数（truncated为达到max_tokens）", ("task", "reason")
+)
+stream_cancellations = metrics_registry.counter(
+    "stream_cancellations_total", "流式生成被取消的次数", ("reason", "kind")
+)
+stream_cancel_latency = metrics_registry.histogram(
+    "stream_cancel_latency_seconds", "从发出取消到生成任务及上游连接结束的时间", ("reason",), CANCEL_BUCKETS
+)
+llm_timeouts = metrics_registry.counter(
+    "llm_timeouts_total", "LLM调用超时次数（connect/first_token/idle）", ("provider", "phase")
+)
+llm_circuit_state = metrics_registry.gauge(
+    "llm_circuit_state", "提供商熔断器状态（0关闭，1半开，2打开）", ("provider",)
+)
+llm_circuit_rejections = metrics_registry.counter(
+    "llm_circuit_rejections_total", "熔断器打开期间被直接拒绝的调用次数", ("provider",)
+)
+llm_concurrency_limit = metrics_registry.gauge(
+    "llm_concurrency_limit", "自适应并发控制当前的并发上限", ("gate",)
+)
+micro_batch_size = metrics_registry.histogram(
+    "micro_batch_size", "合并为一次LLM调用的请求数", ("group",), BATCH_SIZE_BUCKETS
+)
+micro_batch_calls_saved = metrics_registry.counter(
+    "micro_batch_calls_saved_total", "请求合并节省的LLM调用次数（已扣除拆分失败后单独调用的请求）", ("group",)
+)
+tutorial_stage_duration = metrics_registry.histogram(
+    "tutorial_stage_duration_seconds", "教程生成各阶段单次生成的耗时", ("stage",), DURATION_BUCKETS
+)
+storage_duration = metrics_registry.histogram(
+    "storage_operation_duration_seconds", "存档读写耗时", ("manager", "operation"), STORAGE_BUCKETS
+)
+
+
+class LLMCallMetrics:
+    """记录一次LLM流式调用的各项指标"""
+
+    def __init__(self, provider: str, model: str):
+        self.provider = provider
+        self.model = model
+        self.start = time.perf_counter()
+        self.admitted_at: Optional[float] = None
+        self.first: Optional[float] = None
+        self.last: Optional[float] = None
+        self.tokens = 0
+
+    def admitted(self) -> None:
+        """获得执行槽位（429后重新排队时更新时间点，排队时间只记录第一次）"""
+        first = self.admitted_at is None
+        self.admitted_at = time.perf_counter()
+        if first:
+            llm_queue_wait.observe(self.admitted_at - self.start, provider=self.provider, model=self.model)
+
+    def token(self, text: str) -> Optional[float]:
+        """收到一个token，首个token时返回首token延迟"""
+        now = time.perf_counter()
+        self.tokens += estimate_tokens(text)
+        previous, self.last = self.last, now
+        if previous is None:
+            self.first = now
+            ttft = now - self.start
+            llm_ttft.observe(ttft, provider=self.provider, model=self.model)
+            return ttft
+        llm_inter_token.observe(now - previous, provider=self.provider, model=self.model)
+        return None
+
+    def finish(self, outcome: str, error: Optional[BaseException] = None) -> None:
+        """调用结束：outcome为success、error、cancelled或cache_hit"""
+        labels = {"provider": self.provider, "model": self.model}
+        llm_requests.inc(outcome=outcome, **labels)
+        if error is not None:
+            llm_errors.inc(error=error.__class__.__name__, **labels)
+        if outcome == "cache_hit":
+            return
+        llm_stream_duration.observe(time.perf_counter() - self.start, **labels)
+        if self.tokens:
+            llm_output_tokens.inc(self.tokens, **labels)
+        if self.first is not None and self.last > self.first:
+            llm_tokens_per_second.observe(self.tokens / (self.last - self.first), **labels)
+
+
+def timed(histogram: Histogram, **labels: Any):
+    """函数装饰器：把每次调用的耗时记入直方图"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,231 @@
+"""
+小请求合并（prompt packing）
+
+知识图谱节点拓展、概念分析、少量练习题这类请求的提示词和输出都很短，单独调用时
+排队、预填充大段相同的格式要求、建立连接的开销占了大部分时间。合并调度：
+- 同一分组、同一LLM实例、格式要求相同的请求，在window秒内到达的合并为一批（最多max_batch个）
+- 一批只调用一次LLM：格式要求只出现一次，各请求的输入用<input id="N">标出，
+  要求模型把第N个子任务的输出放在<task id="N">...</task>中
+- 按标签拆分输出，交给各请求自己的解析器；某个子任务缺失或解析不出内容时，
+  该请求返回None，由调用方按原来的方式单独调用
+- 窗口内只有一个请求时同样返回None，直接单独调用
+统计合并批次、拆分失败次数和节省的调用次数（合并的请求数-1-拆分失败后单独调用的请求数）。
+配置在settings/user_settings.json的global.micro_batch中。
+"""
+import asyncio
+import re
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Hashable, List, Optional, Set
+from pydantic import BaseModel, Field
+from .metrics import micro_batch_size, micro_batch_calls_saved
+
+# 合并调用使用的任务名（对应generation_profiles中的生成参数）
+PACKED_TASK = "micro_batch"
+
+PACK_INSTRUCTION = """
+
+下面有{count}个相互独立的子任务，每个子任务都按上面的要求完成。
+第N个子任务的输出必须放在<task id="N">和</task>之间，按编号顺序依次输出，标签外不要输出其他内容。
+"""
+
+TASK_PATTERN = re.compile(r"<task\s+id\s*=\s*[\"']?(\d+)[\"']?\s*>(.*?)</task>", re.DOTALL)
+
+
+class MicroBatchGroup(BaseModel):
+    """单个分组的合并参数"""
+    enabled: bool = True
+    window: float = Field(default=0.03, ge=0)  # 第一个请求到达后等待其他请求的时间（秒）
+    max_batch: int = Field(default=4, ge=2)
+
+
+class MicroBatchConfig(BaseModel):
+    """小请求合并配置"""
+    enabled: bool = True
+    groups: Dict[str, MicroBatchGroup] = {
+        "knowledge_graph_expand": MicroBatchGroup(),
+        "concept_analyze": MicroBatchGroup(),
+        "exercises": MicroBatchGroup()
+    }
+
+
+@dataclass
+class PendingRequest:
+    item: str
+    parse: Callable[[str], Any]
+    future: asyncio.Future
+
+
+@dataclass
+class PendingBatch:
+    """窗口内收集到的一批请求"""
+    group: str
+    llm: Any
+    instructions: str
+    requests: List[PendingRequest] = field(default_factory=list)
+    timer: Optional[asyncio.TimerHandle] = None
+
+
+def pack_prompt(instructions: str, items: List[str]) -> str:
+    """把多个子任务合并为一个提示词"""
+    inputs = "\n\n".join(f'<input id="{index}">\n{item.strip()}\n</input>' for index, item in enumerate(items, 1))
+    return instructions.rstrip() + PACK_INSTRUCTION.format(count=len(items)) + "\n" + inputs + "\n"
+
+
+def split_outputs(text: str) -> Dict[int, str]:
+    """按<task id="N">标签拆分合并调用的输出"""
+    outputs: Dict[int, str] = {}
+    for match in TASK_PATTERN.finditer(text):
+        outputs.setdefault(int(match.group(1)), match.group(2).strip())
+    return outputs
+
+
+def _is_empty(result: Any) -> bool:
+    return result is None or (isinstance(result, (list, dict, str)) and not result)
+
+
+class MicroBatcher:
+    """按分组收集小请求并合并调用"""
+
+    def __init__(self, config: Optional[MicroBatchConfig] = None):
+        self.config = config or MicroBatchConfig()
+        self._pending: Dict[Hashable, PendingBatch] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    def configure(self, config: Optional[Dict[str, Any]] = None) -> None:
+        self.config = MicroBatchConfig(**(config or {}))
+
+    def _policy(self, group: str) -> Optional[MicroBatchGroup]:
+        if not self.config.enabled:
+            return None
+        policy = self.config.groups.get(group)
+        return policy if policy is not None and policy.enabled else None
+
+    def _stats(self, group: str) -> Dict[str, int]:
+        return self.stats.setdefault(group, {
+            "requests": 0,
+            "alone": 0,  # 窗口内没有其他请求，单独调用
+            "batches": 0,
+            "batched_requests": 0,
+            "fallbacks": 0,  # 拆分或解析失败后单独调用
+            "failed_batches": 0,  # 合并调用本身出错
+            "calls_saved": 0
+        })
+
+    async def submit(
+        self,
+        llm,
+        group: str,
+        instructions: str,
+        item: str,
+        parse: Callable[[str], Any]
+    ) -> Optional[Any]:
+        """提交一个小请求
+
+        instructions为可共用的格式要求，item为该请求自己的输入，parse解析该请求的输出。
+        返回解析结果；返回None表示没有合并（或合并后拆分失败），调用方应单独调用。
+        """
+        policy = self._policy(group)
+        if policy is None:
+            return None
+        self._stats(group)["requests"] += 1
+        loop = asyncio.get_running_loop()
+        key = (group, id(llm), instructions)
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = PendingBatch(group, llm, instructions)
+            self._pending[key] = batch
+            batch.timer = loop.call_later(policy.window, self._flush, key, batch)
+        request = PendingRequest(item, parse, loop.create_future())
+        batch.requests.append(request)
+        if len(batch.requests) >= policy.max_batch:
+            batch.timer.cancel()
+            self._flush(key, batch)
+        return await request.future
+
+    def _flush(self, key: Hashable, batch: PendingBatch) -> None:
+        """窗口结束或批次已满，发出合并调用"""
+        if self._pending.get(key) is batch:
+            del self._pending[key]
+        requests = [request for request in batch.requests if not request.future.done()]
+        if len(requests) < 2:
+            for request in requests:
+                self._stats(batch.group)["alone"] += 1
+                request.future.set_result(None)
+            return
+        batch.requests = requests
+        task = asyncio.create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: PendingBatch) -> None:
+        stats = self._stats(batch.group)
+        requests = batch.requests
+        stats["batches"] += 1
+        stats["batched_requests"] += len(requests)
+        micro_batch_size.observe(len(requests), group=batch.group)
+        try:
+            text = ""
+            calls = batch.llm._call(pack_prompt(batch.instructions, [request.item for request in requests]), task=PACKED_TASK)
+            try:
+                async for chunk in calls:
+                    text += chunk
+                    if all(request.future.done() for request in requests):
+                        # 等待结果的请求都已取消
+                        return
+            finally:
+                await calls.aclose()
+            self._demultiplex(batch, text)
+        except Exception as e:
+            stats["failed_batches"] += 1
+            print(f"合并调用失败（{batch.group}，{len(requests)}个请求），改为单独调用: {str(e)}")
+        finally:
+            # 出错或被取消时让等待的请求单独调用
+            for request in requests:
+                if not request.future.done():
+                    request.future.set_result(None)
+
+    def _demultiplex(self, batch: PendingBatch, text: str) -> None:
+        """拆分合并调用的输出并交给各请求"""
+        stats = self._stats(batch.group)
+        outputs = split_outputs(text)
+        fallbacks = 0
+        for index, request in enumerate(batch.requests, 1):
+            result = None
+            output = outputs.get(index)
+            if output:
+                try:
+                    result = request.parse(output)
+                except Exception as e:
+                    print(f"合并调用第{index}个子任务解析失败: {str(e)}")
+            if _is_empty(result):
+                result = None
+                fallbacks += 1
+            if not request.future.done():
+                request.future.set_result(result)
+        saved = len(batch.requests) - 1 - fallbacks
+        stats["fallbacks"] += fallbacks
+        stats["calls_saved"] += saved
+        if saved > 0:
+            micro_batch_calls_saved.inc(saved, group=batch.group)
+        if fallbacks:
+            print(f"合并调用（{batch.group}）有 {fallbacks}/{len(batch.requests)} 个子任务拆分失败，改为单独调用")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """各分组的合并批次、拆分失败次数和节省的调用次数"""
+        return {
+            "enabled": self.config.enabled,
+            "groups": {group: policy.dict() for group, policy in self.config.groups.items()},
+            "pending": sum(len(batch.requests) for batch in self._pending.values()),
+            "stats": {
+                group: {
+                    **stats,
+                    "average_batch_size": round(stats["batched_requests"] / stats["batches"], 2) if stats["batches"] else None
+                }
+                for group, stats in self.stats.items()
+            }
+        }
+
+
+# 全局小请求合并调度器
+micro_batcher = MicroBatcher()
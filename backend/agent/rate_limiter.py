@@ -0,0 +1,369 @@
+"""
+远程提供商客户端限流
+
+按提供商和API Key维护两个令牌桶：
+- 每分钟请求数（rpm）
+- 每分钟token数（tpm），发请求前按提示词和max_tokens预估，流结束后按实际输出修正
+请求前在令牌桶上平滑等待，而不是直接打到提供商再收到429。
+提供商返回的Retry-After和x-ratelimit-*响应头会动态修正令牌桶：
+剩余额度少于本地估计时以提供商为准，收到429时暂停到Retry-After之后。
+每次调用在获取执行槽位之前预约额度（RateReservation）：拿到200响应的流结束后按实际用量结算，
+没有拿到时（准入拒绝、熔断、超时、错误状态码）退还；429后的重试只等待请求桶，不重复预约token。
+限额配置在settings/user_settings.json中各提供商limits字段的rpm/tpm，0表示不限制。
+"""
+import asyncio
+import hashlib
+import re
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Any, Optional, Tuple
+from pydantic import BaseModel, Field
+from .errors import RateLimited
+
+
+class RateLimitConfig(BaseModel):
+    """限流配置"""
+    rpm: int = Field(default=0, ge=0)  # 每分钟请求数上限，0表示不限制
+    tpm: int = Field(default=0, ge=0)  # 每分钟token数上限，0表示不限制
+    max_wait: float = Field(default=60.0, gt=0)  # 最长等待时间（秒），超过则直接拒绝
+    max_retries: int = Field(default=3, ge=0)  # 收到429后的最大重试次数
+
+
+DEFAULT_RATE_LIMITS = {
+    # OpenRouter免费模型限制为每分钟20次请求
+    "openrouter": RateLimitConfig(rpm=20),
+}
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """解析限流响应头中的时长，支持"20"、"1.5s"、"6m0s"、"250ms"等格式（秒）"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析Retry-After（秒数或HTTP日期），返回需要等待的秒数"""
+    if not value:
+        return None
+    seconds = parse_duration(value)
+    if seconds is not None:
+        return seconds
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_reset(value: Optional[str]) -> Optional[float]:
+    """解析重置时间：时长，或Unix时间戳（秒/毫秒，OpenRouter使用毫秒）"""
+    if not value:
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        return parse_duration(value)
+    now = time.time()
+    if number > 1e12:
+        return max(0.0, number / 1000 - now)
+    if number > 1e9:
+        return max(0.0, number - now)
+    return max(0.0, number)
+
+
+class TokenBucket:
+    """令牌桶，容量为每分钟额度，匀速补充"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / 60.0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """获取amount个令牌还需要等待的时间"""
+        if not self.enabled:
+            return 0.0
+        self._refill()
+        # 超过桶容量的请求等桶满即可，否则永远无法放行
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float) -> None:
+        """扣除令牌，允许为负（实际用量超过预估时由后续请求偿还）；amount为负时退还，不超过容量"""
+        if not self.enabled:
+            return
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+    def set_capacity(self, per_minute: int) -> None:
+        if per_minute == self.capacity:
+            return
+        self._refill()
+        # 从不限制切换为限制时桶是满的
+        self.tokens = per_minute if not self.enabled else min(self.tokens, per_minute)
+        self.capacity = float(per_minute)
+
+    def sync(self, remaining: float, reset_seconds: Optional[float]) -> None:
+        """按提供商返回的剩余额度修正（只向下修正）"""
+        if not self.enabled:
+            return
+        self._refill()
+        if remaining >= self.tokens:
+            return
+        if reset_seconds:
+            # 提供商在reset_seconds后恢复满额，换算成本地补充速度下的等效余量
+            self.tokens = remaining - max(0.0, reset_seconds * self.rate - (self.capacity - remaining))
+        else:
+            self.tokens = remaining
+
+    def drain(self) -> None:
+        if self.enabled:
+            self._refill()
+            self.tokens = min(self.tokens, 0.0)
+
+
+class ProviderRateLimiter:
+    """单个提供商/API Key的限流器"""
+
+    def __init__(self, provider: str, key_id: str, config: RateLimitConfig):
+        self.provider = provider
+        self.key_id = key_id
+        self.config = config
+        self.requests = TokenBucket(config.rpm)
+        self.tokens = TokenBucket(config.tpm)
+        self.blocked_until = 0.0  # 收到429后暂停到的时间点（monotonic）
+        self._lock: Optional[asyncio.Lock] = None
+        self.stats = {
+            "requests": 0,
+            "throttled": 0,
+            "wait_total": 0.0,
+            "wait_max": 0.0,
+            "rejected": 0,
+            "rate_limited_responses": 0,
+            "retries": 0,
+            "estimated_tokens": 0,
+            "header_syncs": 0
+        }
+
+    def configure(self, config: RateLimitConfig) -> None:
+        self.config = config
+        self.requests.set_capacity(config.rpm)
+        self.tokens.set_capacity(config.tpm)
+
+    def _get_lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def _wait_time(self, tokens: int) -> float:
+        return max(
+            self.blocked_until - time.monotonic(),
+            self.requests.wait_time(1),
+            self.tokens.wait_time(tokens)
+        )
+
+    async def acquire(self, model: str, tokens: int) -> float:
+        """在令牌桶上等待直到可以发出请求，返回等待时间
+
+        持锁等待保证先来先服务：后到的请求不会插队抢走刚补充的令牌。
+        """
+        start = time.monotonic()
+        async with self._get_lock():
+            while True:
+                wait = self._wait_time(tokens)
+                if wait <= 0:
+                    break
+                if time.monotonic() - start + wait > self.config.max_wait:
+                    self.stats["rejected"] += 1
+                    raise RateLimited(self.provider, model, wait)
+                await asyncio.sleep(wait)
+            self.requests.consume(1)
+            self.tokens.consume(tokens)
+        waited = time.monotonic() - start
+        self.stats["requests"] += 1
+        self.stats["estimated_tokens"] += tokens
+        if waited > 0.001:
+            self.stats["throttled"] += 1
+            self.stats["wait_total"] += waited
+            self.stats["wait_max"] = max(self.stats["wait_max"], waited)
+        return waited
+
+    async def reserve(self, model: str, tokens: int) -> "RateReservation":
+        """等待并预约一次调用的额度"""
+        await self.acquire(model, tokens)
+        return RateReservation(self, model, tokens)
+
+    def record_usage(self, reserved: int, actual: int) -> None:
+        """流结束后按实际token数修正预估（多退少补）"""
+        self.tokens.consume(actual - reserved)
+        self.stats["estimated_tokens"] += actual - reserved
+
+    def update_from_headers(self, headers) -> None:
+        """根据x-ratelimit-*响应头修正令牌桶"""
+        synced = False
+        limit_requests = headers.get("x-ratelimit-limit-requests") or headers.get("x-ratelimit-limit")
+        limit_tokens = headers.get("x-ratelimit-limit-tokens")
+        # 本地未配置时采用提供商公布的额度
+        if limit_requests and not self.config.rpm and limit_requests.isdigit():
+            self.requests.set_capacity(int(limit_requests))
+        if limit_tokens and not self.config.tpm and limit_tokens.isdigit():
+            self.tokens.set_capacity(int(limit_tokens))
+
+        remaining_requests = headers.get("x-ratelimit-remaining-requests") or headers.get("x-ratelimit-remaining")
+        if remaining_requests is not None:
+            try:
+                reset = parse_reset(headers.get("x-ratelimit-reset-requests") or headers.get("x-ratelimit-reset"))
+                self.requests.sync(float(remaining_requests), reset)
+                synced = True
+            except ValueError:
+                pass
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_tokens is not None:
+            try:
+                self.tokens.sync(float(remaining_tokens), parse_reset(headers.get("x-ratelimit-reset-tokens")))
+                synced = True
+            except ValueError:
+                pass
+        if synced:
+            self.stats["header_syncs"] += 1
+
+    def on_rate_limited(self, headers) -> float:
+        """收到429：暂停到Retry-After之后，返回需要等待的秒数"""
+        self.stats["rate_limited_responses"] += 1
+        retry_after = parse_retry_after(headers.get("retry-after"))
+        if retry_after is None:
+            retry_after = parse_reset(
+                headers.get("x-ratelimit-reset-requests") or headers.get("x-ratelimit-reset")
+            )
+        if retry_after is None:
+            # 没有提示时按1分钟窗口的一小段退避
+            retry_after = 60.0 / max(self.requests.capacity, 10)
+        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+        self.requests.drain()
+        self.update_from_headers(headers)
+        return retry_after
+
+    def get_stats(self) -> Dict[str, Any]:
+        throttled = self.stats["throttled"]
+        return {
+            **self.stats,
+            "provider": self.provider,
+            "key": self.key_id,
+            "rpm": int(self.requests.capacity),
+            "tpm": int(self.tokens.capacity),
+            "requests_available": round(self.requests.tokens, 2) if self.requests.enabled else None,
+            "tokens_available": round(self.tokens.tokens, 1) if self.tokens.enabled else None,
+            "blocked_for": round(max(0.0, self.blocked_until - time.monotonic()), 2),
+            "wait_avg": round(self.stats["wait_total"] / throttled, 3) if throttled else 0.0
+        }
+
+
+class RateReservation:
+    """一次调用在令牌桶上预约的额度"""
+
+    def __init__(self, limiter: ProviderRateLimiter, model: str, tokens: int):
+        self.limiter = limiter
+        self.model = model
+        self.tokens = tokens
+        self.sent = False  # 请求是否已发出
+        self.retries = 0
+        self.settled = False
+
+    def settle(self, actual: int) -> None:
+        """流结束后按实际token数结算（只结算一次）"""
+        if self.settled:
+            return
+        self.settled = True
+        self.limiter.record_usage(self.tokens, actual)
+
+    def release(self) -> None:
+        """没有拿到响应流时退还预约的token；请求没有发出时连同请求数一起退还"""
+        if self.settled:
+            return
+        if not self.sent:
+            self.limiter.requests.consume(-1)
+        self.settle(0)
+
+    @property
+    def can_retry(self) -> bool:
+        return self.retries < self.limiter.config.max_retries
+
+    async def retry(self) -> None:
+        """收到429后等待Retry-After和请求桶（已预约的token不重复扣除）"""
+        self.retries += 1
+        self.limiter.stats["retries"] += 1
+        await self.limiter.acquire(self.model, 0)
+        self.sent = False
+
+
+class RateLimiterRegistry:
+    """按提供商和API Key管理限流器，所有调用点共用"""
+
+    def __init__(self):
+        self._limiters: Dict[Tuple[str, str], ProviderRateLimiter] = {}
+
+    @staticmethod
+    def _key_id(api_key: str) -> str:
+        """API Key只保存摘要，避免出现在统计接口中"""
+        if not api_key:
+            return "anonymous"
+        return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:8]
+
+    def _load_config(self, provider: str) -> RateLimitConfig:
+        """从提供商配置块的limits字段读取rpm/tpm"""
+        from .llm_providers import get_user_settings
+
+        values = DEFAULT_RATE_LIMITS.get(provider, RateLimitConfig()).dict()
+        limits = get_user_settings().get(provider, {}).get("limits") or {}
+        values.update({key: limits[key] for key in values if key in limits})
+        return RateLimitConfig(**values)
+
+    def get(self, provider: str, api_key: str) -> ProviderRateLimiter:
+        key = (provider, self._key_id(api_key))
+        limiter = self._limiters.get(key)
+        if limiter is None:
+            limiter = ProviderRateLimiter(provider, key[1], self._load_config(provider))
+            self._limiters[key] = limiter
+        return limiter
+
+    def reload(self) -> None:
+        """设置变化后重新读取限额"""
+        for (provider, _), limiter in self._limiters.items():
+            limiter.configure(self._load_config(provider))
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取各限流器的统计"""
+        return {
+            f"{provider}:{key_id}": limiter.get_stats()
+            for (provider, key_id), limiter in self._limiters.items()
+        }
+
+
+# 全局限流器实例
+rate_limiter = RateLimiterRegistry()
@@ -0,0 +1,226 @@
+"""
+推理（<think>）token的流式过滤
+
+deepseek-r1等推理模型先输出<think>...</think>包裹的思考过程再给出正文，这部分原来
+逐token作为chunk推给前端，又被拼进小节内容和各解析器的输入，占用带宽和后续提示词。
+在提供商层统一处理：
+- 流式切分正文和推理内容，标签跨token时先缓冲；默认丢弃推理内容（mode=keep时原样保留），
+  调用方可通过on_reasoning回调单独接收推理内容
+- 任务不需要思考时设置提供商参数：Ollama的think=false（旧版服务或不支持的模型报错时
+  记住该模型并去掉参数重试），OpenRouter的reasoning.exclude（不返回推理token）
+- 提供商在单独字段中返回的推理内容（reasoning_content、reasoning、thinking）同样计入统计
+- 每次调用统计推理token占比
+配置在settings/user_settings.json的global.reasoning中。
+"""
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
+from pydantic import BaseModel, Field
+from .metrics import llm_reasoning_tokens, llm_reasoning_share
+from .tokens import estimate_tokens
+
+OPEN_TAG = "<think>"
+CLOSE_TAG = "</think>"
+
+MODE_STRIP = "strip"
+MODE_KEEP = "keep"
+
+
+class ReasoningConfig(BaseModel):
+    """推理内容处理配置"""
+    enabled: bool = True
+    mode: str = Field(default=MODE_STRIP, pattern="^(strip|keep)$")
+    disable_thinking: bool = True  # 任务不需要思考时关闭提供商的思考
+    think_tasks: List[str] = []  # 保留思考的任务
+    history: int = Field(default=50, ge=0)  # 保留最近多少次调用的统计
+
+
+def _partial_suffix(text: str, tag: str) -> int:
+    """text末尾可能是tag开头部分的长度"""
+    for length in range(min(len(tag) - 1, len(text)), 0, -1):
+        if tag.startswith(text[-length:]):
+            return length
+    return 0
+
+
+class ReasoningFilter:
+    """一次调用中的推理内容切分与统计"""
+
+    def __init__(
+        self,
+        provider: str,
+        model: str,
+        task: Optional[str] = None,
+        think: Optional[bool] = None,
+        keep: bool = False,
+        on_reasoning: Optional[Callable[[str], Any]] = None
+    ):
+        self.provider = provider
+        self.model = model
+        self.task = task
+        self.think = think  # False表示请求提供商关闭思考，None表示不设置
+        self.keep = keep
+        self.on_reasoning = on_reasoning
+        self.inside = False
+        self.content_tokens = 0
+        self.reasoning_tokens = 0
+        self._pending = ""
+        self._strip_leading = False
+
+    def reasoning(self, text: str) -> None:
+        """记录推理内容（来自标签内或提供商的单独字段）"""
+        if not text:
+            return
+        self.reasoning_tokens += estimate_tokens(text)
+        if self.on_reasoning is not None:
+            self.on_reasoning(text)
+
+    def _content(self, text: str, out: List[str]) -> None:
+        if self._strip_leading:
+            # </think>之后通常跟着空行
+            text = text.lstrip()
+            if not text:
+                return
+            self._strip_leading = False
+        self.content_tokens += estimate_tokens(text)
+        out.append(text)
+
+    def feed(self, text: str) -> str:
+        """输入一段原始输出，返回其中应输出的部分"""
+        if not text:
+            return ""
+        text, self._pending = self._pending + text, ""
+        out: List[str] = []
+        while text:
+            tag = CLOSE_TAG if self.inside else OPEN_TAG
+            index = text.find(tag)
+            if index == -1 and not self.inside:
+                # 没有开始标签的残留结束标签直接去掉
+                index = text.find(CLOSE_TAG)
+                if index != -1:
+                    self._content(text[:index], out)
+                    text = text[index + len(CLOSE_TAG):]
+                    continue
+            if index == -1:
+                keep = max(_partial_suffix(text, tag), 0 if self.inside else _partial_suffix(text, CLOSE_TAG))
+                body, self._pending = text[:len(text) - keep], text[len(text) - keep:]
+                if self.inside:
+                    self.reasoning(body)
+                    if self.keep:
+                        out.append(body)
+                else:
+                    self._content(body, out)
+                break
+            if self.inside:
+                self.reasoning(text[:index])
+                if self.keep:
+                    out.append(text[:index + len(tag)])
+                self._strip_leading = not self.keep
+            else:
+                self._content(text[:index], out)
+                if self.keep:
+                    out.append(tag)
+            text = text[index + len(tag):]
+            self.inside = not self.inside
+        return "".join(out)
+
+    def flush(self) -> str:
+        """流结束时输出缓冲中的剩余部分"""
+        text, self._pending = self._pending, ""
+        if not text:
+            return ""
+        if self.inside:
+            self.reasoning(text)
+            return text if self.keep else ""
+        out: List[str] = []
+        self._content(text, out)
+        return "".join(out)
+
+    @property
+    def share(self) -> float:
+        total = self.content_tokens + self.reasoning_tokens
+        return self.reasoning_tokens / total if total else 0.0
+
+
+class ReasoningManager:
+    """推理内容处理配置、提供商参数与统计"""
+
+    def __init__(self, config: Optional[ReasoningConfig] = None):
+        self.config = config or ReasoningConfig()
+        self._think_unsupported: Set[Tuple[str, str]] = set()  # 不接受think参数的模型
+        self._recent: Deque[Dict[str, Any]] = deque(maxlen=self.config.history)
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    def configure(self, config: Optional[Dict[str, Any]] = None) -> None:
+        self.config = ReasoningConfig(**(config or {}))
+        self._recent = deque(self._recent, maxlen=self.config.history)
+
+    def begin(
+        self,
+        provider: str,
+        model: str,
+        task: Optional[str] = None,
+        on_reasoning: Optional[Callable[[str], Any]] = None
+    ) -> Optional[ReasoningFilter]:
+        """为一次调用创建过滤器，未启用时返回None"""
+        if not self.config.enabled:
+            return None
+        think = None
+        if self.config.disable_thinking and task is not None and task not in self.config.think_tasks:
+            think = False
+        return ReasoningFilter(
+            provider, model, task,
+            think=think,
+            keep=self.config.mode == MODE_KEEP,
+            on_reasoning=on_reasoning
+        )
+
+    def think_option(self, reasoning: Optional[ReasoningFilter]) -> Optional[bool]:
+        """Ollama的think参数，None表示不设置"""
+        if reasoning is None or reasoning.think is None:
+            return None
+        if (reasoning.provider, reasoning.model) in self._think_unsupported:
+            return None
+        return reasoning.think
+
+    def think_unsupported(self, provider: str, model: str, detail: str) -> None:
+        """提供商拒绝了think参数，之后不再为该模型设置"""
+        print(f"{provider}/{model} 不支持think参数，之后不再设置: {detail[:200]}")
+        self._think_unsupported.add((provider, model))
+
+    def finish(self, reasoning: ReasoningFilter) -> None:
+        """记录一次调用的推理token占比"""
+        key = f"{reasoning.provider}/{reasoning.model}"
+        stats = self.stats.setdefault(key, {"calls": 0, "reasoning_calls": 0, "content_tokens": 0, "reasoning_tokens": 0})
+        stats["calls"] += 1
+        stats["content_tokens"] += reasoning.content_tokens
+        stats["reasoning_tokens"] += reasoning.reasoning_tokens
+        labels = {"provider": reasoning.provider, "model": reasoning.model}
+        if reasoning.reasoning_tokens:
+            stats["reasoning_calls"] += 1
+            llm_reasoning_tokens.inc(reasoning.reasoning_tokens, **labels)
+        llm_reasoning_share.observe(reasoning.share, **labels)
+        self._recent.append({
+            "model": key,
+            "task": reasoning.task,
+            "content_tokens": reasoning.content_tokens,
+            "reasoning_tokens": reasoning.reasoning_tokens,
+            "reasoning_share": round(reasoning.share, 4)
+        })
+
+    def get_stats(self) -> Dict[str, Any]:
+        """各模型的推理token占比及最近的调用"""
+        models = {}
+        for key, stats in self.stats.items():
+            total = stats["content_tokens"] + stats["reasoning_tokens"]
+            models[key] = {**stats, "reasoning_share": round(stats["reasoning_tokens"] / total, 4) if total else 0.0}
+        return {
+            "enabled": self.config.enabled,
+            "mode": self.config.mode,
+            "think_unsupported": [f"{provider}/{model}" for provider, model in self._think_unsupported],
+            "models": models,
+            "recent": list(self._recent)
+        }
+
+
+# 全局推理内容管理器
+reasoning_manager = ReasoningManager()
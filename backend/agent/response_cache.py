@@ -0,0 +1,257 @@
+"""
+LLM响应缓存
+
+在llm._call层按（提供商、模型、temperature、max_tokens、提示词哈希）精确匹配缓存完整的生成结果：
+- 内存LRU层 + 磁盘层（按总大小淘汰最久未使用的条目，超过TTL的条目失效）
+- 命中时按原来的分块重新以异步token流输出（可按配置限速），SSE接口的行为与未命中时一致
+- 只缓存正常结束的流；出错或被取消的流不会写入
+- 按接口开启/关闭：接口通过cache_scope声明自己的名称，未声明的调用默认不缓存
+配置在settings/user_settings.json的global.response_cache中。
+"""
+import asyncio
+import contextvars
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, AsyncGenerator, Dict, List, Optional
+from pydantic import BaseModel, Field
+
+# 当前调用所属的接口名称
+_cache_scope: contextvars.ContextVar = contextvars.ContextVar("llm_cache_scope", default=None)
+
+
+class EndpointCachePolicy(BaseModel):
+    """单个接口的缓存策略"""
+    enabled: bool = True
+    replay_delay: float = Field(default=0.0, ge=0)  # 回放时每个分块之间的间隔（秒），0表示不限速
+
+
+class CacheConfig(BaseModel):
+    """响应缓存配置"""
+    enabled: bool = True
+    memory_entries: int = Field(default=256, ge=0)  # 内存层最多保存的条目数
+    disk_dir: str = "Saves/llm_cache"
+    max_disk_mb: float = Field(default=200.0, ge=0)  # 磁盘层总大小上限，0表示不使用磁盘层
+    ttl: float = Field(default=7 * 24 * 3600, gt=0)  # 条目有效期（秒）
+    default: EndpointCachePolicy = EndpointCachePolicy(enabled=False)  # 未声明接口的调用
+    endpoints: Dict[str, EndpointCachePolicy] = {
+        "concept_analyze": EndpointCachePolicy(),
+        "knowledge_graph_generate": EndpointCachePolicy(replay_delay=0.01),
+        "knowledge_graph_expand": EndpointCachePolicy(replay_delay=0.01),
+        "resources_search": EndpointCachePolicy(),
+        "simulation": EndpointCachePolicy(),
+        "exercises": EndpointCachePolicy(enabled=False),  # 练习题需要每次不同
+        "dialogue": EndpointCachePolicy(enabled=False)
+    }
+
+
+@contextmanager
+def cache_scope(endpoint: str):
+    """声明当前调用所属的接口，决定是否使用缓存"""
+    token = _cache_scope.set(endpoint)
+    try:
+        yield
+    finally:
+        _cache_scope.reset(token)
+
+
+class ResponseCache:
+    """两级LLM响应缓存"""
+
+    def __init__(self, config: Optional[CacheConfig] = None):
+        self.config = config or CacheConfig()
+        self._memory: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._disk_index: Optional["OrderedDict[str, int]"] = None  # key -> 文件大小，按最近使用排序
+        self._disk_bytes = 0
+        self._disk_lock = threading.RLock()  # 磁盘操作在线程池中执行
+        self.stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "expired": 0,
+            "evictions": 0
+        }
+        self.endpoint_stats: Dict[str, Dict[str, int]] = {}
+
+    def configure(self, config: Optional[Dict[str, Any]] = None) -> None:
+        self.config = CacheConfig(**(config or {}))
+        self._disk_index = None
+        while len(self._memory) > self.config.memory_entries:
+            self._memory.popitem(last=False)
+
+    def policy(self) -> Optional[EndpointCachePolicy]:
+        """当前调用的缓存策略，不使用缓存时返回None"""
+        if not self.config.enabled:
+            return None
+        endpoint = _cache_scope.get()
+        policy = self.config.endpoints.get(endpoint, self.config.default) if endpoint else self.config.default
+        return policy if policy.enabled else None
+
+    @staticmethod
+    def make_key(llm, prompt: str, kwargs: Dict[str, Any]) -> str:
+        """缓存键：提供商、模型、采样参数和提示词哈希"""
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        parts = {
+            "provider": llm._llm_type,
+            "model": llm.config.model_name,
+            "temperature": llm.config.temperature,
+            "max_tokens": llm.config.max_tokens,
+            "prompt": prompt_hash,
+            "kwargs": {k: v for k, v in sorted(kwargs.items()) if isinstance(v, (str, int, float, bool, list, dict))}
+        }
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _record(self, kind: str) -> None:
+        self.stats[kind] += 1
+        endpoint = _cache_scope.get() or "default"
+        stats = self.endpoint_stats.setdefault(endpoint, {"hits": 0, "misses": 0})
+        stats["misses" if kind == "misses" else "hits"] += 1
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.config.disk_dir, key[:2], f"{key}.json")
+
+    def _load_disk_index(self) -> "OrderedDict[str, int]":
+        """扫描缓存目录，按修改时间建立LRU索引"""
+        if self._disk_index is not None:
+            return self._disk_index
+        entries = []
+        if os.path.isdir(self.config.disk_dir):
+            for root, _, files in os.walk(self.config.disk_dir):
+                for name in files:
+                    if name.endswith(".json"):
+                        stat = os.stat(os.path.join(root, name))
+                        entries.append((stat.st_mtime, name[:-5], stat.st_size))
+        entries.sort()
+        self._disk_index = OrderedDict((key, size) for _, key, size in entries)
+        self._disk_bytes = sum(self._disk_index.values())
+        return self._disk_index
+
+    def _remove_disk(self, key: str) -> None:
+        with self._disk_lock:
+            index = self._load_disk_index()
+            self._disk_bytes -= index.pop(key, 0)
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def _read_disk(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._disk_lock:
+            index = self._load_disk_index()
+            if key not in index:
+                return None
+            try:
+                with open(self._path(key), "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+                os.utime(self._path(key))  # 更新修改时间，重启后仍按最近使用淘汰
+            except (OSError, ValueError):
+                self._remove_disk(key)
+                return None
+            index.move_to_end(key)
+            return entry
+
+    def _write_disk(self, key: str, entry: Dict[str, Any]) -> None:
+        data = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+        max_bytes = self.config.max_disk_mb * 1024 * 1024
+        if len(data) > max_bytes:
+            return
+        with self._disk_lock:
+            index = self._load_disk_index()
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self._disk_bytes += len(data) - index.pop(key, 0)
+            index[key] = len(data)
+            while self._disk_bytes > max_bytes and index:
+                oldest = next(iter(index))
+                self._remove_disk(oldest)
+                self.stats["evictions"] += 1
+
+    def _expired(self, entry: Dict[str, Any]) -> bool:
+        return time.time() - entry.get("created", 0) > self.config.ttl
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """查找缓存条目，依次查内存层和磁盘层"""
+        entry = self._memory.get(key)
+        if entry is not None:
+            if not self._expired(entry):
+                self._memory.move_to_end(key)
+                self._record("memory_hits")
+                return entry
+            self._memory.pop(key, None)
+            self.stats["expired"] += 1
+            await asyncio.to_thread(self._remove_disk, key)
+            entry = None
+        if self.config.max_disk_mb:
+            entry = await asyncio.to_thread(self._read_disk, key)
+            if entry is not None and self._expired(entry):
+                self.stats["expired"] += 1
+                await asyncio.to_thread(self._remove_disk, key)
+                entry = None
+            if entry is not None:
+                self._remember(key, entry)
+                self._record("disk_hits")
+                return entry
+        self._record("misses")
+        return None
+
+    def _remember(self, key: str, entry: Dict[str, Any]) -> None:
+        if not self.config.memory_entries:
+            return
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.config.memory_entries:
+            self._memory.popitem(last=False)
+
+    async def put(self, key: str, chunks: List[str], meta: Optional[Dict[str, Any]] = None) -> None:
+        """写入一次完整的生成结果"""
+        entry = {"created": time.time(), "chunks": chunks, **(meta or {})}
+        self._remember(key, entry)
+        self.stats["stores"] += 1
+        if self.config.max_disk_mb:
+            try:
+                await asyncio.to_thread(self._write_disk, key, entry)
+            except OSError as e:
+                print(f"写入响应缓存失败: {str(e)}")
+
+    async def replay(self, entry: Dict[str, Any], policy: EndpointCachePolicy) -> AsyncGenerator[str, None]:
+        """按原始分块回放缓存的生成结果"""
+        for chunk in entry["chunks"]:
+            if policy.replay_delay:
+                await asyncio.sleep(policy.replay_delay)
+            yield chunk
+
+    def clear(self) -> None:
+        """清空内存层和磁盘层"""
+        self._memory.clear()
+        for key in list(self._load_disk_index()):
+            self._remove_disk(key)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取命中率等统计"""
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        lookups = hits + self.stats["misses"]
+        endpoints = {}
+        for endpoint, stats in self.endpoint_stats.items():
+            total = stats["hits"] + stats["misses"]
+            endpoints[endpoint] = {**stats, "hit_rate": round(stats["hits"] / total, 4) if total else 0.0}
+        return {
+            **self.stats,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "memory_entries": len(self._memory),
+            "disk_entries": len(self._disk_index) if self._disk_index is not None else None,
+            "disk_bytes": self._disk_bytes if self._disk_index is not None else None,
+            "endpoints": endpoints
+        }
+
+
+# 全局响应缓存实例
+response_cache = ResponseCache()
@@ -0,0 +1,169 @@
+"""
+生成任务的重试策略
+
+替代内容生成中"失败就立即重来"的无限循环：
+- 指数退避加随机抖动，避免提供商故障时高速空转
+- 同时限制尝试次数和总耗时
+- 区分可重试错误（网络中断、超时、5xx/429、输出格式不对）和不可重试错误
+  （认证失败、参数错误、准入拒绝等），后者立即抛出
+- 流式输出中途断开时，把已输出的部分交给模型续写，而不是从头重新生成
+策略配置在settings/user_settings.json的global.retry_policy中。
+"""
+import asyncio
+import random
+import time
+from typing import Any, AsyncGenerator, Dict, Optional
+from pydantic import BaseModel, Field
+import aiohttp
+from .errors import AdmissionRejected, OutputParseError, ProviderAPIError, RetryExhausted
+from .metrics import llm_retries
+
+RETRYABLE = "retryable"
+FATAL = "fatal"
+
+# 临时性的HTTP状态码，其余4xx视为请求本身有问题
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+
+CONTINUATION_TEMPLATE = """{prompt}
+
+【已输出的部分】
+以下是你之前针对上述要求已经输出的内容，因网络中断而没有完成：
+{partial}
+
+请紧接着上面内容的最后一个字继续输出剩余部分，不要重复已输出的内容，不要添加任何说明。"""
+
+
+class RetryPolicyConfig(BaseModel):
+    """重试策略配置"""
+    max_attempts: int = Field(default=5, ge=1)  # 最大尝试次数（包括第一次）
+    base_delay: float = Field(default=1.0, ge=0)  # 首次重试的退避时间（秒）
+    max_delay: float = Field(default=30.0, ge=0)  # 单次退避上限（秒）
+    multiplier: float = Field(default=2.0, ge=1)  # 退避时间的增长倍数
+    jitter: float = Field(default=0.5, ge=0, le=1)  # 随机抖动比例，0表示不抖动
+    total_timeout: float = Field(default=600.0, gt=0)  # 单个生成任务的总时长预算（秒）
+    resume: bool = True  # 流式输出中断后是否从已输出内容续写
+
+
+def classify_error(error: BaseException) -> str:
+    """判断错误是否值得重试"""
+    if isinstance(error, (AdmissionRejected, RetryExhausted)):
+        return FATAL
+    if isinstance(error, ProviderAPIError):
+        if error.status is None or error.status in RETRYABLE_STATUS or error.status >= 500:
+            return RETRYABLE
+        return FATAL
+    if isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError, OutputParseError)):
+        return RETRYABLE
+    return FATAL
+
+
+def build_continuation_prompt(prompt: str, partial: str) -> str:
+    """构造续写提示词"""
+    return CONTINUATION_TEMPLATE.format(prompt=prompt, partial=partial)
+
+
+def trim_overlap(partial: str, text: str, min_overlap: int = 8) -> str:
+    """去掉续写开头与已输出内容结尾重复的部分"""
+    longest = min(len(partial), len(text))
+    for size in range(longest, min_overlap - 1, -1):
+        if partial.endswith(text[:size]):
+            return text[size:]
+    return text
+
+
+class RetryBudget:
+    """单个生成任务的重试预算"""
+
+    def __init__(self, operation: str, config: Optional[RetryPolicyConfig] = None):
+        self.operation = operation
+        self.config = config or retry_policy.config
+        self.started = time.monotonic()
+        self.attempts = 1
+
+    def next_delay(self) -> float:
+        """第n次重试前的退避时间"""
+        delay = min(
+            self.config.max_delay,
+            self.config.base_delay * self.config.multiplier ** (self.attempts - 1)
+        )
+        if self.config.jitter:
+            delay *= 1 - self.config.jitter * random.random()
+        return delay
+
+    async def backoff(self, error: BaseException) -> None:
+        """出错后退避等待；错误不可重试或预算耗尽时抛出"""
+        if classify_error(error) == FATAL:
+            retry_policy.stats["fatal"] += 1
+            raise error
+        delay = self.next_delay()
+        elapsed = time.monotonic() - self.started
+        if self.attempts >= self.config.max_attempts or elapsed + delay > self.config.total_timeout:
+            retry_policy.stats["exhausted"] += 1
+            raise RetryExhausted(self.operation, self.attempts, error) from error
+        print(
+            f"{self.operation}失败: {str(error) or error.__class__.__name__}，"
+            f"{delay:.1f}秒后进行第{self.attempts + 1}次尝试..."
+        )
+        retry_policy.stats["retries"] += 1
+        llm_retries.inc(operation=self.operation, error=error.__class__.__name__)
+        self.attempts += 1
+        await asyncio.sleep(delay)
+
+
+async def stream_with_resume(llm, prompt: str, budget: RetryBudget, **kwargs: Any) -> AsyncGenerator[str, None]:
+    """带重试的流式调用，中途断开时从已输出内容续写
+
+    产出的文本整体等价于一次完整的生成，调用方不会收到重复内容。
+    kwargs原样传给llm._call（如task）。
+    """
+    partial = ""
+    while True:
+        resuming = bool(partial)
+        call_prompt = build_continuation_prompt(prompt, partial) if resuming else prompt
+        # 续写开头先缓冲一小段，去掉与已输出内容重叠的部分
+        head = "" if resuming else None
+        try:
+            async for chunk in llm._call(call_prompt, **kwargs):
+                if not chunk:
+                    continue
+                if head is not None:
+                    head += chunk
+                    if len(head) < 64:
+                        continue
+                    chunk = trim_overlap(partial, head)
+                    head = None
+                partial += chunk
+                yield chunk
+            if head:
+                chunk = trim_overlap(partial, head)
+                partial += chunk
+                yield chunk
+            if resuming:
+                retry_policy.stats["resumed"] += 1
+            return
+        except Exception as e:
+            if partial and not budget.config.resume:
+                # 不续写时只能从头重来，但已输出的内容无法撤回
+                raise
+            await budget.backoff(e)
+
+
+class RetryPolicy:
+    """全局重试策略与统计"""
+
+    def __init__(self, config: Optional[RetryPolicyConfig] = None):
+        self.config = config or RetryPolicyConfig()
+        self.stats = {"retries": 0, "resumed": 0, "exhausted": 0, "fatal": 0}
+
+    def configure(self, config: Optional[Dict[str, Any]] = None) -> None:
+        self.config = RetryPolicyConfig(**(config or {}))
+
+    def budget(self, operation: str) -> RetryBudget:
+        return RetryBudget(operation, self.config)
+
+    def get_state(self) -> Dict[str, Any]:
+        return {"config": self.config.dict(), "stats": dict(self.stats)}
+
+
+# 全局重试策略实例
+retry_policy = RetryPolicy()
@@ -0,0 +1,153 @@
+"""
+进程内的设置缓存
+
+settings/user_settings.json原来在每次create_llm、get_provider_config、ContentGenerator
+初始化、模型列表和设置接口中都会重新打开并解析。设置存储：
+- 首次读取时加载一次，之后从内存返回不可变快照（dict转为只读映射，list转为tuple）
+- 通过SettingsManager写入时直接换成新快照；文件被外部修改时按修改时间和大小发现变化
+  （每次读取最多每check_interval秒检查一次文件状态）
+- 每个快照有递增的版本号，由设置派生的数据（如提供商配置）按版本缓存，设置变化后自动重新计算
+文件损坏或读取失败时继续使用上一个快照。
+"""
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Callable, Dict, Hashable, Mapping, Optional, Tuple
+
+SETTINGS_PATH = "settings/user_settings.json"
+
+
+def freeze(value: Any) -> Any:
+    """转为不可变结构"""
+    if isinstance(value, Mapping):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value: Any) -> Any:
+    """转回可修改的dict/list（深拷贝）"""
+    if isinstance(value, Mapping):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+
+@dataclass(frozen=True)
+class SettingsSnapshot:
+    """某一时刻的完整设置"""
+    version: int
+    data: Mapping[str, Any]
+    loaded_at: float
+
+    def global_settings(self) -> Mapping[str, Any]:
+        return self.data.get("global") or MappingProxyType({})
+
+    def section(self, name: str) -> Mapping[str, Any]:
+        """global下的配置段"""
+        return self.global_settings().get(name) or MappingProxyType({})
+
+    def thaw(self) -> Dict[str, Any]:
+        """可修改的完整设置副本"""
+        return thaw(self.data)
+
+
+class SettingsStore:
+    """设置文件的内存快照与派生数据缓存"""
+
+    def __init__(self, path: str = SETTINGS_PATH, check_interval: float = 1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._snapshot: Optional[SettingsSnapshot] = None
+        self._signature: Optional[Tuple[int, int]] = None
+        self._checked = 0.0
+        self._derived: Dict[Hashable, Any] = {}
+        self._derived_version = -1
+        self._lock = threading.Lock()
+        self.stats = {"reads": 0, "loads": 0, "external_changes": 0, "writes": 0, "load_errors": 0}
+
+    def _stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _install(self, data: Any) -> SettingsSnapshot:
+        version = self._snapshot.version + 1 if self._snapshot is not None else 1
+        self._snapshot = SettingsSnapshot(version=version, data=freeze(data), loaded_at=time.time())
+        return self._snapshot
+
+    def _load(self, signature: Optional[Tuple[int, int]]) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            self.stats["load_errors"] += 1
+            print(f"读取设置文件失败: {str(e)}")
+            if self._snapshot is None:
+                self._install({})
+            return
+        if self._snapshot is not None:
+            self.stats["external_changes"] += 1
+        self.stats["loads"] += 1
+        self._signature = signature
+        self._install(data)
+
+    def snapshot(self, refresh: bool = False) -> SettingsSnapshot:
+        """当前设置快照，refresh为True时立即检查文件是否变化"""
+        self.stats["reads"] += 1
+        now = time.monotonic()
+        if not refresh and self._snapshot is not None and now - self._checked < self.check_interval:
+            return self._snapshot
+        with self._lock:
+            self._checked = now
+            signature = self._stat()
+            if self._snapshot is None or signature != self._signature:
+                self._load(signature)
+            return self._snapshot
+
+    def save(self, data: Dict[str, Any]) -> SettingsSnapshot:
+        """写入设置文件并换成新快照"""
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            self.stats["writes"] += 1
+            self._signature = self._stat()
+            self._checked = time.monotonic()
+            return self._install(data)
+
+    def forget(self, key: Hashable) -> None:
+        """丢弃某项派生数据，下次读取时重新计算"""
+        self._derived.pop(key, None)
+
+    def memoize(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """按快照版本缓存由设置派生的数据"""
+        version = self.snapshot().version
+        if version != self._derived_version:
+            self._derived = {}
+            self._derived_version = version
+        if key not in self._derived:
+            self._derived[key] = factory()
+        return self._derived[key]
+
+    def get_stats(self) -> Dict[str, Any]:
+        snapshot = self._snapshot
+        return {
+            **self.stats,
+            "version": snapshot.version if snapshot is not None else None,
+            "loaded_at": snapshot.loaded_at if snapshot is not None else None,
+            "derived": len(self._derived)
+        }
+
+
+# 全局设置存储
+settings_store = SettingsStore()
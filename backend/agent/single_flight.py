@@ -0,0 +1,211 @@
+"""
+相同请求的合并执行（single-flight）
+
+同一时刻多个调用方以相同的（规范化后的）参数调用同一个工具方法时，只执行一次上游生成：
+- 协程方法：后到的调用方等待同一个结果（或同一个异常）
+- 流式方法：生成结果被广播给所有订阅者，中途加入的订阅者先收到已缓冲的前缀，再接着收实时部分
+执行结束后立即移除，下一次调用会重新生成（结果复用交给响应缓存）。
+所有订阅者都离开时取消上游生成。
+"""
+import asyncio
+import functools
+import json
+import unicodedata
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional
+
+
+def normalize_arg(value: Any) -> Any:
+    """规范化参数：字符串做NFKC、大小写折叠和空白合并"""
+    if isinstance(value, str):
+        return " ".join(unicodedata.normalize("NFKC", value).casefold().split())
+    if isinstance(value, (list, tuple)):
+        return [normalize_arg(item) for item in value]
+    if isinstance(value, dict):
+        return {key: normalize_arg(item) for key, item in sorted(value.items())}
+    return value
+
+
+def make_flight_key(name: str, owner: Any, args: tuple, kwargs: Dict[str, Any]) -> str:
+    """合并键：方法名、所用LLM和规范化后的参数"""
+    llm = getattr(owner, "llm", None)
+    identity = f"{llm._llm_type}/{llm.config.model_name}" if llm is not None else None
+    payload = {
+        "llm": identity,
+        "args": normalize_arg(list(args)),
+        "kwargs": normalize_arg(kwargs)
+    }
+    return f"{name}:{json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)}"
+
+
+class _Call:
+    """进行中的协程调用"""
+
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        self.waiters = 0
+        self.task: Optional[asyncio.Task] = None
+
+
+class _Broadcast:
+    """流式结果的广播缓冲"""
+
+    def __init__(self):
+        self.items: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def publish(self, item: Any) -> None:
+        self.items.append(item)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self.done = True
+        self.error = error
+        self._notify()
+
+    def _notify(self) -> None:
+        # 唤醒所有等待者，并为下一次等待换一个新的事件
+        event, self._changed = self._changed, asyncio.Event()
+        event.set()
+
+    async def subscribe(self) -> AsyncGenerator[Any, None]:
+        position = 0
+        while True:
+            while position < len(self.items):
+                yield self.items[position]
+                position += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+
+class SingleFlightGroup:
+    """管理进行中的合并调用"""
+
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self._streams: Dict[str, _Broadcast] = {}
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    def _record(self, name: str, kind: str) -> None:
+        stats = self.stats.setdefault(name, {"leaders": 0, "joined": 0})
+        stats[kind] += 1
+
+    async def do(self, name: str, key: str, factory: Callable[[], Any]) -> Any:
+        """执行协程，相同键的并发调用共享一次执行"""
+        call = self._calls.get(key)
+        if call is not None:
+            self._record(name, "joined")
+        else:
+            self._record(name, "leaders")
+            future = asyncio.get_running_loop().create_future()
+            # 所有等待者都已离开时，结果中的异常也视为已处理
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            call = _Call(future)
+            self._calls[key] = call
+
+            async def run():
+                try:
+                    future.set_result(await factory())
+                except asyncio.CancelledError:
+                    future.cancel()
+                    raise
+                except BaseException as e:
+                    future.set_exception(e)
+                finally:
+                    if self._calls.get(key) is call:
+                        del self._calls[key]
+
+            # 上游执行放在独立任务中，领头的调用方断开不会影响其他等待者
+            call.task = asyncio.create_task(run())
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.future)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.future.done():
+                # 没有等待者了，取消上游执行
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+                call.task.cancel()
+
+    async def stream(self, name: str, key: str, factory: Callable[[], AsyncGenerator]) -> AsyncGenerator[Any, None]:
+        """执行流式生成，相同键的并发订阅共享同一个上游流"""
+        broadcast = self._streams.get(key)
+        if broadcast is None:
+            self._record(name, "leaders")
+            broadcast = _Broadcast()
+            self._streams[key] = broadcast
+
+            async def produce():
+                try:
+                    async for item in factory():
+                        broadcast.publish(item)
+                    broadcast.finish()
+                except asyncio.CancelledError:
+                    broadcast.finish(asyncio.CancelledError())
+                    raise
+                except Exception as e:
+                    broadcast.finish(e)
+                finally:
+                    if self._streams.get(key) is broadcast:
+                        del self._streams[key]
+
+            broadcast.task = asyncio.create_task(produce())
+        else:
+            self._record(name, "joined")
+
+        broadcast.subscribers += 1
+        try:
+            async for item in broadcast.subscribe():
+                yield item
+        finally:
+            broadcast.subscribers -= 1
+            if broadcast.subscribers == 0 and not broadcast.done and broadcast.task is not None:
+                # 没有订阅者了，取消上游生成
+                if self._streams.get(key) is broadcast:
+                    del self._streams[key]
+                broadcast.task.cancel()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取合并统计及当前进行中的调用数"""
+        return {
+            "in_flight": len(self._calls),
+            "waiters": sum(c.waiters for c in self._calls.values()),
+            "streams_in_flight": len(self._streams),
+            "subscribers": sum(b.subscribers for b in self._streams.values()),
+            "methods": {name: dict(stats) for name, stats in self.stats.items()}
+        }
+
+
+# 全局合并调用组
+single_flight_group = SingleFlightGroup()
+
+
+def single_flight(name: str):
+    """协程方法装饰器：相同参数的并发调用只执行一次"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            key = make_flight_key(name, self, args, kwargs)
+            return await single_flight_group.do(name, key, lambda: func(self, *args, **kwargs))
+        return wrapper
+    return decorator
+
+
+def single_flight_stream(name: str):
+    """异步生成器方法装饰器：相同参数的并发调用共享同一个流"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            key = make_flight_key(name, self, args, kwargs)
+            async for item in single_flight_group.stream(name, key, lambda: func(self, *args, **kwargs)):
+                yield item
+        return wrapper
+    return decorator
@@ -0,0 +1,176 @@
+"""
+提供商流式响应解码器
+
+在一个可复用的字节缓冲区上增量解码SSE（OpenAI兼容接口）和NDJSON（Ollama）：
+- 正确处理被TCP拆分到多次读取中的帧，以及一次读取中包含的多个事件
+- 按行切分时使用memoryview，避免为每一行复制字节
+- 优先使用orjson解析JSON，未安装时回退到标准库json
+- 无法解析的帧会计数并打印，而不是静默丢弃
+"""
+import json
+from typing import Any, AsyncIterator, Callable, List, Optional
+
+try:
+    import orjson
+
+    JSON_BACKEND = "orjson"
+
+    def json_loads(data) -> Any:
+        return orjson.loads(data)
+except ImportError:  # pragma: no cover - 取决于运行环境
+    JSON_BACKEND = "json"
+
+    def json_loads(data) -> Any:
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return json.loads(data)
+
+
+class StreamDecoder:
+    """增量流解码器基类，子类实现单行的解析"""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.done = False  # 收到结束标记后不再产出事件
+        self.events = 0
+        self.malformed = 0
+
+    def feed(self, data: bytes) -> List[Any]:
+        """写入一次网络读取得到的字节，返回其中所有完整的事件"""
+        if self.done:
+            return []
+        buffer = self._buffer
+        buffer += data
+        events: List[Any] = []
+        start = 0
+        view = memoryview(buffer)
+        try:
+            while not self.done:
+                end = buffer.find(b"\n", start)
+                if end < 0:
+                    break
+                line_end = end
+                if line_end > start and buffer[line_end - 1] == 0x0D:  # 兼容\r\n
+                    line_end -= 1
+                line = view[start:line_end]
+                try:
+                    self._decode_line(line, events)
+                finally:
+                    line.release()
+                start = end + 1
+        finally:
+            view.release()
+        if start:
+            del buffer[:start]
+        self.events += len(events)
+        return events
+
+    def flush(self) -> List[Any]:
+        """流结束时处理缓冲区中剩余的不完整行"""
+        events: List[Any] = []
+        if self._buffer and not self.done:
+            self._decode_line(memoryview(bytes(self._buffer)), events)
+        self._buffer.clear()
+        self._finish(events)
+        self.events += len(events)
+        return events
+
+    def _decode_line(self, line: memoryview, events: List[Any]) -> None:
+        raise NotImplementedError
+
+    def _finish(self, events: List[Any]) -> None:
+        """流结束时的收尾处理"""
+
+    def _parse(self, payload) -> Optional[Any]:
+        try:
+            return json_loads(payload)
+        except ValueError:
+            self._report_malformed(payload)
+            return None
+
+    def _report_malformed(self, payload) -> None:
+        self.malformed += 1
+        text = bytes(payload).decode("utf-8", errors="replace")
+        print(f"无法解析的流式数据帧: {text[:100]}")
+
+
+class NDJSONDecoder(StreamDecoder):
+    """Ollama使用的NDJSON（每行一个JSON对象）解码器"""
+
+    def _decode_line(self, line: memoryview, events: List[Any]) -> None:
+        if not line.nbytes:
+            return
+        data = self._parse(line)
+        if data is not None:
+            events.append(data)
+
+
+class SSEDecoder(StreamDecoder):
+    """OpenAI兼容接口使用的Server-Sent Events解码器
+
+    每个data行会被立即尝试解析；解析失败时按SSE规范把后续data行
+    拼接起来，在事件结束的空行处再解析一次（多行data字段）。
+    """
+
+    DONE = b"[DONE]"
+
+    def __init__(self):
+        super().__init__()
+        self._pending: List[bytes] = []
+
+    def _decode_line(self, line: memoryview, events: List[Any]) -> None:
+        if not line.nbytes:
+            self._dispatch_pending(events)
+            return
+        if line[:5] != b"data:":
+            # event/id/retry字段以及以冒号开头的注释（心跳）不携带内容
+            return
+        payload = line[5:]
+        if payload[:1] == b" ":
+            payload = payload[1:]
+        if payload == self.DONE:
+            self._dispatch_pending(events)
+            self.done = True
+            return
+        if self._pending:
+            self._pending.append(bytes(payload))
+            return
+        try:
+            events.append(json_loads(payload))
+        except ValueError:
+            self._pending.append(bytes(payload))
+
+    def _dispatch_pending(self, events: List[Any]) -> None:
+        if not self._pending:
+            return
+        payload = b"\n".join(self._pending)
+        self._pending = []
+        data = self._parse(payload)
+        if data is not None:
+            events.append(data)
+
+    def _finish(self, events: List[Any]) -> None:
+        self._dispatch_pending(events)
+
+
+async def iter_stream_events(content, decoder: StreamDecoder) -> AsyncIterator[Any]:
+    """从aiohttp响应体中增量读取并解码事件"""
+    async for data in content.iter_any():
+        for event in decoder.feed(data):
+            yield event
+        if decoder.done:
+            return
+    for event in decoder.flush():
+        yield event
+
+
+async def iter_stream_tokens(
+    content,
+    decoder: StreamDecoder,
+    extract: Callable[[Any], Optional[str]]
+) -> AsyncIterator[str]:
+    """所有提供商共用的token迭代器，extract负责从事件中取出文本"""
+    async for event in iter_stream_events(content, decoder):
+        token = extract(event)
+        if token:
+            yield token
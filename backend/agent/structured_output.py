@@ -0,0 +1,381 @@
+"""
+结构化输出
+
+各工具原本让模型输出<...|...>、#标题、<定义>等自定义文本格式再逐行解析，
+一行格式不对就会丢掉条目，解析不出任何内容时整段重新生成。结构化输出模式：
+- 按工具声明的pydantic模型生成JSON Schema，向支持的提供商请求结构化输出
+  （Ollama的format、OpenAI的json_schema、DeepSeek的json_object），其余提供商只在提示词中要求JSON
+- 流式输出时增量扫描JSON文本，数组中的每个元素一闭合就校验并交给调用方（可即时展示）
+- JSON解析不出任何有效内容时，回退到原来的文本解析器；提供商拒绝结构化参数时，
+  该模型之后改为只在提示词中要求JSON
+- 按工具统计解析失败率，以及相对文本模式节省的重新生成token数
+配置在settings/user_settings.json的global.structured_output中。
+"""
+import json
+from dataclasses import dataclass
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional, Tuple, Type
+from pydantic import BaseModel, ValidationError
+from .errors import ProviderAPIError
+from .generation_profiles import generation_profiles
+from .tokens import estimate_tokens
+
+# 提供商的结构化输出方式
+MODE_SCHEMA = "schema"  # 按JSON Schema约束输出
+MODE_JSON_OBJECT = "json_object"  # 只保证输出合法JSON
+MODE_PROMPT = "prompt"  # 只在提示词中要求JSON
+
+
+class StructuredToolPolicy(BaseModel):
+    """单个工具的结构化输出开关"""
+    enabled: bool = True
+
+
+class StructuredOutputConfig(BaseModel):
+    """结构化输出配置"""
+    enabled: bool = True
+    providers: Dict[str, str] = {
+        "ollama": MODE_SCHEMA,
+        "openai": MODE_SCHEMA,
+        "openrouter": MODE_SCHEMA,
+        "deepseek": MODE_JSON_OBJECT
+    }
+    tools: Dict[str, StructuredToolPolicy] = {
+        "exercises": StructuredToolPolicy(),
+        "concept_analyze": StructuredToolPolicy(),
+        "resources_search": StructuredToolPolicy(),
+        "knowledge_graph": StructuredToolPolicy(),
+        "main_outline": StructuredToolPolicy(),
+        "chapter_outline": StructuredToolPolicy()
+    }
+
+
+@dataclass
+class StructuredSpec:
+    """一个工具的结构化输出声明
+
+    items_key不为空时，输出是{items_key: [model, ...]}，convert收到校验通过的条目列表；
+    否则输出就是model本身，convert收到单个模型实例。
+    """
+    name: str
+    model: Type[BaseModel]
+    convert: Callable[[Any], Any]
+    items_key: Optional[str] = None
+
+    def schema(self) -> Dict[str, Any]:
+        item_schema = self.model.model_json_schema()
+        if not self.items_key:
+            return item_schema
+        defs = item_schema.pop("$defs", None)
+        schema = {
+            "type": "object",
+            "properties": {self.items_key: {"type": "array", "items": item_schema}},
+            "required": [self.items_key]
+        }
+        if defs:
+            schema["$defs"] = defs
+        return schema
+
+    def instruction(self) -> str:
+        """追加在原提示词后的输出格式说明"""
+        return (
+            "\n\n输出格式调整：上面各项内容要求不变，但不要使用上面描述的文本格式，"
+            "只输出一个符合以下JSON Schema的JSON对象，不要输出任何其他内容：\n"
+            f"{json.dumps(self.schema(), ensure_ascii=False)}\n"
+        )
+
+
+class IncrementalItemScanner:
+    """增量扫描流式JSON文本，数组中的每个对象元素一闭合就解析出来"""
+
+    def __init__(self, key: str):
+        self.key = f'"{key}"'
+        self.buffer = ""
+        self.pos = 0
+        self.state = "seek"  # seek -> array -> item -> array ... -> done
+        self.start = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.invalid = 0
+
+    def _enter_array(self) -> bool:
+        index = self.buffer.find(self.key, self.pos)
+        if index < 0:
+            # 保留可能被切断的键名
+            self.pos = max(self.pos, len(self.buffer) - len(self.key))
+            return False
+        cursor = index + len(self.key)
+        expected = ":["
+        while cursor < len(self.buffer) and expected:
+            char = self.buffer[cursor]
+            if char.isspace():
+                cursor += 1
+            elif char == expected[0]:
+                expected = expected[1:]
+                cursor += 1
+            else:
+                # 不是要找的数组，继续向后查找
+                self.pos = index + 1
+                return True
+        if expected:
+            self.pos = index
+            return False
+        self.state = "array"
+        self.pos = cursor
+        return True
+
+    def feed(self, text: str) -> List[Any]:
+        """追加文本，返回新闭合的元素"""
+        self.buffer += text
+        items = []
+        while self.pos < len(self.buffer) and self.state != "done":
+            if self.state == "seek":
+                if not self._enter_array():
+                    break
+                continue
+            char = self.buffer[self.pos]
+            if self.state == "array":
+                if char == "]":
+                    self.state = "done"
+                elif char == "{":
+                    self.state = "item"
+                    self.start = self.pos
+                    self.depth = 1
+                self.pos += 1
+                continue
+            # 元素内部：跟踪字符串和括号深度
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char == "{":
+                self.depth += 1
+            elif char == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    try:
+                        items.append(json.loads(self.buffer[self.start:self.pos + 1]))
+                    except ValueError:
+                        self.invalid += 1
+                    self.state = "array"
+            self.pos += 1
+        return items
+
+
+def parse_json_document(text: str) -> Optional[Any]:
+    """从完整输出中取出JSON对象（容忍代码块包裹和前后的多余文字）"""
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end <= start:
+        return None
+    try:
+        return json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+
+
+def _is_empty(value: Any) -> bool:
+    if value is None:
+        return True
+    if isinstance(value, dict):
+        return not any(value.values())
+    if isinstance(value, (list, tuple, str)):
+        return len(value) == 0
+    return False
+
+
+class StructuredOutputManager:
+    """结构化输出的调用、解析回退和统计"""
+
+    def __init__(self, config: Optional[StructuredOutputConfig] = None):
+        self.config = config or StructuredOutputConfig()
+        self._downgraded: Dict[Tuple[str, str], str] = {}  # 拒绝了结构化参数的模型
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    def configure(self, config: Optional[Dict[str, Any]] = None) -> None:
+        self.config = StructuredOutputConfig(**(config or {}))
+        self._downgraded.clear()
+
+    def enabled(self, tool: str) -> bool:
+        if not self.config.enabled:
+            return False
+        policy = self.config.tools.get(tool)
+        return policy is None or policy.enabled
+
+    def provider_mode(self, provider: str, model: str) -> str:
+        """提供商请求结构化输出的方式"""
+        return self._downgraded.get((provider, model)) or self.config.providers.get(provider, MODE_PROMPT)
+
+    def _stats(self, tool: str) -> Dict[str, int]:
+        return self.stats.setdefault(tool, {
+            "structured_calls": 0,
+            "text_calls": 0,
+            "structured_failures": 0,  # 结构化输出没有得到任何有效内容
+            "text_failures": 0,
+            "fallbacks": 0,  # JSON无效、由文本解析器解析成功
+            "items": 0,
+            "dropped_items": 0,  # 校验失败而丢弃的条目
+            "structured_tokens": 0,
+            "text_tokens": 0,
+            "structured_regeneration_tokens": 0,  # 没有得到有效内容、需要重新生成的输出token
+            "text_regeneration_tokens": 0
+        })
+
+    def _convert_items(self, spec: StructuredSpec, raw_items: List[Any], stats: Dict[str, int]) -> List[BaseModel]:
+        items = []
+        for raw in raw_items:
+            try:
+                items.append(spec.model(**raw))
+            except (TypeError, ValidationError):
+                stats["dropped_items"] += 1
+        return items
+
+    def _parse_structured(self, spec: StructuredSpec, text: str, items: List[BaseModel], stats: Dict[str, int]) -> Any:
+        """把结构化输出转换为工具的结果"""
+        if spec.items_key:
+            if not items:
+                # 流中没有扫描到数组（例如模型换了外层结构），按整个文档再解析一次
+                document = parse_json_document(text)
+                raw_items = document.get(spec.items_key) if isinstance(document, dict) else None
+                if isinstance(raw_items, list):
+                    items = self._convert_items(spec, [item for item in raw_items if isinstance(item, dict)], stats)
+            return spec.convert(items) if items else None
+        document = parse_json_document(text)
+        if not isinstance(document, dict):
+            return None
+        try:
+            return spec.convert(spec.model(**document))
+        except (TypeError, ValidationError):
+            return None
+
+    async def stream(
+        self,
+        llm,
+        spec: StructuredSpec,
+        prompt: str,
+        text_parser: Callable[[str], Any],
+        render: Optional[Callable[[BaseModel], str]] = None,
+        text_stream: Optional[Callable[[str], AsyncGenerator[str, None]]] = None
+    ) -> AsyncGenerator[Tuple[str, Any], None]:
+        """生成并解析工具输出
+
+        依次产出("chunk", 文本)用于展示，最后产出("result", 结果)；结果为空表示解析失败。
+        结构化模式下展示的是render渲染的已完成条目，文本模式下是原始token。
+        text_stream用于文本模式的调用（如带续写的stream_with_resume），默认直接调用llm；
+        两种模式都按spec.name对应任务的生成参数生成。
+        """
+        stats = self._stats(spec.name)
+        provider, model = llm._llm_type, llm.config.model_name
+        if self.enabled(spec.name):
+            mode = self.provider_mode(provider, model)
+            kwargs = {"task": spec.name}
+            if mode != MODE_PROMPT:
+                kwargs["output_schema"] = {"name": spec.name, "schema": spec.schema()}
+            scanner = IncrementalItemScanner(spec.items_key) if spec.items_key else None
+            profile = generation_profiles.get(spec.name)
+            max_items = profile.max_items if profile is not None else None
+            items: List[BaseModel] = []
+            text = ""
+            calls = llm._call(prompt + spec.instruction(), **kwargs)
+            try:
+                async for chunk in calls:
+                    text += chunk
+                    if scanner is None:
+                        continue
+                    for item in self._convert_items(spec, scanner.feed(chunk), stats):
+                        items.append(item)
+                        if render is not None:
+                            yield "chunk", render(item)
+                    if max_items and len(items) >= max_items:
+                        # 条目数已满足任务要求，不再等待剩余输出
+                        del items[max_items:]
+                        generation_profiles.stopped_early(spec.name, "item_limit")
+                        break
+            except ProviderAPIError as e:
+                if text or mode == MODE_PROMPT or e.status not in (400, 422):
+                    raise
+                # 提供商不接受结构化参数，之后只在提示词中要求JSON
+                print(f"{provider}/{model} 不支持结构化输出参数，改为提示词约束: {e.detail[:200]}")
+                self._downgraded[(provider, model)] = MODE_PROMPT
+                async for event in self.stream(llm, spec, prompt, text_parser, render, text_stream):
+                    yield event
+                return
+            finally:
+                await calls.aclose()
+            if scanner is not None:
+                stats["dropped_items"] += scanner.invalid
+            tokens = estimate_tokens(text)
+            stats["structured_calls"] += 1
+            stats["structured_tokens"] += tokens
+            result = self._parse_structured(spec, text, items, stats)
+            if _is_empty(result):
+                # JSON无效时尝试按原来的文本格式解析
+                result = text_parser(text)
+                if _is_empty(result):
+                    stats["structured_failures"] += 1
+                    stats["structured_regeneration_tokens"] += tokens
+                else:
+                    stats["fallbacks"] += 1
+            if isinstance(result, list):
+                stats["items"] += len(result)
+            yield "result", result
+            return
+
+        text = ""
+        calls = text_stream(prompt) if text_stream is not None else llm._call(prompt, task=spec.name)
+        async for chunk in calls:
+            text += chunk
+            yield "chunk", chunk
+        tokens = estimate_tokens(text)
+        stats["text_calls"] += 1
+        stats["text_tokens"] += tokens
+        result = text_parser(text)
+        if _is_empty(result):
+            stats["text_failures"] += 1
+            stats["text_regeneration_tokens"] += tokens
+        elif isinstance(result, list):
+            stats["items"] += len(result)
+        yield "result", result
+
+    async def generate(self, llm, spec: StructuredSpec, prompt: str, text_parser: Callable[[str], Any]) -> Any:
+        """不需要流式展示时直接返回解析结果"""
+        result = None
+        async for kind, value in self.stream(llm, spec, prompt, text_parser):
+            if kind == "result":
+                result = value
+        return result
+
+    def get_stats(self) -> Dict[str, Any]:
+        """各工具的解析失败率和节省的重新生成token数估算
+
+        节省量 = 结构化调用次数 × 文本模式平均每次调用浪费的token - 结构化模式实际浪费的token，
+        本进程内没有文本模式样本时无法估算（为None）。
+        """
+        result = {}
+        for tool, stats in self.stats.items():
+            structured, text = stats["structured_calls"], stats["text_calls"]
+            saved = None
+            if text:
+                saved = int(
+                    structured * stats["text_regeneration_tokens"] / text
+                    - stats["structured_regeneration_tokens"]
+                )
+            result[tool] = {
+                **stats,
+                "structured_failure_rate": round(stats["structured_failures"] / structured, 4) if structured else None,
+                "text_failure_rate": round(stats["text_failures"] / text, 4) if text else None,
+                "regeneration_tokens_saved": saved
+            }
+        return {
+            "enabled": self.config.enabled,
+            "downgraded": [f"{provider}/{model}" for provider, model in self._downgraded],
+            "tools": result
+        }
+
+
+# 全局结构化输出管理器
+structured_output = StructuredOutputManager()
@@ -0,0 +1,29 @@
+"""
+token数量估算
+
+不依赖具体模型的分词器，按字符类型粗略估算：
+- 中日韩字符大约每个字符1个token
+- 其他文本（英文、代码、标点）大约每4个字符1个token
+用于限流预算、缓存统计等只需要量级准确的场景。
+"""
+from typing import Optional
+
+
+def _is_cjk(char: str) -> bool:
+    code = ord(char)
+    return (
+        0x4E00 <= code <= 0x9FFF  # 中日韩统一表意文字
+        or 0x3400 <= code <= 0x4DBF  # 扩展A
+        or 0x3000 <= code <= 0x30FF  # 标点、平假名、片假名
+        or 0xAC00 <= code <= 0xD7AF  # 韩文音节
+        or 0xFF00 <= code <= 0xFFEF  # 全角字符
+    )
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """估算文本的token数"""
+    if not text:
+        return 0
+    cjk = sum(1 for char in text if _is_cjk(char))
+    other = len(text) - cjk
+    return cjk + (other + 3) // 4
@@ -1,7 +1,11 @@
 from typing import List, Dict, Any, AsyncGenerator
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from langchain.llms.base import BaseLLM
 import uuid
+from ..errors import AdmissionRejected
+from ..single_flight import single_flight
+from ..structured_output import StructuredSpec, structured_output
+from ..micro_batcher import micro_batcher
 
 class Concept(BaseModel):
     """概念数据模型"""
@@ -15,23 +19,30 @@ class Concept(BaseModel):
     applications: List[str]  # 应用场景
     key_points: List[str]  # 关键要点
 
-class ConceptAnalyzer:
-    """概念分析器"""
-    def __init__(self, llm: BaseLLM):
-        self.llm = llm
+class ConceptRelation(BaseModel):
+    """相关概念及其与主概念的关系"""
+    concept: str
+    relationship: str
 
-    async def analyze_concept(self, concept: str) -> Dict[str, Any]:
-        """分析概念并返回完整的分析结果
-        
-        Args:
-            concept: 概念名称
-            
-        Returns:
-            Dict[str, Any]: 完整的分析结果，包含概念的定义、特征、示例、关系和应用场景
-        """
-        try:
-            # 构建分析提示词
-            prompt = f"""请分析以下概念：{concept}
+
+class ConceptAnalysis(BaseModel):
+    """结构化输出的概念分析结果"""
+    definition: str = Field(description="简洁明确地描述概念本质特征和核心含义的一段文字")
+    characteristics: List[str] = Field(description="关键特征，每项一个")
+    examples: List[str] = Field(description="具体且容易理解的示例")
+    relations: List[ConceptRelation] = Field(description="相关概念及关系类型")
+    applications: List[str] = Field(description="具体的应用场景")
+
+
+CONCEPT_OUTPUT = StructuredSpec(
+    name="concept_analyze",
+    model=ConceptAnalysis,
+    convert=lambda analysis: analysis.dict()
+)
+
+
+# 各次请求共用的输出格式要求
+CONCEPT_RULES = """
 
 请严格按照以下格式提供分析结果，确保每个部分的格式完全符合要求：
 
@@ -73,15 +84,43 @@ class ConceptAnalyzer:
 
 请确保输出格式的规范性和内容的专业性。
 """
+
+
+class ConceptAnalyzer:
+    """概念分析器"""
+    def __init__(self, llm: BaseLLM):
+        self.llm = llm
+
+    @single_flight("concept_analyze")
+    async def analyze_concept(self, concept: str) -> Dict[str, Any]:
+        """分析概念并返回完整的分析结果
+        
+        Args:
+            concept: 概念名称
             
-            # 使用LLM生成分析结果，收集所有chunk
-            result_chunks = []
-            async for chunk in self.llm._call(prompt):
-                result_chunks.append(chunk)
-            result_text = ''.join(result_chunks)
-            print(result_text)
-            # 解析结果
-            analysis_data = self._structure_raw_result(result_text)
+        Returns:
+            Dict[str, Any]: 完整的分析结果，包含概念的定义、特征、示例、关系和应用场景
+        """
+        try:
+            # 构建分析提示词
+            item = f"请分析以下概念：{concept}"
+            
+            # 与同时到达的其他概念合并为一次调用，未合并时单独请求
+            analysis_data = await micro_batcher.submit(
+                self.llm,
+                "concept_analyze",
+                CONCEPT_RULES,
+                item,
+                self._parse_batched
+            )
+            if analysis_data is None:
+                # 优先请求结构化输出，无效时按标签格式解析原始文本
+                analysis_data = await structured_output.generate(
+                    self.llm,
+                    CONCEPT_OUTPUT,
+                    item + CONCEPT_RULES,
+                    self._structure_raw_result
+                ) or {}
             
             # 返回完整的分析结果
             return {
@@ -93,9 +132,16 @@ class ConceptAnalyzer:
                 "applications": analysis_data.get('applications', [])
             }
             
+        except AdmissionRejected:
+            raise
         except Exception as e:
             raise ValueError(f"概念分析失败：{str(e)}")
             
+    def _parse_batched(self, raw_text: str) -> Dict[str, Any]:
+        """解析合并调用中单个概念的输出，没有定义时视为拆分失败"""
+        result = self._structure_raw_result(raw_text)
+        return result if result.get('definition') else None
+
     def _structure_raw_result(self, raw_text: str) -> Dict[str, Any]:
         """将非JSON格式的原始文本结构化为字典格式
         
@@ -1,6 +1,10 @@
 from typing import List, AsyncGenerator, Dict, Any
 from dataclasses import dataclass, field
 from langchain.llms.base import LLM
+from pydantic import BaseModel, Field
+from ..errors import OutputParseError
+from ..retry_policy import retry_policy, stream_with_resume
+from ..structured_output import StructuredSpec, structured_output
 
 
 # 提示词模板
@@ -121,8 +125,10 @@ PS：当前已生成的目录：
 
 请直接按格式输出小节（不要加任何说明）：
 """,
+    # 同一教程的各小节共用前面的规则和目录，只有末尾的小节信息不同，
+    # 便于模型服务复用已计算的前缀（KV缓存），只预填充末尾的差异部分
     "section_content_with_context": """
-请为【{topic}】的小节【{section}】生成详细内容。
+请为【{topic}】的一个小节生成详细内容，要生成的小节在最后给出。
 
 请你务必仔细、全面地阅读并深入理解下列的各项规则，包括提示词模板中的格式要求、内容结构设计、语言风格要求等每一个细节。在充分掌握这些规则的基础上，确保生成的内容严格遵循规则，无论是格式还是内容逻辑都能准确无误。
 
@@ -132,7 +138,6 @@ PS：当前已生成的目录：
 3. 示例和练习难度要适中，循序渐进
 4. 专业术语的使用要根据学习者背景调整
 5. 确保内容既有挑战性又不会造成挫败感
-小节描述：{description}
 
 严格限制条例：
 - 绝对绝对不要使用或```markdown```或```text```或```math```等文本修饰符包裹内容，否则会出错。
@@ -149,14 +154,9 @@ PS：当前已生成的目录：
         
 内容结构设计：
 1. 禁止用章节名作为标题！
-小节标题作为标题，小节标题需要携带编号（如{section_number}）
-次小节标题作为次级标题，次级标题也需要携带编号（如{section_number}.1）
-示例：
-# {section}
-## {section_number}.1
-## {section_number}.2
-## {section_number}.3
-...(至少包含5个次小节)
+小节标题作为标题，小节标题需要携带小节编号
+次小节标题作为次级标题，次级标题也需要携带编号（小节编号.1、小节编号.2……）
+至少包含5个次小节，标题格式见最后的示例
 
 2. 正文部分：
    - 按知识点划分内容，每个知识点独立讲解，作为次小节标题，一个小节建议包含5-10个次小节。
@@ -212,6 +212,15 @@ PS：当前已生成的目录：
    - 外部引用：引用参考资料
    - 注释说明：必要的补充解释
 
+要生成的小节：【{section}】（编号{section_number}）
+小节描述：{description}
+标题示例：
+# {section}
+## {section_number}.1
+## {section_number}.2
+## {section_number}.3
+...(至少包含5个次小节)
+
 联网搜索结果：
 {web_context}
 
@@ -238,110 +247,234 @@ class Section:
     content: str = ""
 
 
+def _parse_chapters(content: str) -> List[Chapter]:
+    """从大纲文本中解析章节列表"""
+    chapters = []
+    current_title = ""
+    current_desc = ""
+    chapter_number = 0
+
+    lines = content.split('\n')
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        # 处理章节标题
+        if line.startswith('# '):
+            # 如果有上一个章节，保存它
+            if current_title:
+                chapters.append(Chapter(
+                    number=chapter_number,
+                    title=current_title,
+                    description=current_desc.strip()
+                ))
+
+            line = line[2:].strip()  # 移除 # 和空白
+            # 尝试匹配"第n章 标题"格式
+            if line.startswith('第') and '章' in line:
+                try:
+                    # 提取章节号和标题
+                    chapter_part = line[1:line.index('章')].strip()
+                    title_base = line[line.index('章')+1:].strip()
+                    title_part = title_base.split('\n')[0].strip()
+
+                    # 转换章节号为数字
+                    chapter_number = int(chapter_part)
+                    # 开始新章节
+                    current_title = f"第{chapter_part}章 {title_part}"
+                    current_desc = ""
+                except (ValueError, IndexError) as e:
+                    print(f"\n章节格式解析失败: {line}")
+                    print(f"错误信息: {str(e)}")
+                    continue
+        # 处理章节描述
+        elif current_title and not line.startswith('#'):
+            if line.startswith('<') and line.endswith('>'):
+                current_desc = line[1:-1].strip()  # 移除 <> 并清理空白
+
+    # 保存最后一个章节
+    if current_title:
+        chapters.append(Chapter(
+            number=chapter_number,
+            title=current_title,
+            description=current_desc
+        ))
+    return chapters
+
+
+def _parse_sections(content: str, chapter: Chapter) -> List[Section]:
+    """从章节大纲文本中解析属于该章节的小节列表"""
+    sections = []
+    current_title = ""
+    current_desc = ""
+    current_number = ""
+
+    lines = content.split('\n')
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        # 处理小节标题
+        if line.startswith('## '):
+            # 如果有上一个小节，保存它
+            if current_title and current_number:
+                sections.append(Section(
+                    number=current_number,
+                    title=current_title,
+                    description=current_desc.strip()
+                ))
+            line = line[3:].strip()  # 移除 ## 和空白
+            try:
+                # 分割章节号和标题
+                section_parts = line.split(' ', 1)
+                if len(section_parts) != 2:
+                    continue
+
+                section_number, section_title = section_parts
+                # 验证章节号格式
+                if '.' not in section_number:
+                    continue
+
+                # 验证章节号与当前章节匹配
+                main_chapter = section_number.split('.')[0]
+                if str(main_chapter) != str(chapter.number):
+                    continue
+
+                # 开始新小节
+                current_number = section_number
+                current_title = section_title
+                current_desc = ""
+
+            except (ValueError, IndexError) as e:
+                print(f"\n小节格式解析失败: {line}")
+                print(f"错误信息: {str(e)}")
+                continue
+
+        # 处理小节描述
+        elif current_title and not line.startswith('#'):
+            if line.startswith('<') and line.endswith('>'):
+                current_desc = line[1:-1].strip()  # 移除 <> 并清理空白
+
+    # 保存最后一个小节
+    if current_title and current_number:
+        sections.append(Section(
+            number=current_number,
+            title=current_title,
+            description=current_desc
+        ))
+    return sections
+
+
+class ChapterItem(BaseModel):
+    """结构化输出中的一个章节"""
+    number: int = Field(description="章节号，从1开始")
+    title: str = Field(description="章节标题，不含章节号")
+    description: str = Field(description="章节描述")
+
+
+class SectionItem(BaseModel):
+    """结构化输出中的一个小节"""
+    number: str = Field(description="小节号，格式为章节号.小节号，如1.1")
+    title: str = Field(description="小节标题，不含小节号")
+    description: str = Field(description="小节描述")
+
+
+def _chapter_title(item: ChapterItem) -> str:
+    title = item.title.strip()
+    return title if title.startswith('第') else f"第{item.number}章 {title}"
+
+
+def _render_chapter(item: ChapterItem) -> str:
+    """结构化输出时，每解析出一个章节就以大纲文本格式展示"""
+    return f"# {_chapter_title(item)}\n<{item.description.strip()}>\n\n"
+
+
+def _render_section(item: SectionItem) -> str:
+    return f"## {item.number.strip()} {item.title.strip()}\n<{item.description.strip()}>\n\n"
+
+
+MAIN_OUTLINE_OUTPUT = StructuredSpec(
+    name="main_outline",
+    model=ChapterItem,
+    items_key="chapters",
+    convert=lambda items: [
+        Chapter(number=item.number, title=_chapter_title(item), description=item.description.strip())
+        for item in items
+    ]
+)
+
+
+def _chapter_outline_output(chapter: Chapter) -> StructuredSpec:
+    """小节大纲的结构化输出，只保留属于该章节的小节"""
+    return StructuredSpec(
+        name="chapter_outline",
+        model=SectionItem,
+        items_key="sections",
+        convert=lambda items: [
+            Section(number=item.number.strip(), title=item.title.strip(), description=item.description.strip())
+            for item in items
+            if item.number.strip().split('.')[0] == str(chapter.number)
+        ]
+    )
+
+
 async def generate_main_outline(
     topic: str,
     llm: LLM,
     context: str = None,
     web_context: str = None
 ) -> AsyncGenerator[Dict[str, Any], None]:
-    """生成主要章节大纲，失败时无限重试"""
+    """生成主要章节大纲，失败时按重试策略退避重试"""
+    # 根据是否有上下文选择提示词模板
+    template_key = "main_outline"
+    prompt = PROMPT_TEMPLATES[template_key].format(
+        topic=topic,
+        context=context if context else "",
+        web_context=web_context if web_context else "未开启联网功能"
+    )
+    print("\n生成章节大纲...")
+    print("话题:", topic)
+    print("提示词:", prompt)
+
+    budget = retry_policy.budget("生成章节大纲")
     while True:
         try:
-            # 根据是否有上下文选择提示词模板
-            template_key = "main_outline"
-            prompt = PROMPT_TEMPLATES[template_key].format(
-                topic=topic,
-                context=context if context else "",
-                web_context=web_context if web_context else "未开启联网功能"
-            )
-            print("\n生成章节大纲...")
-            print("话题:", topic)
-            print("提示词:", prompt)
-            
             content = ""
             chapters = []
-            
-            async for chunk in llm._call(prompt):
-                if not chunk:
-                    continue
-
-                # 立即发送chunk实现流式效果
-                if chunk != "":
+            # 立即发送chunk实现流式效果，文本模式下传输中断时由stream_with_resume续写
+            async for kind, value in structured_output.stream(
+                llm, MAIN_OUTLINE_OUTPUT, prompt, _parse_chapters,
+                render=_render_chapter,
+                text_stream=lambda p: stream_with_resume(llm, p, budget, task="main_outline")
+            ):
+                if kind == "chunk":
                     yield {
                         "type": "chunk",
-                        "data": chunk
+                        "data": value
                     }
-                    content += chunk
-            
-            # 处理完整内容生成章节列表
-            current_title = ""
-            current_desc = ""
-            chapter_number = 0
-            
-            lines = content.split('\n')
-            for line in lines:
-                line = line.strip()
-                if not line:
-                    continue
-                    
-                # 处理章节标题
-                if line.startswith('# '):
-                    # 如果有上一个章节，保存它
-                    if current_title:
-                        chapters.append(Chapter(
-                            number=chapter_number,
-                            title=current_title,
-                            description=current_desc.strip()
-                        ))
-                    
-                    line = line[2:].strip()  # 移除 # 和空白
-                    # 尝试匹配"第n章 标题"格式
-                    if line.startswith('第') and '章' in line:
-                        try:
-                            # 提取章节号和标题
-                            chapter_part = line[1:line.index('章')].strip()
-                            title_base = line[line.index('章')+1:].strip()
-                            title_part = title_base.split('\n')[0].strip()
-                            
-                            # 转换章节号为数字
-                            chapter_number = int(chapter_part)
-                            # 开始新章节
-                            current_title = f"第{chapter_part}章 {title_part}"
-                            current_desc = ""
-                        except (ValueError, IndexError) as e:
-                            print(f"\n章节格式解析失败: {line}")
-                            print(f"错误信息: {str(e)}")
-                            continue
-                # 处理章节描述
-                elif current_title and not line.startswith('#'):
-                    if line.startswith('<') and line.endswith('>'):
-                        current_desc = line[1:-1].strip()  # 移除 <> 并清理空白
-            
-            # 保存最后一个章节
-            if current_title:
-                chapters.append(Chapter(
-                    number=chapter_number,
-                    title=current_title,
-                    description=current_desc
-                ))
-            
+                    content += value
+                else:
+                    chapters = value or []
+
             if not chapters:
                 print("\n未能识别任何章节!")
                 print("完整响应内容:")
                 print("-" * 40)
                 print(content)
                 print("-" * 40)
-                raise ValueError("未能正确解析章节内容")
-        
+                raise OutputParseError("未能正确解析章节内容")
+
             # 返回完整的章节列表
             yield {
                 "type": "chapters",
                 "data": chapters
             }
-            break  # 成功生成，退出循环
+            return
         except Exception as e:
-            print(f"生成章节大纲失败: {str(e)}，正在重试...")
-            continue
+            # 不可重试的错误（如准入拒绝）或预算耗尽时直接抛出
+            await budget.backoff(e)
 
 
 async def generate_chapter_outline(
@@ -351,97 +484,41 @@ async def generate_chapter_outline(
     context: str = None,
     web_context: str = None
 ) -> AsyncGenerator[Dict[str, Any], None]:
-    """生成章节的小节大纲，失败时无限重试"""
+    """生成章节的小节大纲，失败时按重试策略退避重试"""
+    # 根据是否有上下文选择提示词模板
+    template_key = "chapter_outline_with_context"
+    prompt = PROMPT_TEMPLATES[template_key].format(
+        topic=topic,
+        chapter=chapter.title,
+        description=chapter.description,
+        chapter_num=chapter.number,
+        context=context if context else "暂无",
+        web_context=web_context if web_context else "未开启联网功能"
+    )
+
+    print(f"\n生成第 {chapter.number} 章小节...")
+    print("提示词:", prompt)
+
+    budget = retry_policy.budget(f"生成第{chapter.number}章小节大纲")
     while True:
         try:
-            # 根据是否有上下文选择提示词模板
-            template_key = "chapter_outline_with_context"
-            prompt = PROMPT_TEMPLATES[template_key].format(
-                topic=topic,
-                chapter=chapter.title,
-                description=chapter.description,
-                chapter_num=chapter.number,
-                context=context if context else "暂无",
-                web_context=web_context if web_context else "未开启联网功能"
-            )
-            
-            print(f"\n生成第 {chapter.number} 章小节...")
-            print("提示词:", prompt)
-            
             content = ""
             sections = []
-            
-            async for chunk in llm._call(prompt):
-                if not chunk:
-                    continue
-                    
-                # 立即发送chunk实现流式效果
-                if chunk != "":
+            async for kind, value in structured_output.stream(
+                llm, _chapter_outline_output(chapter), prompt,
+                lambda text: _parse_sections(text, chapter),
+                render=_render_section,
+                text_stream=lambda p: stream_with_resume(llm, p, budget, task="chapter_outline")
+            ):
+                if kind == "chunk":
                     yield {
                         "type": "chunk",
-                        "data": chunk
+                        "data": value
                     }
-                    content += chunk
-            
-            # 处理完整内容生成小节列表
-            current_title = ""
-            current_desc = ""
-            current_number = ""
-            
-            lines = content.split('\n')
-            for line in lines:
-                line = line.strip()
-                if not line:
-                    continue
-                
-                # 处理小节标题
-                if line.startswith('## '):
-                    # 如果有上一个小节，保存它
-                    if current_title and current_number:
-                        sections.append(Section(
-                            number=current_number,
-                            title=current_title,
-                            description=current_desc.strip()
-                        ))
-                    line = line[3:].strip()  # 移除 ## 和空白
-                    try:
-                        # 分割章节号和标题
-                        section_parts = line.split(' ', 1)
-                        if len(section_parts) != 2:
-                            continue
-                            
-                        section_number, section_title = section_parts
-                        # 验证章节号格式
-                        if '.' not in section_number:
-                            continue
-                            
-                        # 验证章节号与当前章节匹配
-                        main_chapter = section_number.split('.')[0]
-                        if str(main_chapter) != str(chapter.number):
-                            continue
-                        
-                        # 开始新小节
-                        current_number = section_number
-                        current_title = section_title
-                        current_desc = ""
-                        
-                    except (ValueError, IndexError) as e:
-                        print(f"\n小节格式解析失败: {line}")
-                        print(f"错误信息: {str(e)}")
-                        continue
-                        
-                # 处理小节描述
-                elif current_title and not line.startswith('#'):
-                    if line.startswith('<') and line.endswith('>'):
-                        current_desc = line[1:-1].strip()  # 移除 <> 并清理空白
-            
-            # 保存最后一个小节
-            if current_title and current_number:
-                sections.append(Section(
-                    number=current_number,
-                    title=current_title,
-                    description=current_desc
-                ))
+                    content += value
+                else:
+                    sections = value or []
+
             if not sections:
                 print("\n未能提取到任何小节")
                 print("完整响应内容:")
@@ -450,17 +527,16 @@ async def generate_chapter_outline(
                 print("-" * 40)
                 print("\n错误原因：小节格式必须是：## 章节号.小节号 标题")
                 print("正确示例：## 1.1 变量定义")
-                raise ValueError("未识别到任何符合格式的小节")
-            
-                    # 返回完整的小节列表
+                raise OutputParseError("未识别到任何符合格式的小节")
+
+            # 返回完整的小节列表
             yield {
-                        "type": "sections",
-                        "data": sections
+                "type": "sections",
+                "data": sections
             }
-            break  # 成功生成，退出循环
+            return
         except Exception as e:
-            print(f"生成小节大纲失败: {str(e)}，正在重试...")
-            continue
+            await budget.backoff(e)
 
 
 async def generate_section_content(
@@ -470,42 +546,35 @@ async def generate_section_content(
     context: str = None,
     web_context: str = None
 ) -> AsyncGenerator[Dict[str, Any], None]:
-    """生成小节的详细内容，失败时无限重试"""
-    while True:
-        try:
+    """生成小节的详细内容，传输中断时从已输出的内容续写"""
     # 直接使用小节的标题和描述构建提示词
-            # 根据是否有上下文选择提示词模板
-            template_key = "section_content_with_context"
-            prompt = PROMPT_TEMPLATES[template_key].format(
-                topic=topic,
-                section=f"{section.title}",
-                description=section.description,
-                context=context if context else "暂无",
-                section_number=section.number,
-                web_context=web_context if web_context else "未开启联网功能"
-            )
-            print(f"\n生成第 {section.number} 小节内容...")
-            print("提示词:", prompt)
-            content = ""
-            async for chunk in llm._call(prompt):
-                if not chunk:
-                    continue
-                # 发送流式chunk
-                yield {
-                    "type": "chunk",
-                    "data": chunk
-                }
-                content += chunk
-            
-            # 返回完整内容
-            yield {
-                "type": "content",
-                "data": content
-            }
-            break  # 成功生成，退出循环
-        except Exception as e:
-            print(f"生成小节内容失败: {str(e)}，正在重试...")
-            continue
+    template_key = "section_content_with_context"
+    prompt = PROMPT_TEMPLATES[template_key].format(
+        topic=topic,
+        section=f"{section.title}",
+        description=section.description,
+        context=context if context else "暂无",
+        section_number=section.number,
+        web_context=web_context if web_context else "未开启联网功能"
+    )
+    print(f"\n生成第 {section.number} 小节内容...")
+    print("提示词:", prompt)
+
+    budget = retry_policy.budget(f"生成第{section.number}小节内容")
+    content = ""
+    async for chunk in stream_with_resume(llm, prompt, budget, task="section"):
+        # 发送流式chunk
+        yield {
+            "type": "chunk",
+            "data": chunk
+        }
+        content += chunk
+
+    # 返回完整内容
+    yield {
+        "type": "content",
+        "data": content
+    }
 
 # 导出内容
 __all__ = [
@@ -3,6 +3,10 @@ from langchain.llms.base import LLM
 from langchain.prompts import PromptTemplate
 from langchain.output_parsers import PydanticOutputParser
 from pydantic import BaseModel, Field
+from ..errors import AdmissionRejected
+from ..single_flight import single_flight
+from ..structured_output import StructuredSpec, structured_output
+from ..micro_batcher import micro_batcher
 
 
 class Exercise(BaseModel):
@@ -22,36 +26,37 @@ class ExerciseSet(BaseModel):
     total_count: int = Field(description="题目总数")
 
 
-class ExerciseGenerator:
-    def __init__(self, llm: LLM):
-        self.llm = llm
-        self.parser = PydanticOutputParser(pydantic_object=Exercise)
+class ExerciseItem(BaseModel):
+    """结构化输出中的一道题"""
+    type: str = Field(description="题目类型：选择题/判断题/填空题/计算题/简答题")
+    question: str = Field(description="题干，不含选项，填空处用____代替")
+    options: List[str] = Field(default=[], description="选择题的选项（如\"A. 选项内容\"），其他题型为空")
+    answer: str = Field(description="正确答案，选择题为选项字母")
 
-    async def generate_batch(
-        self,
-        topic: str,
-        types: List[str],
-        difficulty: int = 3,
-        count: int = 5
-    ) -> List[Dict[str, Any]]:
-        """批量生成练习题
-        
-        Args:
-            topic: 知识点
-            types: 题目类型列表
-            difficulty: 难度等级(1-5)
-            count: 生成数量
-            
-        Returns:
-            List[Dict]: 生成的练习题列表
-        """
-        try:
-            # 构建批量生成提示
-            prompt = f"""请根据以下要求生成练习题：
-            知识点：{topic}
-            请你生成{count}道{', '.join(types)}（确保生成的题型正确，只能生成指定的题目类型！）
-            难度等级：{difficulty}/5
 
+def _exercises_from_items(items: List[ExerciseItem]) -> List[Dict[str, Any]]:
+    """把结构化输出转换为与文本解析相同的练习题结构"""
+    return [
+        Exercise(
+            question=item.question.strip(),
+            options={chr(65 + i): option.strip() for i, option in enumerate(item.options)} if item.type.strip() == '选择题' else {},
+            answer=item.answer.strip(),
+            type_=item.type.strip().lower().replace('题', '')
+        ).dict()
+        for item in items
+    ]
+
+
+EXERCISE_OUTPUT = StructuredSpec(
+    name="exercises",
+    model=ExerciseItem,
+    items_key="exercises",
+    convert=_exercises_from_items
+)
+
+
+# 各次请求共用的出题要求和输出格式
+EXERCISE_RULES = """
             要求：
             1. 题目难度要符合指定等级
             2. 每道题必须包含题目类型、题干和答案
@@ -86,67 +91,126 @@ class ExerciseGenerator:
             - 填空题的题干部分需要填入地方的用____代替
             - 判断题/计算题/简答题的题干是一个整体，无分隔
             """
-            
-            # 初始化输出列表
-            output = []
-            
-            # 使用LLM生成结果
-            async for chunk in self.llm._call(prompt):
-                output.append(chunk)
-            output = ''.join(output)
-            # 解析输出格式
-            exercises = []
-            for line in output.strip().split('\n'):
-                line = line.strip()
-                if line.startswith('<') and line.endswith('>'):
-                    try:
-                        # 移除尖括号并分割字段
-                        fields = line[1:-1].split('|')
-                        if len(fields) != 3:
-                            continue
-                            
-                        exercise_type, question, answer = fields
-                        
-                        # 处理选项
-                        options = {}
-                        if exercise_type.strip() == '选择题':
-                            option_list = question.strip().split('///')
-                            if len(option_list) > 1:
-                                question = option_list[0]
-                                for i, opt in enumerate(option_list[1:], start=0):
-                                    options[chr(65 + i)] = opt.strip()
-                        
-                        # 创建练习题对象
-                        exercise_data = {
-                            'question': question.strip(),
-                            'options': options,
-                            'answer': answer.strip(),
-                            'type_': exercise_type.strip().lower().replace('题', ''),
-                        }
-                        
-                        exercise = Exercise(**exercise_data)
-                        exercises.append(exercise.dict())
-                    except Exception as e:
-                        print(f"题目解析失败: {str(e)}")
+
+# 不超过该题数的请求可以与其他请求合并生成
+BATCHABLE_COUNT = 3
+
+# 生成失败时占位题目的题干
+FALLBACK_QUESTION = "生成失败"
+
+
+class ExerciseGenerator:
+    def __init__(self, llm: LLM):
+        self.llm = llm
+        self.parser = PydanticOutputParser(pydantic_object=Exercise)
+
+    @staticmethod
+    def build_request(topic: str, types: List[str], difficulty: int = 3, count: int = 5) -> str:
+        """提示词中每次请求不同的部分（知识点、题型、数量和难度）"""
+        return f"""请根据以下要求生成练习题：
+            知识点：{topic}
+            请你生成{count}道{', '.join(types)}（确保生成的题型正确，只能生成指定的题目类型！）
+            难度等级：{difficulty}/5
+"""
+
+    @classmethod
+    def build_prompt(cls, topic: str, types: List[str], difficulty: int = 3, count: int = 5) -> str:
+        """构建批量生成练习题的提示词"""
+        return cls.build_request(topic, types, difficulty, count) + EXERCISE_RULES
+
+    @staticmethod
+    def parse_exercises(output: str, count: int) -> List[Dict[str, Any]]:
+        """解析<题目类型|题干|答案>格式的输出"""
+        exercises = []
+        for line in output.strip().split('\n'):
+            line = line.strip()
+            if line.startswith('<') and line.endswith('>'):
+                try:
+                    # 移除尖括号并分割字段
+                    fields = line[1:-1].split('|')
+                    if len(fields) != 3:
                         continue
+                        
+                    exercise_type, question, answer = fields
+                    
+                    # 处理选项
+                    options = {}
+                    if exercise_type.strip() == '选择题':
+                        option_list = question.strip().split('///')
+                        if len(option_list) > 1:
+                            question = option_list[0]
+                            for i, opt in enumerate(option_list[1:], start=0):
+                                options[chr(65 + i)] = opt.strip()
+                    
+                    # 创建练习题对象
+                    exercise_data = {
+                        'question': question.strip(),
+                        'options': options,
+                        'answer': answer.strip(),
+                        'type_': exercise_type.strip().lower().replace('题', ''),
+                    }
+                    
+                    exercise = Exercise(**exercise_data)
+                    exercises.append(exercise.dict())
+                except Exception as e:
+                    print(f"题目解析失败: {str(e)}")
+                    continue
+        
+        return exercises[:count]  # 确保返回指定数量的题目
+
+    @staticmethod
+    def is_fallback(exercises: List[Dict[str, Any]]) -> bool:
+        """是否为生成失败时返回的占位题目"""
+        return len(exercises) == 1 and exercises[0].get("question") == FALLBACK_QUESTION
+
+    @single_flight("exercises")
+    async def generate_batch(
+        self,
+        topic: str,
+        types: List[str],
+        difficulty: int = 3,
+        count: int = 5
+    ) -> List[Dict[str, Any]]:
+        """批量生成练习题
+        
+        Args:
+            topic: 知识点
+            types: 题目类型列表
+            difficulty: 难度等级(1-5)
+            count: 生成数量
             
-            return exercises[:count]  # 确保返回指定数量的题目
+        Returns:
+            List[Dict]: 生成的练习题列表
+        """
+        try:
+            exercises = None
+            if count <= BATCHABLE_COUNT:
+                # 题数少的请求与同时到达的其他请求合并为一次调用，未合并时单独请求
+                exercises = await micro_batcher.submit(
+                    self.llm,
+                    "exercises",
+                    EXERCISE_RULES,
+                    self.build_request(topic, types, difficulty, count),
+                    lambda output: self.parse_exercises(output, count)
+                )
+            if exercises is None:
+                prompt = self.build_prompt(topic, types, difficulty, count)
+
+                # 优先请求结构化输出，无效时回退到文本格式解析
+                exercises = await structured_output.generate(
+                    self.llm,
+                    EXERCISE_OUTPUT,
+                    prompt,
+                    lambda output: self.parse_exercises(output, count)
+                )
+            return (exercises or [])[:count]
+        except AdmissionRejected:
+            raise
         except Exception as e:
             print(f"练习题生成失败: {str(e)}")
-            return {
-                "exercise": {
-                    "question": "生成失败",
-                    "options": ["选项生成失败"],
-                    "answer": "无法生成答案",
-                    "explanation": "练习题生成过程中出现错误",
-                    "difficulty": difficulty,
-                    "topic": topic,
-                    "type": exercise_type,
-                    "keywords": []
-                },
-                "metadata": {
-                    "topic": topic,
-                    "difficulty": difficulty,
-                    "type": exercise_type
-                }
-            }
\ No newline at end of file
+            return [Exercise(
+                question=FALLBACK_QUESTION,
+                options={},
+                answer="无法生成答案",
+                type_=types[0].strip().lower().replace('题', '') if types else ""
+            ).dict()]
@@ -1,6 +1,10 @@
 from typing import List, Dict, Any
 from dataclasses import dataclass
 from langchain.llms.base import LLM
+from pydantic import BaseModel, Field
+from ..single_flight import single_flight_stream
+from ..structured_output import StructuredSpec, structured_output
+from ..micro_batcher import micro_batcher
 
 
 @dataclass
@@ -28,6 +32,49 @@ class KnowledgeEdge:
     metadata: Dict[str, Any] = None  # 元数据
 
 
+class NodeItem(BaseModel):
+    """结构化输出中的一个知识点"""
+    label: str = Field(description="知识点名称")
+    category: str = Field(description="类别：概念/方法/原理/应用")
+    description: str = Field(description="50字以内的简短描述")
+    relation: str = Field(description="与中心知识点的关系：包含/依赖/应用/相关/推导")
+
+
+def _nodes_from_items(items: List[NodeItem]) -> List[Dict[str, str]]:
+    return [{"id": f"K{i}", **item.dict()} for i, item in enumerate(items, 1)]
+
+
+def _parse_node_lines(result: str) -> List[Dict[str, str]]:
+    """解析<node|id,label,category,description,relation>格式的输出"""
+    nodes = []
+    for line in result.strip().split('\n'):
+        line = line.strip()
+        if line.startswith('<node|'):
+            attrs = line[6:-1].split(',')
+            if len(attrs) >= 5:  # 确保包含关系属性
+                nodes.append({
+                    "id": attrs[0],
+                    "label": attrs[1],
+                    "category": attrs[2],
+                    "description": attrs[3],
+                    "relation": attrs[4]
+                })
+    return nodes
+
+
+def _render_node(item: NodeItem) -> str:
+    """结构化输出时，每解析出一个知识点就以文本格式展示"""
+    return f"<node|{item.label},{item.category},{item.description},{item.relation}>\n"
+
+
+NODE_OUTPUT = StructuredSpec(
+    name="knowledge_graph",
+    model=NodeItem,
+    items_key="nodes",
+    convert=_nodes_from_items
+)
+
+
 PROMPT_TEMPLATES = {
     "expand_knowledge": """
 你是一个专业的知识图谱分析专家。请基于给定的知识点【{topic}】，生成相关的知识点。
@@ -51,11 +98,46 @@ PROMPT_TEMPLATES = {
 """
 }
 
+# 拓展单个节点的提示词：每次请求不同的部分、共用的要求和输出格式、结尾的开始提示
+EXPAND_NODE_REQUEST = """
+你是一个专业的知识图谱分析专家。请基于给定的知识点【{topic}】（{category}），生成相关的延伸知识点。
+
+要拓展的中心知识点：
+- ID: {node_id}
+- 名称: {topic}
+- 类别: {category}
+- 描述: {description}
+
+已有知识点：
+{current_nodes}
+"""
+
+EXPAND_NODE_RULES = """
+要求：
+1. 生成3-4个新的相关知识点（避免与已有知识点重复）
+2. 每个知识点都要归类（概念/方法/原理/应用）
+3. 为每个知识点提供简短描述（50字以内）
+4. 指明与中心知识点的关系类型（包含/依赖/应用/相关/推导）
+
+输出格式要求：
+- 每个知识点用<node>标签包裹，属性用|分隔
+- 属性顺序：id,label,category,description,relation
+- id使用K1,K2,K3...格式
+
+示例输出：
+<node|K1,变量,概念,用于存储和表示数据的命名空间,包含>
+"""
+
+EXPAND_NODE_START = """
+请直接开始输出：
+"""
+
 
 class KnowledgeGraphGenerator:
     def __init__(self, llm: LLM):
         self.llm = llm
 
+    @single_flight_stream("knowledge_graph_generate")
     async def expand_knowledge(
         self,
         topic: str,
@@ -84,56 +166,50 @@ class KnowledgeGraphGenerator:
             draggable=True
         )
 
-        # 收集完整输出
-        result = ""
-        async for chunk in self.llm._call(prompt):
-            if chunk:
-                yield {
-                    "type": "chunk",
-                    "data": chunk
-                }
-                result += chunk
+        # 优先请求结构化输出，无效时按<node|...>格式解析
+        parsed = []
+        async for kind, value in structured_output.stream(
+            self.llm, NODE_OUTPUT, prompt, _parse_node_lines, render=_render_node
+        ):
+            if kind == "chunk":
+                if value:
+                    yield {
+                        "type": "chunk",
+                        "data": value
+                    }
+            else:
+                parsed = value or []
 
         yield {
             "type": "chunk",
             "data": "\n正在解析知识点和关系..."
         }
         
-        # 解析输出
-        lines = result.strip().split('\n')
         nodes = [root_node]  # 将根节点添加到节点列表
         edges = []
         
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-                
-            if line.startswith('<node|'):
-                # 解析节点
-                attrs = line[6:-1].split(',')
-                if len(attrs) >= 5:  # 确保包含关系属性
-                    node = KnowledgeNode(
-                        id=attrs[0],
-                        label=attrs[1],
-                        name=attrs[1],
-                        category=attrs[2],
-                        description=attrs[3],
-                        value=1,
-                        draggable=True
-                    )
-                    nodes.append(node)
-                    
-                    # 创建与中心节点的关系
-                    if attrs[0] != "center":
-                        edge = KnowledgeEdge(
-                            source="center",
-                            target=attrs[0],
-                            type=attrs[4],  # 使用节点中的关系属性
-                            description=f"{attrs[1]}是{topic}的{attrs[4]}",
-                            label=attrs[4]
-                        )
-                        edges.append(edge)
+        for attrs in parsed:
+            node = KnowledgeNode(
+                id=attrs["id"],
+                label=attrs["label"],
+                name=attrs["label"],
+                category=attrs["category"],
+                description=attrs["description"],
+                value=1,
+                draggable=True
+            )
+            nodes.append(node)
+            
+            # 创建与中心节点的关系
+            if attrs["id"] != "center":
+                edge = KnowledgeEdge(
+                    source="center",
+                    target=attrs["id"],
+                    type=attrs["relation"],  # 使用节点中的关系属性
+                    description=f"{attrs['label']}是{topic}的{attrs['relation']}",
+                    label=attrs["relation"]
+                )
+                edges.append(edge)
         
         # 返回解析后的数据
         graph_data = {
@@ -160,97 +236,79 @@ class KnowledgeGraphGenerator:
         current_nodes: List[Dict[str, Any]] = None
     ):
         """拓展单个知识点节点"""
-        prompt = f"""
-你是一个专业的知识图谱分析专家。请基于给定的知识点【{topic}】（{category}），生成相关的延伸知识点。
-
-要拓展的中心知识点：
-- ID: {node_id}
-- 名称: {topic}
-- 类别: {category}
-- 描述: {description}
-
-已有知识点：
-{chr(10).join([
-    f"- {node['label']}（{node['category']}）"
-    for node in (current_nodes or [])
-])}
-
-要求：
-1. 生成3-4个新的相关知识点（避免与已有知识点重复）
-2. 每个知识点都要归类（概念/方法/原理/应用）
-3. 为每个知识点提供简短描述（50字以内）
-4. 指明与中心知识点的关系类型（包含/依赖/应用/相关/推导）
-
-输出格式要求：
-- 每个知识点用<node>标签包裹，属性用|分隔
-- 属性顺序：id,label,category,description,relation
-- id使用K1,K2,K3...格式
-
-示例输出：
-<node|K1,变量,概念,用于存储和表示数据的命名空间,包含>
-
-请直接开始输出：
-"""
+        node_input = EXPAND_NODE_REQUEST.format(
+            node_id=node_id,
+            topic=topic,
+            category=category,
+            description=description,
+            current_nodes=chr(10).join([
+                f"- {node['label']}（{node['category']}）"
+                for node in (current_nodes or [])
+            ])
+        )
         # 输出初始信息
         yield {
             "type": "chunk",
             "data": f"开始拓展知识点 [{topic}]...\n"
         }
 
-        # 收集完整输出
-        result = ""
-        async for chunk in self.llm._call(prompt):
-            if chunk:
+        # 与同时拓展的其他节点合并为一次调用，未合并时单独请求
+        parsed = await micro_batcher.submit(
+            self.llm, "knowledge_graph_expand", EXPAND_NODE_RULES, node_input, _parse_node_lines
+        )
+        if parsed is not None:
+            for attrs in parsed:
                 yield {
                     "type": "chunk",
-                    "data": chunk
+                    "data": _render_node(NodeItem(**attrs))
                 }
-                result += chunk
+        else:
+            # 优先请求结构化输出，无效时按<node|...>格式解析
+            parsed = []
+            async for kind, value in structured_output.stream(
+                self.llm, NODE_OUTPUT, node_input + EXPAND_NODE_RULES + EXPAND_NODE_START, _parse_node_lines, render=_render_node
+            ):
+                if kind == "chunk":
+                    if value:
+                        yield {
+                            "type": "chunk",
+                            "data": value
+                        }
+                else:
+                    parsed = value or []
 
         yield {
             "type": "chunk",
             "data": "\n正在解析新的知识点和关系..."
         }
         
-        # 解析输出
-        lines = result.strip().split('\n')
         nodes = []
         edges = []
-        node_counter = 1
         
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-                
-            if line.startswith('<node|'):
-                # 解析节点
-                attrs = line[6:-1].split(',')
-                if len(attrs) >= 5:  # 确保包含关系属性
-                    # 生成新的节点ID，使用原节点ID作为前缀
-                    new_id = f"{node_id}-{node_counter}"
-                    # 创建新节点
-                    node = KnowledgeNode(
-                        id=new_id,
-                        label=attrs[1],
-                        name=attrs[1],
-                        category=attrs[2],
-                        description=attrs[3],
-                        value=1,
-                        draggable=True
-                    )
-                    nodes.append(node)
-                    
-                    # 创建与父节点的关系边
-                    edge = KnowledgeEdge(
-                        source=node_id,  # 父节点作为源节点
-                        target=new_id,   # 新节点作为目标节点
-                        type=attrs[4],    # 使用节点中的关系属性
-                        description=f"{attrs[1]}是{topic}的{attrs[4]}",
-                        label=attrs[4]    # 使用关系类型作为标签
-                    )
-                    edges.append(edge)
-                    node_counter += 1
+        for node_counter, attrs in enumerate(parsed, 1):
+            # 生成新的节点ID，使用原节点ID作为前缀
+            new_id = f"{node_id}-{node_counter}"
+            # 创建新节点
+            node = KnowledgeNode(
+                id=new_id,
+                label=attrs["label"],
+                name=attrs["label"],
+                category=attrs["category"],
+                description=attrs["description"],
+                value=1,
+                draggable=True
+            )
+            nodes.append(node)
+            
+            # 创建与父节点的关系边
+            edge = KnowledgeEdge(
+                source=node_id,  # 父节点作为源节点
+                target=new_id,   # 新节点作为目标节点
+                type=attrs["relation"],    # 使用节点中的关系属性
+                description=f"{attrs['label']}是{topic}的{attrs['relation']}",
+                label=attrs["relation"]    # 使用关系类型作为标签
+            )
+            edges.append(edge)
         
         # 返回解析后的数据
         graph_data = {
@@ -282,7 +340,7 @@ class KnowledgeGraphGenerator:
         )
         
         result = ""
-        async for chunk in self.llm._call(prompt):
+        async for chunk in self.llm._call(prompt, task="knowledge_relation"):
             if chunk:
                 result += chunk
         result = result.strip()
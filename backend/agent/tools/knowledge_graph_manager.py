@@ -3,12 +3,14 @@ import json
 import datetime
 from typing import List, Dict, Any
 import sys
+from ..metrics import storage_duration, timed
 
 class KnowledgeGraphManager:
     def __init__(self):
         self.save_dir = 'mapSaves'
         os.makedirs(self.save_dir, exist_ok=True)
 
+    @timed(storage_duration, manager="knowledge_graph", operation="save")
     def save_graph(self, graph_data: Dict[str, Any], topic: str) -> str:
         """保存知识图谱到文件"""
         # 生成文件名
@@ -22,6 +24,7 @@ class KnowledgeGraphManager:
 
         return filename
 
+    @timed(storage_duration, manager="knowledge_graph", operation="list")
     def get_graph_list(self) -> List[Dict[str, Any]]:
         """获取已保存的知识图谱列表"""
         graph_files = []
@@ -47,6 +50,7 @@ class KnowledgeGraphManager:
 
         return sorted(graph_files, key=lambda x: x['created_at'], reverse=True)
 
+    @timed(storage_duration, manager="knowledge_graph", operation="load")
     def get_graph(self, filename: str) -> Dict[str, Any]:
         """获取指定的知识图谱数据"""
         filepath = os.path.join(self.save_dir, filename)
@@ -56,6 +60,7 @@ class KnowledgeGraphManager:
         with open(filepath, 'r', encoding='utf-8') as f:
             return json.load(f)
 
+    @timed(storage_duration, manager="knowledge_graph", operation="delete")
     def delete_graph(self, filename: str) -> bool:
         """删除指定的知识图谱文件"""
         filepath = os.path.join(self.save_dir, filename)
@@ -0,0 +1,148 @@
+"""
+Ollama上下文长度（num_ctx）选择
+
+原来调用Ollama时不设置num_ctx：带完整大纲和搜索结果的小节提示词超过模型默认上下文时
+被Ollama静默截断，短提示词又按默认值预留了不必要的KV缓存。按提示词大小选择num_ctx：
+- 估算提示词token数，加上输出预留（num_predict，不限制时为reserve_output），
+  从buckets中选择能容纳的最小档位；只用少数几个档位，避免num_ctx频繁变化导致模型反复重新加载
+- 模型已按更大的档位驻留在该实例上时沿用该档位（sticky），同样是为了避免重新加载
+- 档位不超过模型的最大上下文（通过OllamaService.get_model_info读取一次后缓存）
+- 提示词本身超过最大上下文时，按overflow截断提示词中间部分（trim）或只打印警告（warn）
+- 启动预热按warmup_tokens选择档位加载模型并记为已加载，之后的小请求沿用该档位，不会重新加载
+配置在settings/user_settings.json的global.ollama.context中。
+"""
+import asyncio
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from pydantic import BaseModel, Field
+from ..tokens import estimate_tokens
+from .ollama_residency import ollama_residency
+
+TRIM_MARKER = "\n\n……（内容过长，中间部分已省略）……\n\n"
+
+
+class OllamaContextConfig(BaseModel):
+    """num_ctx选择配置"""
+    enabled: bool = True
+    buckets: List[int] = [2048, 4096, 8192, 16384, 32768]
+    reserve_output: int = Field(default=1024, ge=0)  # 不限制输出长度时为输出预留的token数
+    min_output: int = Field(default=256, ge=0)  # 截断提示词时至少为输出留出的token数
+    overflow: str = Field(default="trim", pattern="^(trim|warn)$")
+    sticky: bool = True  # 模型已按更大的档位加载时沿用
+    info_retry: float = Field(default=300.0, gt=0)  # 读取模型最大上下文失败后多久重试（秒）
+    warmup_tokens: int = Field(default=8192, ge=1)  # 预热时按多少token选择档位，应覆盖常见的提示词加输出
+
+
+def trim_prompt(prompt: str, budget: int) -> str:
+    """省略提示词中间部分使其不超过budget个token（保留开头的要求和结尾的任务）"""
+    tokens = estimate_tokens(prompt)
+    if tokens <= budget:
+        return prompt
+    # 按token占比估算保留的字符数，留出标记的位置
+    keep = max(int(len(prompt) * (budget - estimate_tokens(TRIM_MARKER)) / tokens), 0)
+    head = keep // 2
+    return prompt[:head] + TRIM_MARKER + prompt[len(prompt) - (keep - head):]
+
+
+def context_length(info: Dict[str, Any]) -> Optional[int]:
+    """从/api/show的返回中读取模型的最大上下文长度"""
+    for key, value in (info.get("model_info") or {}).items():
+        if key.endswith(".context_length") and isinstance(value, int):
+            return value
+    return None
+
+
+class OllamaContextManager:
+    """按提示词大小选择num_ctx，并缓存各模型的最大上下文"""
+
+    def __init__(self, config: Optional[OllamaContextConfig] = None):
+        self.config = config or OllamaContextConfig()
+        self._limits: Dict[str, Tuple[Optional[int], float]] = {}  # 模型 -> (最大上下文, 读取时间)
+        self._lookups: Dict[str, asyncio.Task] = {}
+        self._loaded: Dict[Tuple[str, str], int] = {}  # (实例, 模型) -> 上次使用的num_ctx
+        self.stats: Dict[str, Any] = {"calls": 0, "buckets": {}, "sticky": 0, "trimmed": 0, "overflow_warnings": 0}
+
+    def configure(self, config: Optional[Dict[str, Any]] = None) -> None:
+        self.config = OllamaContextConfig(**(config or {}))
+
+    async def max_context(self, base_url: str, model: str) -> Optional[int]:
+        """模型的最大上下文长度，读取失败时返回None"""
+        cached = self._limits.get(model)
+        if cached is not None and (cached[0] is not None or time.time() - cached[1] < self.config.info_retry):
+            return cached[0]
+        task = self._lookups.get(model)
+        if task is None:
+            task = asyncio.ensure_future(self._lookup(base_url, model))
+            self._lookups[model] = task
+            task.add_done_callback(lambda _: self._lookups.pop(model, None))
+        return await asyncio.shield(task)
+
+    async def _lookup(self, base_url: str, model: str) -> Optional[int]:
+        # 延迟导入，避免与ollama_service循环导入
+        from .ollama_service import OllamaService
+
+        limit = context_length(await OllamaService(base_url).get_model_info(model))
+        if limit is None:
+            print(f"未能读取 {model} 的最大上下文长度，暂不限制num_ctx档位")
+        self._limits[model] = (limit, time.time())
+        return limit
+
+    def choose(self, needed: int, limit: Optional[int]) -> int:
+        """能容纳needed个token的最小档位（不超过模型的最大上下文）"""
+        buckets = sorted(bucket for bucket in self.config.buckets if limit is None or bucket <= limit)
+        for bucket in buckets:
+            if bucket >= needed:
+                return bucket
+        if limit is not None:
+            return limit
+        return buckets[-1] if buckets else needed
+
+    async def warmup(self, base_url: str, model: str) -> Optional[int]:
+        """预热请求使用的num_ctx，并记为该实例上模型已加载的档位；未启用时返回None"""
+        if not self.config.enabled:
+            return None
+        num_ctx = self.choose(self.config.warmup_tokens, await self.max_context(base_url, model))
+        self._loaded[(base_url, model)] = num_ctx
+        return num_ctx
+
+    async def fit(self, base_url: str, model: str, prompt: str, num_predict: Optional[int]) -> Tuple[str, Optional[int]]:
+        """为一次调用选择num_ctx，必要时截断提示词；返回（提示词, num_ctx），未启用时num_ctx为None"""
+        if not self.config.enabled:
+            return prompt, None
+        self.stats["calls"] += 1
+        limit = await self.max_context(base_url, model)
+        prompt_tokens = estimate_tokens(prompt)
+        output = num_predict if num_predict is not None and num_predict > 0 else self.config.reserve_output
+        if limit is not None and prompt_tokens + self.config.min_output > limit:
+            budget = limit - self.config.min_output
+            if self.config.overflow == "trim":
+                self.stats["trimmed"] += 1
+                print(f"提示词约 {prompt_tokens} token，超过 {model} 的最大上下文 {limit}，截断为约 {budget} token")
+                prompt = trim_prompt(prompt, budget)
+                prompt_tokens = estimate_tokens(prompt)
+            else:
+                self.stats["overflow_warnings"] += 1
+                print(f"警告: 提示词约 {prompt_tokens} token，超过 {model} 的最大上下文 {limit}，Ollama会截断提示词")
+        num_ctx = self.choose(prompt_tokens + output, limit)
+        key = (base_url, model)
+        loaded = self._loaded.get(key)
+        if self.config.sticky and loaded is not None and loaded > num_ctx and ollama_residency.is_resident(base_url, model):
+            self.stats["sticky"] += 1
+            num_ctx = loaded
+        self._loaded[key] = num_ctx
+        buckets = self.stats["buckets"]
+        buckets[num_ctx] = buckets.get(num_ctx, 0) + 1
+        return prompt, num_ctx
+
+    def get_stats(self) -> Dict[str, Any]:
+        """各档位的使用次数、截断次数和已读取的模型最大上下文"""
+        return {
+            "config": self.config.dict(),
+            **self.stats,
+            "max_context": {model: limit for model, (limit, _) in self._limits.items()},
+            "loaded": {f"{base_url}|{model}": num_ctx for (base_url, model), num_ctx in self._loaded.items()}
+        }
+
+
+# 全局num_ctx选择器
+ollama_context = OllamaContextManager()
@@ -0,0 +1,217 @@
+"""
+多个Ollama实例的负载均衡
+
+OllamaConfig.base_url只能指向一个实例，有多台机器运行Ollama时只能用上其中一台。
+在ollama配置中用base_urls列出多个实例后，每次调用按以下规则选择实例：
+- 只在健康、已安装该模型（按/api/tags）的实例中选择；全部不可用时仍选择负载最小的实例尝试
+- 优先选择该模型已驻留显存的实例（模型亲和），除非它比最空闲的实例多出affinity_slack个以上进行中的请求
+- 其余按进行中的请求数最少（least outstanding）选择
+后台定期通过/api/tags探测各实例，连续失败eject_after次（含请求时的连接失败）后摘除，
+探测恢复后重新加入。
+配置在settings/user_settings.json的global.ollama.base_urls和global.ollama.pool中。
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Set
+import aiohttp
+from pydantic import BaseModel, Field
+from ..http_pool import http_pool
+from .ollama_residency import ollama_residency
+from ..circuit_breaker import circuit_breakers
+
+# 请求时视为实例不可用的错误（连接失败、超时），HTTP错误状态不计入
+CONNECTION_ERRORS = (aiohttp.ClientConnectionError, asyncio.TimeoutError, OSError)
+
+
+class OllamaPoolConfig(BaseModel):
+    """Ollama实例池配置"""
+    probe_interval: float = Field(default=15.0, gt=0)  # 健康探测间隔（秒）
+    probe_timeout: float = Field(default=3.0, gt=0)
+    eject_after: int = Field(default=2, ge=1)  # 连续失败多少次后摘除
+    affinity_slack: int = Field(default=2, ge=0)  # 模型已驻留的实例最多可以比最空闲的实例多几个请求
+
+
+@dataclass
+class OllamaInstance:
+    """单个Ollama实例的状态"""
+    base_url: str
+    healthy: bool = True
+    outstanding: int = 0  # 进行中的请求数
+    requests: int = 0
+    errors: int = 0
+    failures: int = 0  # 连续失败次数
+    ejections: int = 0
+    models: Optional[Set[str]] = None  # 已安装的模型，未探测时为None
+    last_probe: Optional[float] = None
+    probe_latency: Optional[float] = None
+    last_error: Optional[str] = None
+
+    def has_model(self, model: str) -> bool:
+        return self.models is None or model in self.models or f"{model}:latest" in self.models
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "base_url": self.base_url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "errors": self.errors,
+            "consecutive_failures": self.failures,
+            "ejections": self.ejections,
+            "models": sorted(self.models) if self.models is not None else None,
+            "last_probe": self.last_probe,
+            "probe_latency": self.probe_latency,
+            "last_error": self.last_error
+        }
+
+
+def pool_urls(config: Any) -> List[str]:
+    """ollama配置中的实例地址：base_url加上base_urls，去重并保持顺序"""
+    urls = [config.get("base_url")] + list(config.get("base_urls") or [])
+    return list(dict.fromkeys(url.rstrip("/") for url in urls if url))
+
+
+class OllamaPool:
+    """Ollama实例的选择、健康探测和负载统计"""
+
+    def __init__(self, config: Optional[OllamaPoolConfig] = None):
+        self.config = config or OllamaPoolConfig()
+        self._instances: Dict[str, OllamaInstance] = {}
+        self._prober: Optional[asyncio.Task] = None
+
+    def configure(self, config: Optional[Dict[str, Any]] = None) -> None:
+        self.config = OllamaPoolConfig(**(config or {}))
+
+    def register(self, urls: Iterable[str]) -> List[OllamaInstance]:
+        """登记实例（已登记的保留原状态）"""
+        instances = []
+        for url in urls:
+            url = url.rstrip("/")
+            if url not in self._instances:
+                self._instances[url] = OllamaInstance(url)
+            instances.append(self._instances[url])
+        return instances
+
+    def pick(self, urls: Iterable[str], model: str) -> str:
+        """为一次调用选择实例"""
+        instances = self.register(urls)
+        if len(instances) == 1:
+            return instances[0].base_url
+        candidates = [i for i in instances if i.healthy and i.has_model(model)] or \
+            [i for i in instances if i.healthy] or instances
+        least = min(i.outstanding for i in candidates)
+        resident = [
+            i for i in candidates
+            if ollama_residency.is_resident(i.base_url, model) and i.outstanding <= least + self.config.affinity_slack
+        ]
+        return min(resident or candidates, key=lambda i: (i.outstanding, i.requests)).base_url
+
+    @asynccontextmanager
+    async def lease(self, urls: Iterable[str], model: str) -> AsyncIterator[str]:
+        """选择实例并在调用期间计入其进行中的请求，连接失败时记入该实例的连续失败次数"""
+        base_url = self.pick(urls, model)
+        instance = self._instances[base_url]
+        instance.outstanding += 1
+        instance.requests += 1
+        try:
+            yield base_url
+        except CONNECTION_ERRORS as e:
+            instance.errors += 1
+            self._failed(instance, f"{e.__class__.__name__}: {str(e)}")
+            raise
+        else:
+            instance.failures = 0
+        finally:
+            instance.outstanding -= 1
+
+    def _failed(self, instance: OllamaInstance, error: str) -> None:
+        instance.failures += 1
+        instance.last_error = error[:200]
+        if instance.healthy and instance.failures >= self.config.eject_after:
+            instance.healthy = False
+            instance.ejections += 1
+            print(f"Ollama实例 {instance.base_url} 连续失败 {instance.failures} 次，暂时摘除: {instance.last_error}")
+
+    async def probe(self, instance: OllamaInstance) -> None:
+        """通过/api/tags探测实例并刷新已安装的模型"""
+        start = time.perf_counter()
+        instance.last_probe = time.time()
+        try:
+            session = http_pool.get_session("ollama")
+            timeout = aiohttp.ClientTimeout(total=self.config.probe_timeout)
+            async with session.get(f"{instance.base_url}/api/tags", timeout=timeout) as response:
+                if response.status != 200:
+                    raise ValueError(f"Status {response.status}")
+                data = await response.json()
+        except Exception as e:
+            self._failed(instance, f"{e.__class__.__name__}: {str(e)}")
+            return
+        instance.probe_latency = round(time.perf_counter() - start, 4)
+        instance.models = {model["name"] for model in data.get("models", []) if model.get("name")}
+        instance.failures = 0
+        if not instance.healthy:
+            instance.healthy = True
+            print(f"Ollama实例 {instance.base_url} 探测恢复，重新加入")
+
+    async def probe_all(self) -> None:
+        if self._instances:
+            await asyncio.gather(*[self.probe(instance) for instance in list(self._instances.values())])
+
+    async def list_tags(self, urls: Iterable[str]) -> Dict[str, List[Dict[str, Any]]]:
+        """各健康实例上已安装的模型（/api/tags原始条目）"""
+        instances = [instance for instance in self.register(urls) if instance.healthy] or self.register(urls)
+
+        async def tags(instance: OllamaInstance) -> List[Dict[str, Any]]:
+            try:
+                session = http_pool.get_session("ollama")
+                timeout = circuit_breakers.client_timeout("ollama", read=True)
+                async with session.get(f"{instance.base_url}/api/tags", timeout=timeout) as response:
+                    if response.status != 200:
+                        print(f"Failed to get Ollama models from {instance.base_url}: Status {response.status}")
+                        return []
+                    data = await response.json()
+            except Exception as e:
+                print(f"Error connecting to Ollama service {instance.base_url}: {str(e)}")
+                self._failed(instance, f"{e.__class__.__name__}: {str(e)}")
+                return []
+            models = data.get("models", [])
+            instance.models = {model["name"] for model in models if model.get("name")}
+            return models
+
+        results = await asyncio.gather(*[tags(instance) for instance in instances])
+        return {instance.base_url: models for instance, models in zip(instances, results)}
+
+    async def _probe_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.config.probe_interval)
+            try:
+                await self.probe_all()
+            except Exception as e:
+                print(f"Ollama实例探测失败: {str(e)}")
+
+    def start(self) -> None:
+        """启动后台健康探测（只有一个实例时不需要探测）"""
+        if len(self._instances) > 1 and (self._prober is None or self._prober.done()):
+            self._prober = asyncio.create_task(self._probe_loop())
+
+    async def stop(self) -> None:
+        if self._prober is not None:
+            self._prober.cancel()
+            try:
+                await self._prober
+            except asyncio.CancelledError:
+                pass
+            self._prober = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """各实例的健康状态和负载"""
+        return {
+            "config": self.config.dict(),
+            "instances": [instance.summary() for instance in self._instances.values()]
+        }
+
+
+# 全局Ollama实例池
+ollama_pool = OllamaPool()
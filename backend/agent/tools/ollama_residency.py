@@ -0,0 +1,274 @@
+"""
+Ollama模型驻留管理
+
+让当前使用的模型通过keep_alive常驻显存，而不是在每次生成前后卸载。
+只有在以下情况才会主动卸载模型：
+- 切换到新模型且驻留模型数量达到上限（按LRU淘汰）
+- 显存占用超过配置的上限（内存压力）
+- 模型空闲时间超过idle_timeout
+有进行中请求的模型不会被卸载；记录只在卸载成功后删除。驻留状态的修改按实例加锁，
+卸载、/api/ps等网络请求在锁外进行，一个实例响应慢不会阻塞其他实例上的生成。
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import Dict, Any, Optional, Tuple, List
+from pydantic import BaseModel, Field
+from ..http_pool import http_pool
+from ..circuit_breaker import circuit_breakers
+
+
+class ResidencyConfig(BaseModel):
+    """模型驻留配置"""
+    keep_alive: str = "30m"  # 每次请求传给Ollama的keep_alive
+    idle_timeout: float = Field(default=900.0, gt=0)  # 空闲多久后主动卸载（秒）
+    max_loaded_models: int = Field(default=1, ge=1)  # 每个Ollama实例最多驻留的模型数
+    max_vram_mb: int = Field(default=0, ge=0)  # 显存占用上限（MB），0表示不检查
+    sweep_interval: float = Field(default=60.0, gt=0)  # 空闲检查间隔（秒）
+
+
+@dataclass
+class ResidentModel:
+    """驻留模型记录"""
+    base_url: str
+    model: str
+    loaded_at: float
+    last_used: float
+    load_seconds: Optional[float] = None  # 冷加载耗时（来自Ollama返回的load_duration）
+    active: int = 0  # 正在进行的请求数
+    uses: int = 0
+    unloading: bool = False  # 正在卸载
+
+
+class OllamaResidencyManager:
+    """Ollama模型驻留管理器"""
+
+    def __init__(self, config: Optional[ResidencyConfig] = None):
+        self.config = config or ResidencyConfig()
+        self._models: "OrderedDict[Tuple[str, str], ResidentModel]" = OrderedDict()
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._sweeper: Optional[asyncio.Task] = None
+        self.evictions: Dict[str, int] = {"lru": 0, "memory": 0, "idle": 0, "manual": 0}
+
+    def configure(self, config: Optional[Dict[str, Any]] = None) -> None:
+        """根据用户设置更新驻留策略"""
+        self.config = ResidencyConfig(**(config or {}))
+
+    @property
+    def keep_alive(self) -> str:
+        return self.config.keep_alive
+
+    def _get_lock(self, base_url: str) -> asyncio.Lock:
+        lock = self._locks.get(base_url)
+        if lock is None:
+            lock = self._locks[base_url] = asyncio.Lock()
+        return lock
+
+    async def acquire(self, base_url: str, model: str) -> None:
+        """在调用模型前登记使用，必要时为新模型腾出空间"""
+        key = (base_url, model)
+        victims: List[ResidentModel] = []
+        async with self._get_lock(base_url):
+            record = self._models.get(key)
+            created = record is None
+            if created:
+                victims = self._lru_victims(base_url)
+                now = time.time()
+                record = ResidentModel(base_url=base_url, model=model, loaded_at=now, last_used=now)
+                self._models[key] = record
+            record.active += 1
+            record.uses += 1
+            self._models.move_to_end(key)
+        # 卸载在锁外进行
+        for victim in victims:
+            await self._unload(victim, "lru")
+        if created:
+            await self._relieve_memory(base_url)
+
+    def release(self, base_url: str, model: str, load_duration_ns: Optional[int] = None) -> None:
+        """调用结束后更新使用时间，记录首次加载耗时"""
+        record = self._models.get((base_url, model))
+        if record is None:
+            return
+        record.active = max(0, record.active - 1)
+        record.last_used = time.time()
+        if record.load_seconds is None and load_duration_ns:
+            record.load_seconds = round(load_duration_ns / 1e9, 3)
+
+    def is_resident(self, base_url: str, model: str) -> bool:
+        """模型是否已在该实例上驻留"""
+        return (base_url, model) in self._models
+
+    def _idle_candidates(self, base_url: str) -> List[ResidentModel]:
+        """同一实例上没有进行中请求、也不在卸载中的模型，按最近最少使用排序"""
+        return [
+            record for record in self._models.values()
+            if record.base_url == base_url and record.active == 0 and not record.unloading
+        ]
+
+    @staticmethod
+    def _claim(record: ResidentModel) -> bool:
+        """标记为卸载中，有进行中的请求或已在卸载时返回False"""
+        if record.active > 0 or record.unloading:
+            return False
+        record.unloading = True
+        return True
+
+    def _lru_victims(self, base_url: str) -> List[ResidentModel]:
+        """切换到新模型时按LRU选出需要卸载的模型（在锁内调用，只修改状态）"""
+        loaded = [r for r in self._models.values() if r.base_url == base_url and not r.unloading]
+        candidates = self._idle_candidates(base_url)
+        victims = []
+        while len(loaded) >= self.config.max_loaded_models and candidates:
+            victim = candidates.pop(0)
+            self._claim(victim)
+            victims.append(victim)
+            loaded.remove(victim)
+        return victims
+
+    async def _relieve_memory(self, base_url: str) -> None:
+        """显存占用超过上限时逐个卸载空闲模型"""
+        while self.config.max_vram_mb and await self._under_memory_pressure(base_url):
+            async with self._get_lock(base_url):
+                candidates = self._idle_candidates(base_url)
+                victim = candidates[0] if candidates else None
+                if victim is not None:
+                    self._claim(victim)
+            if victim is None or not await self._unload(victim, "memory"):
+                return
+
+    async def _under_memory_pressure(self, base_url: str) -> bool:
+        """通过/api/ps检查显存占用是否超过上限"""
+        if not self.config.max_vram_mb:
+            return False
+        running = await self.list_running(base_url)
+        used_mb = sum(m.get("size_vram", 0) for m in running) / (1024 * 1024)
+        return used_mb > self.config.max_vram_mb
+
+    async def list_running(self, base_url: str) -> List[Dict[str, Any]]:
+        """获取Ollama实例上当前已加载的模型"""
+        try:
+            session = http_pool.get_session("ollama")
+            timeout = circuit_breakers.client_timeout("ollama", read=True)
+            async with session.get(f"{base_url}/api/ps", timeout=timeout) as response:
+                if response.status != 200:
+                    return []
+                data = await response.json()
+                return data.get("models", [])
+        except Exception as e:
+            print(f"获取已加载模型失败: {str(e)}")
+            return []
+
+    async def _unload(self, record: ResidentModel, reason: Optional[str] = None) -> bool:
+        """卸载已标记为卸载中的模型，成功且期间没有新请求时才删除记录"""
+        try:
+            unloaded = await self._send_unload(record.base_url, record.model)
+        finally:
+            record.unloading = False
+        if unloaded:
+            if reason is not None:
+                self.evictions[reason] = self.evictions.get(reason, 0) + 1
+            key = (record.base_url, record.model)
+            if record.active == 0 and self._models.get(key) is record:
+                del self._models[key]
+        return unloaded
+
+    async def unload_model(self, base_url: str, model: str) -> bool:
+        """通过keep_alive=0让Ollama立即卸载模型，有进行中请求的模型不卸载"""
+        record = self._models.get((base_url, model))
+        if record is None:
+            return await self._send_unload(base_url, model)
+        if not self._claim(record):
+            print(f"模型 {model} 有进行中的请求或正在卸载，暂不卸载")
+            return False
+        return await self._unload(record)
+
+    async def _send_unload(self, base_url: str, model: str) -> bool:
+        try:
+            session = http_pool.get_session("ollama")
+            payload = {"model": model, "keep_alive": 0}
+            timeout = circuit_breakers.client_timeout("ollama", read=True)
+            async with session.post(f"{base_url}/api/generate", json=payload, timeout=timeout) as response:
+                await response.read()
+                if response.status != 200:
+                    print(f"卸载模型 {model} 失败: Status {response.status}")
+                    return False
+                print(f"已卸载模型 {model}")
+                return True
+        except Exception as e:
+            print(f"卸载模型 {model} 时出错: {str(e)}")
+            return False
+
+    async def evict(self, model: str, base_url: Optional[str] = None) -> bool:
+        """手动卸载模型，有进行中请求的实例上不卸载（此时返回False）"""
+        records = [
+            r for r in self._models.values()
+            if r.model == model and (base_url is None or r.base_url == base_url)
+        ]
+        if not records:
+            return False
+        claimed = [record for record in records if self._claim(record)]
+        results = [await self._unload(record, "manual") for record in claimed]
+        return len(claimed) == len(records) and all(results)
+
+    async def sweep(self) -> None:
+        """卸载空闲超时的模型，并清理已被Ollama自行卸载的记录"""
+        now = time.time()
+        idle = [
+            record for record in list(self._models.values())
+            if record.active == 0 and now - record.last_used > self.config.idle_timeout and self._claim(record)
+        ]
+        for record in idle:
+            await self._unload(record, "idle")
+        for base_url in {r.base_url for r in self._models.values()}:
+            running = await self.list_running(base_url)
+            names = {m.get("name") or m.get("model") for m in running}
+            async with self._get_lock(base_url):
+                # 请求结果返回后重新检查，期间开始使用的模型保留
+                for record in list(self._models.values()):
+                    if record.base_url == base_url and record.active == 0 and not record.unloading \
+                            and record.model not in names:
+                        self._models.pop((base_url, record.model), None)
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.config.sweep_interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"模型空闲检查失败: {str(e)}")
+
+    def start(self) -> None:
+        """启动后台空闲检查任务"""
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self) -> None:
+        """停止后台空闲检查任务（不卸载模型，便于重启后继续使用）"""
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+
+    def get_state(self) -> Dict[str, Any]:
+        """获取当前驻留状态"""
+        now = time.time()
+        return {
+            "config": self.config.dict(),
+            "models": [
+                {
+                    **asdict(record),
+                    "idle_seconds": round(now - record.last_used, 1)
+                }
+                for record in self._models.values()
+            ],
+            "evictions": dict(self.evictions)
+        }
+
+
+# 全局驻留管理器实例
+ollama_residency = OllamaResidencyManager()
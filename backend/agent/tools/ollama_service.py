@@ -1,19 +1,30 @@
 import aiohttp
 import json
-from typing import List, Dict, Any, AsyncGenerator
-from langchain.llms.base import LLM
+from typing import List, Dict, Any, AsyncGenerator, Optional
+from ..llm_providers import BaseLLM, get_provider_config
 from pydantic import BaseModel, Field
+from ..http_pool import http_pool
+from .ollama_residency import ollama_residency
+from .ollama_pool import ollama_pool, pool_urls
+from .ollama_context import ollama_context
+from .ollama_session import ollama_sessions
+from ..stream_decoder import NDJSONDecoder, iter_stream_events, iter_stream_tokens
+from ..errors import ProviderAPIError
+from ..structured_output import structured_output, MODE_SCHEMA, MODE_JSON_OBJECT
+from ..reasoning_filter import reasoning_manager
+from ..circuit_breaker import circuit_breakers
 
 
 class OllamaConfig(BaseModel):
     """Ollama配置类"""
     base_url: str = Field(default="http://localhost:11434")
+    base_urls: List[str] = Field(default=[])  # 额外的Ollama实例，与base_url一起按负载分配请求
     model_name: str = Field(default="deepseek-r1:8b")
     temperature: float = Field(default=0.7)
     max_tokens: int = Field(default=1024)
 
 
-class OllamaLLM(LLM):
+class OllamaLLM(BaseLLM):
     """Ollama LLM实现类"""
     config: OllamaConfig = Field(default_factory=OllamaConfig)
 
@@ -27,147 +38,173 @@ class OllamaLLM(LLM):
         """返回LLM类型"""
         return "ollama"
 
-    @property
-    def _identifying_params(self) -> Dict[str, Any]:
-        """返回标识参数"""
-        return {
-            "model_name": self.config.model_name,
-            "base_url": self.config.base_url,
-            "temperature": self.config.temperature,
-            "max_tokens": self.config.max_tokens
-        }
-
     async def clear_gpu_memory(self) -> None:
         """清理Ollama模型的GPU显存"""
-        try:
-            url = f"{self.config.base_url}/api/generate"
-            payload = {
-                "model": self.config.model_name,
-                "keep_alive": 0
-            }
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=payload) as response:
-                    if response.status != 200:
-                        print(f"清理显存失败: Status {response.status}")
-                    else:
-                        print(f"已清理 {self.config.model_name} 的显存")
-        except Exception as e:
-            print(f"清理显存时出错: {str(e)}")
+        for base_url in pool_urls(self.config.dict()):
+            await ollama_residency.unload_model(base_url, self.config.model_name)
 
-    async def _call(
+    async def _reserve(self, prompt: str, **kwargs: Any) -> None:
+        """本地模型不限流"""
+        return None
+
+    async def _stream(
+        self,
+        prompt: str,
+        **kwargs: Any
+    ) -> AsyncGenerator[str, None]:
+        """调用Ollama API生成文本
+
+        模型通过keep_alive常驻，由驻留管理器决定何时卸载，
+        不再在每次生成前后清理显存。配置了多个实例时由ollama_pool选择实例。
+        """
+        async with ollama_pool.lease(pool_urls(self.config.dict()), self.config.model_name) as base_url:
+            stream = self._stream_from(base_url, prompt, **kwargs)
+            try:
+                async for token in stream:
+                    yield token
+            finally:
+                await stream.aclose()
+
+    async def _stream_from(
         self,
+        base_url: str,
         prompt: str,
         **kwargs: Any
     ) -> AsyncGenerator[str, None]:
-        """调用Ollama API生成文本"""
+        """向指定实例发起流式生成"""
+        model = self.config.model_name
+        load_duration = None
+        prompt_eval_count = None
+        generation = kwargs.get("generation")
+        profile = generation.profile if generation is not None else None
+        num_predict = profile.resolve_max_tokens(self.config.max_tokens) if profile else self.config.max_tokens
+        # 按提示词大小选择num_ctx档位，超过模型最大上下文时截断
+        prompt, num_ctx = await ollama_context.fit(base_url, model, prompt, num_predict)
+        await ollama_residency.acquire(base_url, model)
         try:
-            await self.clear_gpu_memory()
-            async with aiohttp.ClientSession() as session:
-                url = f"{self.config.base_url}/api/generate"
-                headers = {"Content-Type": "application/json"}
-                
-                payload = {
-                    "model": self.config.model_name,
-                    "prompt": prompt,
-                    "stream": True,
-                    "options": {
-                        "temperature": self.config.temperature,
-                        "num_predict": self.config.max_tokens,
-                    }
+            session = http_pool.get_session("ollama")
+            url = f"{base_url}/api/generate"
+            headers = {"Content-Type": "application/json"}
+            
+            payload = {
+                "model": model,
+                "prompt": prompt,
+                "stream": True,
+                "keep_alive": ollama_residency.keep_alive,
+                "options": {
+                    "temperature": profile.resolve_temperature(self.config.temperature) if profile else self.config.temperature,
+                    "num_predict": num_predict,
                 }
-                
-                print(f"发送请求: {url}")
-                print(f"使用模型: {payload['model']}")
-
+            }
+            if num_ctx is not None:
+                payload["options"]["num_ctx"] = num_ctx
+            
+            output_schema = kwargs.get("output_schema")
+            if output_schema:
+                mode = structured_output.provider_mode(self._llm_type, model)
+                if mode == MODE_SCHEMA:
+                    payload["format"] = output_schema["schema"]
+                elif mode == MODE_JSON_OBJECT:
+                    payload["format"] = "json"
+
+            reasoning = kwargs.get("reasoning")
+            think = reasoning_manager.think_option(reasoning)
+            if think is not None:
+                payload["think"] = think
+
+            print(f"发送请求: {url}")
+            print(f"使用模型: {payload['model']}")
+
+            while True:
                 async with session.post(
                     url,
                     json=payload,
-                    headers=headers
+                    headers=headers,
+                    timeout=circuit_breakers.client_timeout(self._llm_type)
                 ) as response:
                     if response.status != 200:
                         error_text = await response.text()
-                        raise ValueError(
-                            f"API错误 ({response.status}): {error_text}"
-                        )
-
-                    async for line in response.content:
-                        if not line:
-                            continue
-                            
-                        text = line.decode('utf-8')
-                        if text == "":
-                            continue
-                            
-                        try:
-                            data = json.loads(text)
-                            if "error" in data:
-                                raise RuntimeError(data["error"])
-                            if "response" in data:
-                                # 直接返回原始响应
-                                response = data["response"]
-                                if response != "":  # 仅用于检查非空
-                                    yield response  # 返回完整响应，包含换行符
-                        except json.JSONDecodeError:
-                            print(f"无效响应: {text[:100]}")
+                        if response.status == 400 and "think" in payload and "think" in error_text.lower():
+                            # 旧版服务或模型不支持思考开关，去掉参数重试
+                            reasoning_manager.think_unsupported(self._llm_type, model, error_text)
+                            del payload["think"]
                             continue
-
-            # 生成完成后清理显存
-            await self.clear_gpu_memory()
-        except Exception as e:
-            # 发生错误时也清理显存
-            await self.clear_gpu_memory()
-            raise e
+                        raise ProviderAPIError(response.status, error_text)
+
+                    def extract_token(data: Dict[str, Any]) -> Optional[str]:
+                        nonlocal load_duration, prompt_eval_count
+                        if "error" in data:
+                            raise ProviderAPIError(None, str(data["error"]))
+                        if reasoning is not None and data.get("thinking"):
+                            # 开启思考时推理内容在单独的thinking字段中
+                            reasoning.reasoning(data["thinking"])
+                        if data.get("done"):
+                            load_duration = data.get("load_duration")
+                            # 实际预填充的token数，命中KV缓存的前缀不计入
+                            prompt_eval_count = data.get("prompt_eval_count")
+                            if generation is not None:
+                                generation.observe(data.get("done_reason"))
+                        # 直接返回原始响应，包含换行符
+                        return data.get("response")
+
+                    async for token in iter_stream_tokens(
+                        response.content,
+                        NDJSONDecoder(),
+                        extract_token
+                    ):
+                        yield token
+                break
+            ollama_sessions.record(model, prompt, prompt_eval_count)
+        finally:
+            ollama_residency.release(base_url, model, load_duration)
 
 
 class OllamaService:
-    def __init__(self, base_url: str = "http://localhost:11434"):
+    def __init__(self, base_url: Optional[str] = None):
+        # 不指定地址时使用设置中的全部Ollama实例（base_url和base_urls）
         self.base_url = base_url
 
+    def urls(self) -> List[str]:
+        """服务使用的Ollama实例地址"""
+        if self.base_url:
+            return [self.base_url]
+        return pool_urls(get_provider_config("ollama") or {"base_url": "http://localhost:11434"})
+
     async def list_models(self) -> List[Dict[str, Any]]:
-        """获取本地安装的Ollama模型列表"""
-        try:
-            async with aiohttp.ClientSession() as session:
-                url = f"{self.base_url}/api/tags"
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        # 格式化模型信息
-                        return [
-                            {
-                                "id": model['name'],
-                                "name": model['name'],
-                                "type": "ollama",
-                                "description": (
-                                    f"Ollama - {model['name']}"
-                                ),
-                                "modified_at": model.get('modified_at', '')
-                            }
-                            for model in data.get('models', [])
-                        ]
-                    else:
-                        print(
-                            "Failed to get Ollama models: "
-                            f"Status {response.status}"
-                        )
-                        return []
-        except Exception as e:
-            print(f"Error connecting to Ollama service: {str(e)}")
-            return []
+        """获取各Ollama实例上安装的模型列表（按模型名合并，instances为安装了该模型的实例）"""
+        models: Dict[str, Dict[str, Any]] = {}
+        for base_url, entries in (await ollama_pool.list_tags(self.urls())).items():
+            for model in entries:
+                # 格式化模型信息
+                record = models.setdefault(model['name'], {
+                    "id": model['name'],
+                    "name": model['name'],
+                    "type": "ollama",
+                    "description": (
+                        f"Ollama - {model['name']}"
+                    ),
+                    "modified_at": model.get('modified_at', ''),
+                    "instances": []
+                })
+                record["instances"].append(base_url)
+        return list(models.values())
 
     async def get_model_info(self, model_name: str) -> Dict[str, Any]:
         """获取特定模型的详细信息"""
         try:
-            async with aiohttp.ClientSession() as session:
-                url = f"{self.base_url}/api/show/{model_name}"
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        return await response.json()
-                    else:
-                        print(
-                            "Failed to get model info: "
-                            f"Status {response.status}"
-                        )
-                        return {}
+            session = http_pool.get_session("ollama")
+            base_url = ollama_pool.pick(self.urls(), model_name)
+            url = f"{base_url}/api/show"
+            timeout = circuit_breakers.client_timeout("ollama", read=True)
+            async with session.post(url, json={"model": model_name, "name": model_name}, timeout=timeout) as response:
+                if response.status == 200:
+                    return await response.json()
+                else:
+                    print(
+                        "Failed to get model info: "
+                        f"Status {response.status}"
+                    )
+                    return {}
         except Exception as e:
             print(f"Error getting model info: {str(e)}")
             return {}
@@ -187,20 +224,25 @@ class OllamaService:
             如果stream=False，返回完整的响应
             如果stream=True，返回一个异步生成器，用于流式输出
         """
-        try:
-            url = f"{self.base_url}/api/chat"
-            payload = {
-                "model": model,
-                "messages": messages,
-                "stream": stream,
-                "options": {
-                    "temperature": temperature,
-                    "num_predict": max_tokens
+        # 配置了多个实例时由ollama_pool选择实例
+        async with ollama_pool.lease(self.urls(), model) as base_url:
+            await ollama_residency.acquire(base_url, model)
+            try:
+                url = f"{base_url}/api/chat"
+                payload = {
+                    "model": model,
+                    "messages": messages,
+                    "stream": stream,
+                    "keep_alive": ollama_residency.keep_alive,
+                    "options": {
+                        "temperature": temperature,
+                        "num_predict": max_tokens
+                    }
                 }
-            }
 
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=payload) as response:
+                session = http_pool.get_session("ollama")
+                timeout = circuit_breakers.client_timeout("ollama", read=True)
+                async with session.post(url, json=payload, timeout=timeout) as response:
                     if response.status != 200:
                         error_msg = f"Chat request failed: Status {response.status}"
                         print(error_msg)
@@ -208,40 +250,23 @@ class OllamaService:
                         return
 
                     if stream:
-                        async for line in response.content:
-                            if line:
-                                try:
-                                    data = json.loads(line)
-                                    yield data
-                                except json.JSONDecodeError as e:
-                                    print(f"Error parsing stream data: {str(e)}")
+                        async for data in iter_stream_events(response.content, NDJSONDecoder()):
+                            yield data
                     else:
                         data = await response.json()
                         yield data
 
-            # 对话完成后清理显存
-            await self.clear_gpu_memory(model)
-
-        except Exception as e:
-            error_msg = f"Error in chat: {str(e)}"
-            print(error_msg)
-            yield {"error": error_msg}
-            # 发生错误时也清理显存
-            await self.clear_gpu_memory(model)
+            except Exception as e:
+                error_msg = f"Error in chat: {str(e)}"
+                print(error_msg)
+                yield {"error": error_msg}
+            finally:
+                ollama_residency.release(base_url, model)
 
     async def clear_gpu_memory(self, model: str) -> None:
         """清理指定模型的GPU显存"""
-        try:
-            url = f"{self.base_url}/api/show"
-            payload = {"name": model}
-            async with aiohttp.ClientSession() as session:
-                async with session.delete(url, json=payload) as response:
-                    if response.status != 200:
-                        print(f"清理显存失败: Status {response.status}")
-                    else:
-                        print(f"已清理 {model} 的显存")
-        except Exception as e:
-            print(f"清理显存时出错: {str(e)}")
+        for base_url in self.urls():
+            await ollama_residency.unload_model(base_url, model)
 
     async def generate(self, model: str, prompt: str, stream: bool = False,
                       temperature: float = 0.7, max_tokens: int = 2000) -> AsyncGenerator[Dict[str, Any], None]:
@@ -258,20 +283,25 @@ class OllamaService:
             如果stream=False，返回完整的响应
             如果stream=True，返回一个异步生成器，用于流式输出
         """
-        try:
-            url = f"{self.base_url}/api/generate"
-            payload = {
-                "model": model,
-                "prompt": prompt,
-                "stream": stream,
-                "options": {
-                    "temperature": temperature,
-                    "num_predict": max_tokens
+        # 配置了多个实例时由ollama_pool选择实例
+        async with ollama_pool.lease(self.urls(), model) as base_url:
+            await ollama_residency.acquire(base_url, model)
+            try:
+                url = f"{base_url}/api/generate"
+                payload = {
+                    "model": model,
+                    "prompt": prompt,
+                    "stream": stream,
+                    "keep_alive": ollama_residency.keep_alive,
+                    "options": {
+                        "temperature": temperature,
+                        "num_predict": max_tokens
+                    }
                 }
-            }
 
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=payload) as response:
+                session = http_pool.get_session("ollama")
+                timeout = circuit_breakers.client_timeout("ollama", read=True)
+                async with session.post(url, json=payload, timeout=timeout) as response:
                     if response.status != 200:
                         error_msg = f"Generate request failed: Status {response.status}"
                         print(error_msg)
@@ -279,26 +309,18 @@ class OllamaService:
                         return
 
                     if stream:
-                        async for line in response.content:
-                            if line:
-                                try:
-                                    data = json.loads(line)
-                                    yield data
-                                except json.JSONDecodeError as e:
-                                    print(f"Error parsing stream data: {str(e)}")
+                        async for data in iter_stream_events(response.content, NDJSONDecoder()):
+                            yield data
                     else:
                         data = await response.json()
                         yield data
 
-            # 生成完成后清理显存
-            await self.clear_gpu_memory(model)
-
-        except Exception as e:
-            error_msg = f"Error in generate: {str(e)}"
-            print(error_msg)
-            yield {"error": error_msg}
-            # 发生错误时也清理显存
-            await self.clear_gpu_memory(model)
+            except Exception as e:
+                error_msg = f"Error in generate: {str(e)}"
+                print(error_msg)
+                yield {"error": error_msg}
+            finally:
+                ollama_residency.release(base_url, model)
 
 
 # 创建服务实例
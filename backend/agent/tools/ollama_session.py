@@ -0,0 +1,147 @@
+"""
+Ollama前缀复用会话
+
+一次教程生成中的几十次小节生成共用同一段提示词前缀（规则模板、主题和完整目录），
+只有末尾的小节信息不同。Ollama的推理进程会保留上一次请求的KV缓存，新请求与其
+前缀相同的部分不再预填充，只计算差异部分。会话负责：
+- 标记一次教程生成，统计其中每次调用实际预填充的token数（Ollama返回的prompt_eval_count）
+- 按字符类型估算每次调用完整提示词的token数（estimate_tokens）；实际预填充明显少于估算
+  （低于reuse_threshold倍）的调用才算复用了前缀，两者之差即为节省的预填充token。
+  估算与实际分词器的正常偏差（不同模板、中英文混排）不会被算作节省
+- 几次调用后仍没有明显少于估算的调用时，判定当前模型/服务不支持前缀复用并给出提示
+不支持前缀复用的模型、其他提供商或未返回prompt_eval_count的旧版服务不受影响，生成照常进行。
+配置在settings/user_settings.json的global.ollama_session中。
+"""
+import contextvars
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from pydantic import BaseModel, Field
+from ..metrics import llm_prefill_tokens
+from ..tokens import estimate_tokens
+
+# 当前调用所属的会话
+_current_session: contextvars.ContextVar = contextvars.ContextVar("ollama_session", default=None)
+
+
+class SessionConfig(BaseModel):
+    """前缀复用会话配置"""
+    enabled: bool = True
+    probe_calls: int = Field(default=3, ge=2)  # 判断是否支持前缀复用所需的调用次数
+    reuse_threshold: float = Field(default=0.5, gt=0, lt=1)  # 实际预填充低于估算的多少倍才算复用了前缀
+    history: int = Field(default=20, ge=0)  # 保留最近多少个会话的统计
+
+
+@dataclass
+class OllamaSession:
+    """一次教程生成的前缀复用统计"""
+    name: str
+    started: float
+    reuse_threshold: float = 0.5
+    calls: List[Tuple[int, int]] = field(default_factory=list)  # (估算的提示词token数, 实际预填充token数)
+    finished: Optional[float] = None
+    supported: Optional[bool] = None  # None表示尚未判定
+    token: Any = None
+
+    def record(self, estimated: int, evaluated: int, probe_calls: int) -> None:
+        self.calls.append((estimated, evaluated))
+        if self.supported is None and len(self.calls) >= probe_calls:
+            self.supported = self.saved_tokens() > 0
+
+    def _saved(self, estimated: int, evaluated: int) -> int:
+        """单次调用节省的预填充token，没有明显少于估算时为0"""
+        if evaluated < estimated * self.reuse_threshold:
+            return estimated - evaluated
+        return 0
+
+    def prompt_tokens(self) -> int:
+        """估算的完整提示词token数"""
+        return sum(estimated for estimated, _ in self.calls)
+
+    def evaluated_tokens(self) -> int:
+        return sum(evaluated for _, evaluated in self.calls)
+
+    def saved_tokens(self) -> int:
+        return sum(self._saved(estimated, evaluated) for estimated, evaluated in self.calls)
+
+    def summary(self) -> Dict[str, Any]:
+        prompt_tokens = self.prompt_tokens()
+        saved = self.saved_tokens()
+        return {
+            "name": self.name,
+            "calls": len(self.calls),
+            "prompt_tokens": prompt_tokens,
+            "prefilled_tokens": self.evaluated_tokens(),
+            "saved_tokens": saved,
+            "saved_ratio": round(saved / prompt_tokens, 4) if prompt_tokens else 0.0,
+            "supported": self.supported,
+            "duration": round((self.finished or time.time()) - self.started, 1)
+        }
+
+
+class OllamaSessionManager:
+    """管理进行中和最近结束的前缀复用会话"""
+
+    def __init__(self, config: Optional[SessionConfig] = None):
+        self.config = config or SessionConfig()
+        self._active: Dict[int, OllamaSession] = {}
+        self._history: Deque[Dict[str, Any]] = deque(maxlen=self.config.history)
+
+    def configure(self, config: Optional[Dict[str, Any]] = None) -> None:
+        self.config = SessionConfig(**(config or {}))
+        self._history = deque(self._history, maxlen=self.config.history)
+
+    def begin(self, name: str) -> Optional[OllamaSession]:
+        """开始一个会话，之后当前上下文中的Ollama调用都计入该会话"""
+        if not self.config.enabled:
+            return None
+        session = OllamaSession(name=name, started=time.time(), reuse_threshold=self.config.reuse_threshold)
+        session.token = _current_session.set(session)
+        self._active[id(session)] = session
+        return session
+
+    def end(self, session: Optional[OllamaSession]) -> None:
+        """结束会话并输出节省的预填充token数"""
+        if session is None or self._active.pop(id(session), None) is None:
+            return
+        try:
+            _current_session.reset(session.token)
+        except ValueError:
+            # 生成器在其他上下文中被关闭，上下文变量随原上下文一起失效
+            pass
+        session.finished = time.time()
+        summary = session.summary()
+        self._history.append(summary)
+        if summary["saved_tokens"]:
+            llm_prefill_tokens.inc(summary["saved_tokens"], kind="reused")
+        if summary["calls"]:
+            print(
+                f"会话 {session.name} 共 {summary['calls']} 次调用，"
+                f"复用前缀节省预填充 {summary['saved_tokens']}/{summary['prompt_tokens']} tokens"
+            )
+
+    def current(self) -> Optional[OllamaSession]:
+        return _current_session.get()
+
+    def record(self, model: str, prompt: str, evaluated: Optional[int]) -> None:
+        """记录一次Ollama调用实际预填充的token数"""
+        session = self.current()
+        if session is None or evaluated is None:
+            return
+        session.record(estimate_tokens(prompt), evaluated, self.config.probe_calls)
+        llm_prefill_tokens.inc(evaluated, kind="evaluated")
+        if session.supported is False and len(session.calls) == self.config.probe_calls:
+            print(f"模型 {model} 未复用提示词前缀，会话 {session.name} 按普通调用继续")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取进行中和最近结束的会话统计"""
+        return {
+            "enabled": self.config.enabled,
+            "active": [session.summary() for session in self._active.values()],
+            "recent": list(self._history)
+        }
+
+
+# 全局会话管理器
+ollama_sessions = OllamaSessionManager()
@@ -1,6 +1,8 @@
 from typing import List, Dict, Any
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from langchain.llms.base import BaseLLM
+from ..errors import AdmissionRejected
+from ..structured_output import StructuredSpec, structured_output
 import re
 import uuid
 from typing import Optional
@@ -14,6 +16,26 @@ class Resource(BaseModel):
     url: str  # 资源链接
     difficulty: int  # 1-5表示难度等级
 
+class ResourceItem(BaseModel):
+    """结构化输出中的一个资源"""
+    title: str
+    description: str
+    type: str = Field(description="资源类型：视频、文章、教程等")
+    url: str
+    difficulty: int = Field(ge=1, le=5, description="难度等级1-5")
+
+
+RESOURCE_OUTPUT = StructuredSpec(
+    name="resources_search",
+    model=ResourceItem,
+    items_key="resources",
+    convert=lambda items: [
+        Resource(id=str(uuid.uuid4()), **{**item.dict(), "url": item.url.replace('`', '')})
+        for item in items
+    ]
+)
+
+
 class ResourceSearcher:
     """学习资源搜索器"""
     def __init__(self, llm: BaseLLM):
@@ -49,57 +71,64 @@ class ResourceSearcher:
         """
         
         try:
-            # 获取LLM响应
-            result = []
-            async for chunk in self.llm._call(prompt):
-                result.append(chunk)
-            result = ''.join(result)
+            # 优先请求结构化输出，无效时按<...|...>格式解析
+            resources = await structured_output.generate(
+                self.llm,
+                RESOURCE_OUTPUT,
+                prompt,
+                self._parse_resources
+            )
+            return resources or []
             
-            # 使用更严格的正则表达式匹配
-            pattern = r'<([^>]+)>'
-            matches = re.finditer(pattern, result)
+        except AdmissionRejected:
+            raise
+        except Exception as e:
+            raise ValueError(f"搜索资源失败：{str(e)}")
+
+    def _parse_resources(self, result: str) -> List[Resource]:
+        """解析<标题|描述|类型|URL|难度>格式的输出"""
+        # 使用更严格的正则表达式匹配
+        pattern = r'<([^>]+)>'
+        matches = re.finditer(pattern, result)
+        
+        resources = []
+        for match in matches:
+            resource_str = match.group(1).strip()
             
-            resources = []
-            for match in matches:
-                resource_str = match.group(1).strip()
+            try:
+                # 分割并验证字段
+                parts = [part.strip() for part in resource_str.split('|')]
                 
-                try:
-                    # 分割并验证字段
-                    parts = [part.strip() for part in resource_str.split('|')]
+                if len(parts) != 5:
+                    continue
                     
-                    if len(parts) != 5:
-                        continue
-                        
-                    title, description, res_type, url, difficulty_str = parts
+                title, description, res_type, url, difficulty_str = parts
+                
+                # 验证必填字段
+                if not all([title, description, res_type, url, difficulty_str]):
+                    continue
                     
-                    # 验证必填字段
-                    if not all([title, description, res_type, url, difficulty_str]):
-                        continue
-                        
-                    # 验证难度值
-                    try:
-                        difficulty_val = int(difficulty_str)
-                        if not 1 <= difficulty_val <= 5:
-                            continue
-                    except ValueError:
+                # 验证难度值
+                try:
+                    difficulty_val = int(difficulty_str)
+                    if not 1 <= difficulty_val <= 5:
                         continue
-                    
-                    # 创建资源对象
-                    resource = Resource(
-                        id=str(uuid.uuid4()),
-                        title=title,
-                        description=description,
-                        type=res_type,
-                        url=url.replace('`', ''),  # 清理URL中的反引号
-                        difficulty=difficulty_val
-                    )
-                    resources.append(resource)
-                    
-                except (ValueError, IndexError) as e:
-                    # 记录具体错误但继续处理
-                    print(f"解析资源失败: {str(e)}，资源字符串: {resource_str}")
+                except ValueError:
                     continue
-            return resources
-            
-        except Exception as e:
-            raise ValueError(f"搜索资源失败：{str(e)}")
\ No newline at end of file
+                
+                # 创建资源对象
+                resource = Resource(
+                    id=str(uuid.uuid4()),
+                    title=title,
+                    description=description,
+                    type=res_type,
+                    url=url.replace('`', ''),  # 清理URL中的反引号
+                    difficulty=difficulty_val
+                )
+                resources.append(resource)
+                
+            except (ValueError, IndexError) as e:
+                # 记录具体错误但继续处理
+                print(f"解析资源失败: {str(e)}，资源字符串: {resource_str}")
+                continue
+        return resources
@@ -1,6 +1,8 @@
 from typing import Dict, Any, List
 from pydantic import BaseModel
 from langchain.llms.base import BaseLLM
+from ..errors import AdmissionRejected
+from ..single_flight import single_flight
 
 class SimulationComponent(BaseModel):
     """仿真组件数据模型"""
@@ -22,6 +24,7 @@ class SimulationBuilder:
     def __init__(self, llm: BaseLLM):
         self.llm = llm
 
+    @single_flight("simulation")
     async def create_simulation(self, topic: str) -> SimulationEnvironment:
         """创建仿真环境"""
         prompt = f"""请为以下主题创建一个基于HTML5 Canvas的仿真环境：
@@ -136,7 +139,7 @@ class SimulationBuilder:
             # 生成主要的仿真代码
             print(prompt)
             output = []
-            async for chunk in self.llm._call(prompt):
+            async for chunk in self.llm._call(prompt, task="simulation"):
                 output.append(chunk)
                 print(chunk,end="")
             simulation_code = ''.join(output)
@@ -161,6 +164,8 @@ class SimulationBuilder:
                 return simulation
             except Exception as e:
                 raise ValueError(f"创建SimulationEnvironment实例失败: {str(e)}")
+        except AdmissionRejected:
+            raise
         except Exception as e:
             raise ValueError(f"创建仿真环境失败：{str(e)}")
     
@@ -176,11 +181,11 @@ class SimulationBuilder:
         """
         import re
         
-        # 构建正则表达式模式
+        # 构建正则表达式模式，输出在停止序列处结束时代码块可能没有结尾的```
         if language:
-            pattern = f"```{language}\\n([\\s\\S]*?)\\n```"
+            pattern = f"```{language}\\n([\\s\\S]*?)(?:\\n```|$)"
         else:
-            pattern = "```([\\s\\S]*?)```"
+            pattern = "```([\\s\\S]*?)(?:```|$)"
             
         # 查找匹配的代码块
         match = re.search(pattern, text)
@@ -3,6 +3,7 @@ import json
 from datetime import datetime
 from typing import List, Dict, Any
 import sys
+from ..metrics import storage_duration, timed
 
 class TutorialManager:
     def __init__(self, save_dir: str = None):
@@ -10,6 +11,7 @@ class TutorialManager:
         self.save_dir = 'Saves'
         os.makedirs(self.save_dir, exist_ok=True)
 
+    @timed(storage_duration, manager="tutorial", operation="save")
     def save_tutorial(self, tutorial_data: Dict[str, Any]) -> str:
         """保存教程到文件"""
         try:
@@ -34,6 +36,7 @@ class TutorialManager:
         except Exception as e:
             raise Exception(f"Failed to save tutorial: {str(e)}")
 
+    @timed(storage_duration, manager="tutorial", operation="list")
     def get_tutorial_list(self) -> List[Dict[str, Any]]:
         """获取所有保存的教程列表"""
         tutorials = []
@@ -98,6 +101,7 @@ class TutorialManager:
 
         return tree
 
+    @timed(storage_duration, manager="tutorial", operation="load")
     def get_tutorial(self, tutorial_id: str) -> Dict[str, Any]:
         """获取指定教程的完整内容"""
         try:
@@ -112,6 +116,7 @@ class TutorialManager:
         except Exception as e:
             raise Exception(f"Failed to get tutorial: {str(e)}")
 
+    @timed(storage_duration, manager="tutorial", operation="delete")
     def delete_tutorial(self, tutorial_id: str) -> bool:
         """删除指定的教程"""
         try:
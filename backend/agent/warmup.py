@@ -0,0 +1,170 @@
+"""
+启动预热与就绪检查
+
+在FastAPI启动阶段预先加载默认提供商的模型：
+- Ollama：向每个健康且已安装该模型的实例发送一次极小的生成请求，把模型加载进显存
+- 远程提供商：探测一次API连通性，顺带建立连接池中的连接
+预热完成前/ready返回503，负载均衡器只会把流量路由到已预热的实例。
+"""
+import asyncio
+import time
+from typing import Dict, Any, Optional
+from pydantic import BaseModel, Field
+from .http_pool import http_pool
+from .tools.ollama_residency import ollama_residency
+from .tools.ollama_context import ollama_context
+from .tools.ollama_pool import ollama_pool, pool_urls
+
+
+class WarmupConfig(BaseModel):
+    """预热配置"""
+    enabled: bool = True
+    retry_interval: float = Field(default=10.0, gt=0)  # 预热失败后的重试间隔（秒）
+    max_attempts: int = Field(default=0, ge=0)  # 最大尝试次数，0表示一直重试直到成功
+    timeout: float = Field(default=300.0, gt=0)  # 单次预热超时（秒），需覆盖模型冷加载时间
+
+
+class ModelWarmer:
+    """模型预热器，同时维护实例的就绪状态"""
+
+    def __init__(self, config: Optional[WarmupConfig] = None):
+        self.config = config or WarmupConfig()
+        self.status = "pending"  # pending/warming/ready/failed/disabled
+        self.provider: Optional[str] = None
+        self.model: Optional[str] = None
+        self.attempts = 0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.cold_load_seconds: Optional[float] = None  # 预热总耗时（连接+模型加载）
+        self.model_load_seconds: Optional[float] = None  # Ollama报告的模型加载耗时
+        self.error: Optional[str] = None
+
+    def configure(self, config: Optional[Dict[str, Any]] = None) -> None:
+        self.config = WarmupConfig(**(config or {}))
+
+    @property
+    def ready(self) -> bool:
+        return self.status in ("ready", "disabled")
+
+    async def _warm_ollama(self, llm) -> None:
+        """在各Ollama实例上加载模型，至少一个实例成功即视为完成"""
+        model = llm.config.model_name
+        instances = ollama_pool.register(pool_urls(llm.config.dict()))
+        if len(instances) > 1:
+            # 先探测健康状态和已安装的模型，只预热本次探测成功且已安装该模型的实例
+            await ollama_pool.probe_all()
+            instances = [
+                instance for instance in instances
+                if instance.healthy and instance.failures == 0 and instance.models is not None and instance.has_model(model)
+            ] or instances
+        results = await asyncio.gather(
+            *[self._warm_instance(instance.base_url, model) for instance in instances],
+            return_exceptions=True
+        )
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if len(errors) == len(results):
+            raise errors[0]
+        for instance, result in zip(instances, results):
+            if isinstance(result, BaseException):
+                print(f"Ollama实例 {instance.base_url} 预热失败: {str(result) or result.__class__.__name__}")
+        loads = [result for result in results if isinstance(result, (int, float))]
+        if loads:
+            self.model_load_seconds = round(max(loads) / 1e9, 3)
+
+    async def _warm_instance(self, base_url: str, model: str) -> Optional[int]:
+        """发送一次极小的生成请求，让Ollama加载模型，返回Ollama报告的加载耗时（纳秒）"""
+        load_duration = None
+        # 按之后实际调用会用到的num_ctx档位加载，否则首个请求改变num_ctx时Ollama会重新加载模型
+        num_ctx = await ollama_context.warmup(base_url, model)
+        await ollama_residency.acquire(base_url, model)
+        try:
+            session = http_pool.get_session("ollama")
+            payload = {
+                "model": model,
+                "prompt": "hi",
+                "stream": False,
+                "keep_alive": ollama_residency.keep_alive,
+                "options": {"num_predict": 1}
+            }
+            if num_ctx is not None:
+                payload["options"]["num_ctx"] = num_ctx
+            async with session.post(f"{base_url}/api/generate", json=payload) as response:
+                if response.status != 200:
+                    error_text = await response.text()
+                    raise ValueError(f"模型预热失败 ({response.status}): {error_text}")
+                data = await response.json()
+                load_duration = data.get("load_duration")
+        finally:
+            ollama_residency.release(base_url, model, load_duration)
+        return load_duration
+
+    async def _probe_remote(self, llm) -> None:
+        """探测远程提供商的API连通性"""
+        session = http_pool.get_session(llm._llm_type)
+        url = f"{llm.config.base_url}/models"
+        async with session.get(url, headers=llm._get_headers()) as response:
+            await response.read()
+            # 部分代理未实现/models，能返回404说明连接本身可用
+            if response.status >= 400 and response.status != 404:
+                raise ValueError(f"提供商连通性探测失败: Status {response.status}")
+
+    async def warm_up(self, llm) -> None:
+        """执行一次预热"""
+        self.provider = llm._llm_type
+        self.model = llm.config.model_name
+        self.attempts += 1
+        self.status = "warming"
+        start = time.perf_counter()
+        if self.provider == "ollama":
+            await asyncio.wait_for(self._warm_ollama(llm), timeout=self.config.timeout)
+        else:
+            await asyncio.wait_for(self._probe_remote(llm), timeout=self.config.timeout)
+        self.cold_load_seconds = round(time.perf_counter() - start, 3)
+
+    async def run(self, llm) -> None:
+        """预热直到成功（或达到最大尝试次数），之后实例变为就绪"""
+        if not self.config.enabled:
+            self.status = "disabled"
+            return
+        self.started_at = time.time()
+        while True:
+            try:
+                await self.warm_up(llm)
+                self.status = "ready"
+                self.error = None
+                self.finished_at = time.time()
+                print(
+                    f"模型预热完成: {self.provider}/{self.model}，"
+                    f"耗时 {self.cold_load_seconds}s"
+                )
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.error = str(e) or e.__class__.__name__
+                print(f"模型预热失败（第{self.attempts}次）: {self.error}")
+                if self.config.max_attempts and self.attempts >= self.config.max_attempts:
+                    self.status = "failed"
+                    self.finished_at = time.time()
+                    return
+                self.status = "pending"
+                await asyncio.sleep(self.config.retry_interval)
+
+    def get_state(self) -> Dict[str, Any]:
+        """获取预热与就绪状态"""
+        return {
+            "ready": self.ready,
+            "status": self.status,
+            "provider": self.provider,
+            "model": self.model,
+            "attempts": self.attempts,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "cold_load_seconds": self.cold_load_seconds,
+            "model_load_seconds": self.model_load_seconds,
+            "error": self.error
+        }
+
+
+# 全局预热器实例
+model_warmer = ModelWarmer()
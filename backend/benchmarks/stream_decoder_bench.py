@@ -0,0 +1,181 @@
+"""
+流式解码器微基准
+
+模拟大量并发的提供商流式响应（SSE和NDJSON），每个响应被随机切分成
+TCP读取大小的字节块，比较：
+- raw：只遍历字节块、不做解码（基线，衡量调度本身的开销）
+- legacy：旧实现的逐行decode + json.loads
+- decoder：agent.stream_decoder的增量解码器
+
+输出每种方式的tokens/sec以及相对基线的每token解码开销。
+
+用法（在backend目录下运行）：
+    python benchmarks/stream_decoder_bench.py --streams 1000 --tokens 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agent.stream_decoder import (  # noqa: E402
+    JSON_BACKEND,
+    NDJSONDecoder,
+    SSEDecoder,
+    iter_stream_tokens
+)
+
+
+class FakeContent:
+    """模拟aiohttp响应体：iter_any按网络读取返回字节块，异步迭代按行返回"""
+
+    def __init__(self, chunks: List[bytes]):
+        self.chunks = chunks
+
+    async def iter_any(self):
+        for chunk in self.chunks:
+            await asyncio.sleep(0)
+            yield chunk
+
+    async def __aiter__(self):
+        pending = b""
+        for chunk in self.chunks:
+            await asyncio.sleep(0)
+            pending += chunk
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                yield line + b"\n"
+        if pending:
+            yield pending
+
+
+def build_body(fmt: str, tokens: int) -> bytes:
+    words = [f"词{i} token{i} " for i in range(tokens)]
+    if fmt == "sse":
+        events = [
+            b"data: " + json.dumps(
+                {"choices": [{"delta": {"content": word}}]},
+                ensure_ascii=False
+            ).encode("utf-8") + b"\n\n"
+            for word in words
+        ]
+        events.append(b"data: [DONE]\n\n")
+    else:
+        events = [
+            json.dumps({"model": "bench", "response": word, "done": False},
+                       ensure_ascii=False).encode("utf-8") + b"\n"
+            for word in words
+        ]
+        events.append(b'{"model": "bench", "response": "", "done": true}\n')
+    return b"".join(events)
+
+
+def split_body(body: bytes, rng: random.Random, min_read: int, max_read: int) -> List[bytes]:
+    chunks = []
+    i = 0
+    while i < len(body):
+        size = rng.randint(min_read, max_read)
+        chunks.append(body[i:i + size])
+        i += size
+    return chunks
+
+
+def extract_sse(data):
+    choices = data.get("choices")
+    if choices:
+        return choices[0].get("delta", {}).get("content")
+    return None
+
+
+def extract_ndjson(data):
+    return data.get("response")
+
+
+async def consume_raw(content: FakeContent) -> int:
+    count = 0
+    async for chunk in content.iter_any():
+        count += chunk.count(b"\n")
+    return count
+
+
+async def consume_legacy(content: FakeContent, fmt: str) -> int:
+    count = 0
+    async for line in content:
+        if not line:
+            continue
+        text = line.decode("utf-8").strip()
+        if fmt == "sse":
+            if text.startswith("data: "):
+                text = text[6:]
+            if text == "[DONE]":
+                break
+        try:
+            data = json.loads(text)
+        except json.JSONDecodeError:
+            continue
+        token = extract_sse(data) if fmt == "sse" else extract_ndjson(data)
+        if token:
+            count += 1
+    return count
+
+
+async def consume_decoder(content: FakeContent, fmt: str) -> int:
+    decoder = SSEDecoder() if fmt == "sse" else NDJSONDecoder()
+    extract = extract_sse if fmt == "sse" else extract_ndjson
+    count = 0
+    async for _ in iter_stream_tokens(content, decoder, extract):
+        count += 1
+    return count
+
+
+async def run_mode(mode: str, fmt: str, bodies: List[List[bytes]]) -> Dict[str, float]:
+    contents = [FakeContent(chunks) for chunks in bodies]
+    if mode == "raw":
+        coros = [consume_raw(c) for c in contents]
+    elif mode == "legacy":
+        coros = [consume_legacy(c, fmt) for c in contents]
+    else:
+        coros = [consume_decoder(c, fmt) for c in contents]
+    start = time.perf_counter()
+    counts = await asyncio.gather(*coros)
+    elapsed = time.perf_counter() - start
+    tokens = sum(counts)
+    return {"tokens": tokens, "seconds": elapsed, "tokens_per_sec": tokens / elapsed}
+
+
+async def main(args) -> None:
+    rng = random.Random(args.seed)
+    print(f"JSON后端: {JSON_BACKEND}")
+    print(f"并发流: {args.streams}，每流token: {args.tokens}，"
+          f"读取大小: {args.min_read}-{args.max_read}字节\n")
+    for fmt in ("sse", "ndjson"):
+        body = build_body(fmt, args.tokens)
+        bodies = [split_body(body, rng, args.min_read, args.max_read) for _ in range(args.streams)]
+        results = {}
+        for mode in ("raw", "legacy", "decoder"):
+            results[mode] = await run_mode(mode, fmt, bodies)
+        total_tokens = args.streams * args.tokens
+        print(f"[{fmt}]")
+        for mode in ("raw", "legacy", "decoder"):
+            r = results[mode]
+            overhead = (r["seconds"] - results["raw"]["seconds"]) / total_tokens * 1e6
+            line = f"  {mode:<8} {r['tokens_per_sec']:>14,.0f} tokens/s  {r['seconds']:.3f}s"
+            if mode != "raw":
+                line += f"  解码开销 {overhead:.2f}µs/token"
+            print(line)
+        print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="流式解码器微基准")
+    parser.add_argument("--streams", type=int, default=1000, help="并发流数量")
+    parser.add_argument("--tokens", type=int, default=200, help="每个流的token数")
+    parser.add_argument("--min-read", type=int, default=16, help="单次读取最小字节数")
+    parser.add_argument("--max-read", type=int, default=512, help="单次读取最大字节数")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
@@ -1,15 +1,23 @@
 import os
 import sys
 import json
+import asyncio
+import math
 import traceback
+from contextlib import asynccontextmanager
 from typing import Dict, Any, Optional,List
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.exceptions import RequestValidationError
 from pydantic import BaseModel
 from fastapi.staticfiles import StaticFiles
-from tenacity import retry, stop_after_attempt, wait_exponential
+from tenacity import (
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_exponential
+)
 
 
 # 导入本地模块
@@ -21,6 +29,34 @@ from agent import (  # noqa: E402
 )
 from tree import learning_tree_instance  # noqa: E402
 from agent.tools.ollama_service import ollama_service  # noqa: E402
+from agent.http_pool import http_pool  # noqa: E402
+from agent.tools.ollama_residency import ollama_residency  # noqa: E402
+from agent.tools.ollama_pool import ollama_pool, pool_urls  # noqa: E402
+from agent.tools.ollama_context import ollama_context  # noqa: E402
+from agent.tools.ollama_session import ollama_sessions  # noqa: E402
+from agent.warmup import model_warmer  # noqa: E402
+from agent.admission import admission_controller  # noqa: E402
+from agent.rate_limiter import rate_limiter  # noqa: E402
+from agent.retry_policy import retry_policy  # noqa: E402
+from agent.latency import ttft_tracker  # noqa: E402
+from agent.response_cache import response_cache, cache_scope  # noqa: E402
+from agent.fuzzy_cache import fuzzy_cache  # noqa: E402
+from agent.single_flight import single_flight_group  # noqa: E402
+from agent.metrics import metrics_registry  # noqa: E402
+from agent.batch_jobs import batch_jobs  # noqa: E402
+from agent.structured_output import structured_output  # noqa: E402
+from agent.generation_profiles import generation_profiles  # noqa: E402
+from agent.cancellation import cancellation  # noqa: E402
+from agent.reasoning_filter import reasoning_manager  # noqa: E402
+from agent.llm_registry import llm_registry  # noqa: E402
+from agent.micro_batcher import micro_batcher  # noqa: E402
+from agent.circuit_breaker import circuit_breakers  # noqa: E402
+from agent.adaptive_concurrency import adaptive_concurrency  # noqa: E402
+from agent.errors import AdmissionRejected  # noqa: E402
+from agent.llm_providers import (  # noqa: E402
+    get_user_settings as load_provider_settings,
+    get_settings_section
+)
 from settings_manager import settings_manager  # noqa: E402
 from agent.tools.knowledge_graph_generator import (  # noqa: E402
     KnowledgeGraphGenerator
@@ -34,21 +70,88 @@ from agent.tools.resource_searcher import ResourceSearcher  # noqa: E402
 from agent.tools.concept_analyzer import ConceptAnalyzer  # noqa: E402
 from agent.tools.simulation_builder import SimulationBuilder  # noqa: E402
 
-# 初始化组件
-knowledge_graph_generator = KnowledgeGraphGenerator(langchain_agent.llm)
+# 初始化组件（LLM工具按请求的模型从llm_registry取用，见get_tool）
 knowledge_graph_manager = KnowledgeGraphManager()
 tutorial_manager = TutorialManager()
-exercise_generator = ExerciseGenerator(langchain_agent.llm)
-resource_searcher = ResourceSearcher(langchain_agent.llm)
-concept_analyzer = ConceptAnalyzer(langchain_agent.llm)
-simulation_builder = SimulationBuilder(langchain_agent.llm)
+
+
+def get_prewarm_targets() -> List[tuple]:
+    """获取需要预热连接的提供商及其地址（默认提供商和已配置API密钥的提供商）"""
+    settings = load_provider_settings()
+    default_provider = settings.get("default_provider", "ollama")
+    targets = []
+    for provider in ["ollama", "deepseek", "openai", "openrouter"]:
+        config = settings.get(provider)
+        if not config or not config.get("base_url"):
+            continue
+        if provider == default_provider or config.get("api_key"):
+            targets.append((provider, config["base_url"]))
+    return targets
+
+
+def configure_ollama_pool() -> None:
+    """按设置登记Ollama实例（base_url和base_urls）并更新实例池和num_ctx选择配置"""
+    config = load_provider_settings().get("ollama", {})
+    ollama_pool.configure(config.get("pool"))
+    ollama_pool.register(pool_urls(config))
+    ollama_context.configure(config.get("context"))
+
+
+def configure_components() -> None:
+    """按当前设置配置各组件（启动时和保存设置后调用）"""
+    admission_controller.reload()
+    rate_limiter.reload()
+    http_pool.configure(get_settings_section("http_pool"))
+    ollama_residency.configure(
+        load_provider_settings().get("ollama", {}).get("residency")
+    )
+    configure_ollama_pool()
+    retry_policy.configure(get_settings_section("retry_policy"))
+    response_cache.configure(get_settings_section("response_cache"))
+    fuzzy_cache.configure(get_settings_section("fuzzy_cache"))
+    ollama_sessions.configure(get_settings_section("ollama_session"))
+    batch_jobs.configure(get_settings_section("batch_jobs"))
+    structured_output.configure(get_settings_section("structured_output"))
+    generation_profiles.configure(get_settings_section("generation_profiles"))
+    cancellation.configure(get_settings_section("cancellation"))
+    reasoning_manager.configure(get_settings_section("reasoning"))
+    llm_registry.configure(get_settings_section("llm_registry"))
+    micro_batcher.configure(get_settings_section("micro_batch"))
+    circuit_breakers.configure(get_settings_section("circuit_breaker"))
+    # 在准入控制重新读取限额之后，重新应用学到的并发上限
+    adaptive_concurrency.configure(get_settings_section("adaptive_concurrency"))
+    model_warmer.configure(get_settings_section("warmup"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动时创建共享连接池并预热，关闭时释放连接"""
+    configure_components()
+    if http_pool.config.prewarm:
+        warmed = await http_pool.prewarm_all(get_prewarm_targets())
+        print(f"连接预热完成: {warmed}")
+    ollama_residency.start()
+    ollama_pool.start()
+    batch_jobs.start()
+    # 模型预热在后台进行，完成前/ready返回503
+    warmup_task = asyncio.create_task(model_warmer.run(langchain_agent.llm))
+    yield
+    if not warmup_task.done():
+        warmup_task.cancel()
+    # 先取消进行中的生成，关闭上游连接后再释放连接池
+    await cancellation.shutdown()
+    await ollama_residency.stop()
+    await ollama_pool.stop()
+    await batch_jobs.stop()
+    await http_pool.close()
 
 
 # 初始化服务
 app = FastAPI(
     title="AI Education Backend",
     description="Backend service for the AI Education application.",
-    version="0.1.0"
+    version="0.1.0",
+    lifespan=lifespan
 )
 
 
@@ -73,18 +176,18 @@ class ResponseModel(BaseModel):
 class DialogueRequest(BaseModel):
     session_id: str
     message: str
-    model: str = DEFAULT_MODEL
+    model: Optional[str] = None  # 为空时按任务路由或使用默认模型，见llm_registry
 
 
 class ToolCallRequest(BaseModel):
     tool_name: str
     params: Dict[str, Any]
-    model: str = DEFAULT_MODEL
+    model: Optional[str] = None
 
 
 class KnowledgeGraphRequest(BaseModel):
     topic: str
-    model: str = DEFAULT_MODEL
+    model: Optional[str] = None
 
 
 class Settings(BaseModel):
@@ -94,7 +197,7 @@ class Settings(BaseModel):
 
 class KnowledgePointRequest(BaseModel):
     content: str
-    model: str = DEFAULT_MODEL
+    model: Optional[str] = None
 
 
 class ExerciseRequest(BaseModel):
@@ -102,14 +205,14 @@ class ExerciseRequest(BaseModel):
     difficulty: int = 3
     count: int = 1
     types: List[str]
-    model: str = DEFAULT_MODEL
+    model: Optional[str] = None
 
 
 class ResourceRequest(BaseModel):
     query: str
     types: List[str] = []  # 支持多个资源类型
     difficulty: int = 0
-    model: str = DEFAULT_MODEL
+    model: Optional[str] = None
 
 
 class ConceptRequest(BaseModel):
@@ -117,12 +220,22 @@ class ConceptRequest(BaseModel):
     context: str = ""
     user_level: int = 3
     dimensions: List[str] = []  # 指定概念分析的维度，如["定义", "特征", "示例", "关联概念"]
-    model: str = DEFAULT_MODEL
+    model: Optional[str] = None
 
 
 class SimulationRequest(BaseModel):
     topic: str
-    model: str = DEFAULT_MODEL
+    model: Optional[str] = None
+
+
+class BatchJobRequest(BaseModel):
+    provider: str = "openai"
+    model: Optional[str] = None
+    temperature: Optional[float] = None
+    max_tokens: Optional[int] = None
+    # 每条请求：{"task": "prompt", "prompt": ...} 或
+    # {"task": "exercises", "topic": ..., "types": [...], "difficulty": 3, "count": 5}，可带custom_id
+    requests: List[Dict[str, Any]]
 
 
 # 错误处理
@@ -150,6 +263,25 @@ async def http_exception_handler(request, exc):
     )
 
 
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request, exc):
+    """LLM并发队列已满或被限流时快速返回429（排队超时、熔断返回503），并给出Retry-After"""
+    return JSONResponse(
+        status_code=503 if exc.reason in ("queue_timeout", "circuit_open") else 429,
+        headers={"Retry-After": str(math.ceil(exc.retry_after))},
+        content={
+            "success": False,
+            "message": str(exc),
+            "data": {
+                "provider": exc.provider,
+                "model": exc.model,
+                "reason": exc.reason,
+                "retry_after": exc.retry_after
+            }
+        }
+    )
+
+
 @app.exception_handler(Exception)
 async def general_exception_handler(request, exc):
     print("Error:", str(exc))
@@ -165,15 +297,51 @@ async def general_exception_handler(request, exc):
     )
 
 
+def is_retryable(error: BaseException) -> bool:
+    """准入拒绝和限流需要立即返回给客户端，429已在提供商调用内按Retry-After等待；
+    4xx（如请求的模型无效）重试也不会成功"""
+    if isinstance(error, AdmissionRejected):
+        return False
+    return not (isinstance(error, HTTPException) and error.status_code < 500)
+
+
 # 重试装饰器
 def with_retry(max_attempts: int = 3):
     return retry(
         stop=stop_after_attempt(max_attempts),
         wait=wait_exponential(multiplier=1, min=4, max=10),
+        retry=retry_if_exception(is_retryable),
         reraise=True
     )
 
 
+def llm_identity(llm) -> str:
+    """用于缓存匹配的LLM标识（提供商/模型）"""
+    return f"{llm._llm_type}/{llm.config.model_name}"
+
+
+def ensure_llm_capacity(llm=None) -> None:
+    """流式接口开始响应前检查LLM排队余量，队列已满时直接拒绝"""
+    llm = llm or langchain_agent.llm
+    admission_controller.check(llm._llm_type, llm.config.model_name)
+
+
+def get_llm(model: Optional[str] = None, task: Optional[str] = None):
+    """按请求中的模型从LLM实例池取出实例，模型无效时返回400"""
+    try:
+        return llm_registry.get(model, task=task)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def get_tool(tool_class, model: Optional[str] = None, task: Optional[str] = None, hedged: bool = False):
+    """取出绑定在请求模型对应LLM实例上的工具，模型无效时返回400"""
+    try:
+        return llm_registry.tool(tool_class, model, task=task, hedged=hedged)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 # 创建Saves目录（如果不存在）
 SAVES_DIR = 'Saves'
 os.makedirs(SAVES_DIR, exist_ok=True)
@@ -239,12 +407,14 @@ async def save_temp_file(request: Request):
 # API路由
 @app.get("/api/dialogue/stream")
 async def handle_dialogue_stream(
+    request: Request,
     session_id: str,
     message: str,
-    model: str = DEFAULT_MODEL,
+    model: Optional[str] = None,
     has_outline: bool = False,
     use_web_search: bool = False
 ):
+    ensure_llm_capacity(get_llm(model, task="main_outline"))
     import os
     try:
         if os.path.exists('temp_encodedTutorial.txt'):
@@ -279,24 +449,32 @@ async def handle_dialogue_stream(
             print("Starting stream generation...")
             print("Session ID:", session_id)
             print("Message:", message)
-            async for chunk in langchain_agent.process_message(
-                session_id,
-                message,
-                model,
-                has_outline=has_outline,
-                tutorial_data=tutorial_data,
-                use_web_search=use_web_search
-            ):
-                if chunk:
-                    # 统一使用对象格式发送
-                    if isinstance(chunk, str):
-                        data = {
-                            "type": "chunk",
-                            "content": chunk
-                        }
-                    else:
-                        data = chunk
-                    yield f"data: {json.dumps(data)}\n\n"
+            with cache_scope("dialogue"):
+                # 客户端断开、停止生成或服务关闭时取消整条生成链
+                async for chunk in cancellation.run(
+                    session_id,
+                    langchain_agent.process_message(
+                        session_id,
+                        message,
+                        model,
+                        has_outline=has_outline,
+                        tutorial_data=tutorial_data,
+                        use_web_search=use_web_search
+                    ),
+                    request=request,
+                    kind="dialogue",
+                    stopped={"type": "stopped", "message": "生成已停止"}
+                ):
+                    if chunk:
+                        # 统一使用对象格式发送
+                        if isinstance(chunk, str):
+                            data = {
+                                "type": "chunk",
+                                "content": chunk
+                            }
+                        else:
+                            data = chunk
+                        yield f"data: {json.dumps(data)}\n\n"
             yield "data: [DONE]\n\n"
 
         return StreamingResponse(
@@ -348,6 +526,8 @@ async def handle_dialogue(request: DialogueRequest):
                 "model": request.model
             }
         )
+    except AdmissionRejected:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -412,8 +592,8 @@ async def stop_generation(request: StopGenerationRequest):
 async def list_models():
     """获取所有可用的AI模型列表"""
     try:
-        # 获取用户设置
-        settings = get_user_settings()
+        # 获取用户设置（get_user_settings在本模块中是设置接口，这里用提供商设置）
+        settings = load_provider_settings()
         provider = settings.get("default_provider", "ollama")
         
         models = []
@@ -466,6 +646,9 @@ async def save_settings(settings: Settings):
             settings.user_id,
             settings.preferences
         )
+        configure_components()
+        # 新登记的Ollama实例需要健康检查
+        ollama_pool.start()
         return ResponseModel(
             success=True,
             message="设置保存成功",
@@ -498,19 +681,264 @@ async def get_user_settings(user_id: str):
 
 @app.get("/health", response_model=ResponseModel)
 async def health_check():
-    """健康检查"""
+    """健康检查（含各提供商熔断器状态，有熔断器打开时status为degraded）"""
+    breakers = circuit_breakers.get_states()
     return ResponseModel(
         success=True,
         message="服务正常运行",
         data={
-            "status": "ok",
+            "status": "degraded" if "open" in breakers.values() else "ok",
             "version": "0.1.0",
             "default_model": DEFAULT_MODEL,
-            "base_url": DEFAULT_BASE_URL
+            "base_url": DEFAULT_BASE_URL,
+            "circuit_breakers": breakers
+        }
+    )
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus格式的运行指标"""
+    return PlainTextResponse(
+        metrics_registry.render(),
+        media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@app.get("/ready")
+async def readiness_check():
+    """就绪检查：模型预热完成前返回503，供负载均衡器判断是否路由流量"""
+    state = model_warmer.get_state()
+    return JSONResponse(
+        status_code=200 if state["ready"] else 503,
+        content={
+            "success": state["ready"],
+            "message": "服务已就绪" if state["ready"] else "模型预热中",
+            "data": state
+        }
+    )
+
+
+@app.get("/api/http_pool/stats", response_model=ResponseModel)
+async def get_http_pool_stats():
+    """获取提供商连接池统计（连接复用/新建次数、DNS缓存命中等）"""
+    return ResponseModel(
+        success=True,
+        message="获取连接池统计成功",
+        data=http_pool.get_stats()
+    )
+
+
+@app.get("/api/admission/stats", response_model=ResponseModel)
+async def get_admission_stats():
+    """获取LLM并发闸门统计（并发数、排队数、排队耗时、拒绝次数）"""
+    return ResponseModel(
+        success=True,
+        message="获取并发统计成功",
+        data=admission_controller.get_stats()
+    )
+
+
+@app.get("/api/rate_limits/stats", response_model=ResponseModel)
+async def get_rate_limit_stats():
+    """获取远程提供商限流统计（令牌桶余量、等待时间、429次数）"""
+    return ResponseModel(
+        success=True,
+        message="获取限流统计成功",
+        data=rate_limiter.get_stats()
+    )
+
+
+@app.get("/api/retry_policy", response_model=ResponseModel)
+async def get_retry_policy_state():
+    """获取内容生成重试策略及统计（重试、续写、预算耗尽次数）"""
+    return ResponseModel(
+        success=True,
+        message="获取重试策略成功",
+        data=retry_policy.get_state()
+    )
+
+
+@app.get("/api/hedging/stats", response_model=ResponseModel)
+async def get_hedging_stats():
+    """获取对冲请求统计（对冲次数、故障转移次数、各提供商胜出次数）及首token延迟"""
+    return ResponseModel(
+        success=True,
+        message="获取对冲统计成功",
+        data={
+            "concept_analyzer": llm_registry.hedging_stats(),
+            "ttft": ttft_tracker.get_stats()
+        }
+    )
+
+
+@app.get("/api/single_flight/stats", response_model=ResponseModel)
+async def get_single_flight_stats():
+    """获取相同请求合并统计（各方法的领头调用数、合并加入数）及进行中的调用"""
+    return ResponseModel(
+        success=True,
+        message="获取合并统计成功",
+        data=single_flight_group.get_stats()
+    )
+
+
+@app.get("/api/cache/stats", response_model=ResponseModel)
+async def get_cache_stats():
+    """获取LLM响应缓存统计（总命中率及各接口命中率）"""
+    return ResponseModel(
+        success=True,
+        message="获取缓存统计成功",
+        data={
+            "exact": response_cache.get_stats(),
+            "fuzzy": fuzzy_cache.get_stats()
         }
     )
 
 
+@app.post("/api/cache/clear", response_model=ResponseModel)
+async def clear_cache():
+    """清空LLM响应缓存"""
+    await asyncio.to_thread(response_cache.clear)
+    fuzzy_cache.clear()
+    return ResponseModel(success=True, message="缓存已清空")
+
+
+class UnloadModelRequest(BaseModel):
+    model: str
+    base_url: Optional[str] = None
+
+
+@app.get("/api/ollama/residency", response_model=ResponseModel)
+async def get_ollama_residency():
+    """获取Ollama模型驻留状态（已加载模型、最近使用时间、加载耗时）"""
+    return ResponseModel(
+        success=True,
+        message="获取模型驻留状态成功",
+        data=ollama_residency.get_state()
+    )
+
+
+@app.get("/api/ollama/sessions", response_model=ResponseModel)
+async def get_ollama_sessions():
+    """获取教程生成的提示词前缀复用统计（每个教程节省的预填充token数）"""
+    return ResponseModel(
+        success=True,
+        message="获取前缀复用统计成功",
+        data=ollama_sessions.get_stats()
+    )
+
+
+@app.get("/api/ollama/pool", response_model=ResponseModel)
+async def get_ollama_pool():
+    """获取各Ollama实例的健康状态和负载（进行中的请求数、请求数、连续失败次数、已安装的模型）"""
+    return ResponseModel(
+        success=True,
+        message="获取Ollama实例状态成功",
+        data=ollama_pool.get_stats()
+    )
+
+
+@app.get("/api/ollama/context", response_model=ResponseModel)
+async def get_ollama_context():
+    """获取num_ctx各档位的使用次数、提示词截断次数和已读取的模型最大上下文"""
+    return ResponseModel(
+        success=True,
+        message="获取上下文长度统计成功",
+        data=ollama_context.get_stats()
+    )
+
+
+@app.get("/api/structured_output/stats", response_model=ResponseModel)
+async def get_structured_output_stats():
+    """获取各工具结构化输出与文本解析的调用数、解析失败率和重新生成消耗的token"""
+    return ResponseModel(
+        success=True,
+        message="获取结构化输出统计成功",
+        data=structured_output.get_stats()
+    )
+
+
+@app.get("/api/generation_profiles/stats", response_model=ResponseModel)
+async def get_generation_profile_stats():
+    """获取各任务的生成参数，以及输出被截断或提前结束的次数"""
+    return ResponseModel(
+        success=True,
+        message="获取生成参数统计成功",
+        data=generation_profiles.get_stats()
+    )
+
+
+@app.get("/api/cancellation/stats", response_model=ResponseModel)
+async def get_cancellation_stats():
+    """获取进行中的流式生成、取消次数和从取消到上游连接关闭的耗时"""
+    return ResponseModel(
+        success=True,
+        message="获取取消统计成功",
+        data=cancellation.get_stats()
+    )
+
+
+@app.get("/api/reasoning/stats", response_model=ResponseModel)
+async def get_reasoning_stats():
+    """获取各模型推理（思考）token的占比"""
+    return ResponseModel(
+        success=True,
+        message="获取推理token统计成功",
+        data=reasoning_manager.get_stats()
+    )
+
+
+@app.get("/api/llm_registry/stats", response_model=ResponseModel)
+async def get_llm_registry_stats():
+    """获取LLM实例池统计（池中的实例、复用与新建次数、任务路由）"""
+    return ResponseModel(
+        success=True,
+        message="获取LLM实例池统计成功",
+        data=llm_registry.get_stats()
+    )
+
+
+@app.get("/api/micro_batch/stats", response_model=ResponseModel)
+async def get_micro_batch_stats():
+    """获取小请求合并统计（合并批次、拆分失败次数、节省的调用次数）"""
+    return ResponseModel(
+        success=True,
+        message="获取请求合并统计成功",
+        data=micro_batcher.get_stats()
+    )
+
+
+@app.get("/api/circuit_breaker/stats", response_model=ResponseModel)
+async def get_circuit_breaker_stats():
+    """获取各提供商熔断器的状态、窗口内失败次数和各阶段超时次数"""
+    return ResponseModel(
+        success=True,
+        message="获取熔断器状态成功",
+        data=circuit_breakers.get_stats()
+    )
+
+
+@app.get("/api/adaptive_concurrency/stats", response_model=ResponseModel)
+async def get_adaptive_concurrency_stats():
+    """获取各提供商和模型当前的并发上限、工作点（吞吐最高的上限）和调整记录"""
+    return ResponseModel(
+        success=True,
+        message="获取自适应并发状态成功",
+        data=adaptive_concurrency.get_stats()
+    )
+
+
+@app.post("/api/ollama/residency/unload", response_model=ResponseModel)
+async def unload_ollama_model(request: UnloadModelRequest):
+    """手动卸载驻留的Ollama模型"""
+    success = await ollama_residency.evict(request.model, request.base_url)
+    return ResponseModel(
+        success=success,
+        message="模型已卸载" if success else "模型未驻留",
+        data=ollama_residency.get_state()
+    )
+
+
 # 教程管理相关路由
 tutorial_manager = TutorialManager()
 
@@ -581,28 +1009,50 @@ async def delete_tutorial(tutorial_id: str):
             detail=f"删除教程失败：{str(e)}"
         )
 
-# 知识图谱生成器
-knowledge_graph_generator = KnowledgeGraphGenerator(langchain_agent.llm)
-
-
 @app.post("/api/api/knowledge_graph/generate")
 async def generate_knowledge_graph(request: Request):
     """生成知识图谱（流式输出）"""
+    data = await request.json()
+    knowledge_graph_generator = get_tool(KnowledgeGraphGenerator, data.get("model"), task="knowledge_graph")
+    ensure_llm_capacity(knowledge_graph_generator.llm)
     try:
-        data = await request.json()
         topic = data.get("topic")
         description = data.get("description", "")
         
         if not topic:
             raise ValueError("主题不能为空")
         
+        fuzzy_context = {"description": description, "llm": llm_identity(knowledge_graph_generator.llm)}
+        cached = fuzzy_cache.lookup("knowledge_graph_generate", topic, fuzzy_context)
+
         async def generate():
-            async for chunk in knowledge_graph_generator.expand_knowledge(
-                topic=topic,
-                description=description
-            ):
-                if chunk:
+            if cached is not None:
+                for chunk in cached:
                     yield f"data: {json.dumps(chunk)}\n\n"
+                yield "data: [DONE]\n\n"
+                return
+            chunks = []
+            key = f"knowledge_graph:{id(request)}"
+            scope = cancellation.scope(key, "knowledge_graph_generate")
+            with cache_scope("knowledge_graph_generate"):
+                async for chunk in cancellation.run(
+                    key,
+                    knowledge_graph_generator.expand_knowledge(
+                        topic=topic,
+                        description=description
+                    ),
+                    request=request,
+                    kind="knowledge_graph_generate",
+                    scope=scope
+                ):
+                    if chunk:
+                        chunks.append(chunk)
+                        yield f"data: {json.dumps(chunk)}\n\n"
+            # 只缓存完整结束的流（客户端断开或被停止时只生成了一部分）；
+            # 解析失败时图谱只有中心节点，不缓存
+            graphs = [chunk for chunk in chunks if isinstance(chunk, dict) and chunk.get("type") == "graph"]
+            if scope.completed and graphs and len((graphs[-1].get("data") or {}).get("nodes") or []) > 1:
+                fuzzy_cache.store("knowledge_graph_generate", topic, chunks, fuzzy_context)
             yield "data: [DONE]\n\n"
 
         return StreamingResponse(
@@ -713,8 +1163,10 @@ async def delete_knowledge_graph(filename: str):
 @app.post("/api/api/knowledge_graph/expand")
 async def expand_knowledge_node(request: Request):
     """扩展知识图谱节点（流式响应）"""
+    data = await request.json()
+    knowledge_graph_generator = get_tool(KnowledgeGraphGenerator, data.get("model"), task="knowledge_graph")
+    ensure_llm_capacity(knowledge_graph_generator.llm)
     try:
-        data = await request.json()
         node_id = data.get("nodeId")
         topic = data.get("topic")
         description = data.get("description", "")
@@ -725,15 +1177,21 @@ async def expand_knowledge_node(request: Request):
             raise ValueError("节点ID和主题不能为空")
         
         async def generate():
-            async for chunk in knowledge_graph_generator.expand_single_node(
-                node_id=node_id,
-                topic=topic,
-                description=description,
-                category=category,
-                current_nodes=current_nodes
-            ):
-                if chunk:
-                    yield f"data: {json.dumps(chunk)}\n\n"
+            with cache_scope("knowledge_graph_expand"):
+                async for chunk in cancellation.run(
+                    f"knowledge_graph:{id(request)}",
+                    knowledge_graph_generator.expand_single_node(
+                        node_id=node_id,
+                        topic=topic,
+                        description=description,
+                        category=category,
+                        current_nodes=current_nodes
+                    ),
+                    request=request,
+                    kind="knowledge_graph_expand"
+                ):
+                    if chunk:
+                        yield f"data: {json.dumps(chunk)}\n\n"
             yield "data: [DONE]\n\n"
 
         return StreamingResponse(
@@ -767,21 +1225,35 @@ async def expand_knowledge_node(request: Request):
 @app.post("/api/exercises/generate", response_model=ResponseModel)
 async def generate_exercises(request: ExerciseRequest):
     """批量生成练习题"""
+    exercise_generator = get_tool(ExerciseGenerator, request.model, task="exercises")
     try:
-        
-        # 生成练习题
-        exercises = await exercise_generator.generate_batch(
-            topic=request.topic,
-            types=request.types,
-            difficulty=request.difficulty,
-            count=request.count
-        )
+        fuzzy_context = {
+            "types": request.types,
+            "difficulty": request.difficulty,
+            "count": request.count,
+            "llm": llm_identity(exercise_generator.llm)
+        }
+        exercises = fuzzy_cache.lookup("exercises", request.topic, fuzzy_context)
+        if exercises is None:
+            # 生成练习题
+            with cache_scope("exercises"):
+                exercises = await exercise_generator.generate_batch(
+                    topic=request.topic,
+                    types=request.types,
+                    difficulty=request.difficulty,
+                    count=request.count
+                )
+            # 生成失败时返回的是占位题目，不缓存
+            if exercises and not ExerciseGenerator.is_fallback(exercises):
+                fuzzy_cache.store("exercises", request.topic, exercises, fuzzy_context)
         print(f"生成的练习题：{exercises}")
         return ResponseModel(
             success=True,
             message="练习题生成成功",
             data=exercises
         )
+    except AdmissionRejected:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -794,13 +1266,15 @@ async def generate_exercises(request: ExerciseRequest):
 @with_retry()
 async def search_resources(request: ResourceRequest):
     """搜索学习资源"""
+    resource_searcher = get_tool(ResourceSearcher, request.model, task="resources_search")
     try:
         # 调用资源搜索器
-        resources = await resource_searcher.search_resources(
-            request.query,
-            request.types,
-            request.difficulty
-        )
+        with cache_scope("resources_search"):
+            resources = await resource_searcher.search_resources(
+                request.query,
+                request.types,
+                request.difficulty
+            )
         # 返回完整资源列表
         return ResponseModel(
             success=True,
@@ -810,6 +1284,8 @@ async def search_resources(request: ResourceRequest):
                 "total": len(resources)
             }
         )
+    except AdmissionRejected:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -821,16 +1297,27 @@ async def search_resources(request: ResourceRequest):
 @with_retry()
 async def analyze_concept(request: ConceptRequest):
     """分析概念"""
+    # 概念分析是交互式工具，对尾延迟敏感，使用对冲请求
+    concept_analyzer = get_tool(ConceptAnalyzer, request.model, task="concept_analyze", hedged=True)
     try:
-        result = await concept_analyzer.analyze_concept(
-            concept=request.concept_name
-        )
+        fuzzy_context = {"llm": llm_identity(concept_analyzer.llm)}
+        result = fuzzy_cache.lookup("concept_analyze", request.concept_name, fuzzy_context)
+        if result is None:
+            with cache_scope("concept_analyze"):
+                result = await concept_analyzer.analyze_concept(
+                    concept=request.concept_name
+                )
+            # 结构化输出和文本解析都失败时定义为空，不缓存
+            if isinstance(result, dict) and result.get("definition"):
+                fuzzy_cache.store("concept_analyze", request.concept_name, result, fuzzy_context)
         print(f"Concept analysis result: {result}")
         return ResponseModel(
             success=True,
             message="概念分析成功",
             data=result
         )
+    except AdmissionRejected:
+        raise
     except Exception as e:
         print(f"Error during concept analysis: {str(e)}")
         raise HTTPException(
@@ -844,22 +1331,87 @@ async def analyze_concept(request: ConceptRequest):
 @with_retry()
 async def generate_simulation(request: SimulationRequest):
     """生成仿真环境"""
+    simulation_builder = get_tool(SimulationBuilder, request.model, task="simulation")
     try:
-        simulation = await simulation_builder.create_simulation(
-            request.topic
-        )
+        with cache_scope("simulation"):
+            simulation = await simulation_builder.create_simulation(
+                request.topic
+            )
         print(f"Simulation generated: {simulation}")
         return ResponseModel(
             success=True,
             message="生成仿真环境成功",
             data=simulation
         )
+    except AdmissionRejected:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"生成仿真环境失败：{str(e)}"
         )
 
+# 离线批量生成相关路由
+@app.post("/api/batch/jobs", response_model=ResponseModel)
+async def submit_batch_job(request: BatchJobRequest):
+    """提交批量生成任务（使用提供商的批处理接口，后台轮询完成状态）"""
+    try:
+        job = await batch_jobs.submit(
+            request.requests,
+            provider=request.provider,
+            model=request.model,
+            temperature=request.temperature,
+            max_tokens=request.max_tokens
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"提交批量任务失败：{str(e)}")
+    return ResponseModel(success=True, message="批量任务已提交", data=job.summary())
+
+
+@app.get("/api/batch/jobs", response_model=ResponseModel)
+async def list_batch_jobs():
+    """获取批量任务列表"""
+    return ResponseModel(success=True, message="获取批量任务列表成功", data=batch_jobs.list_jobs())
+
+
+@app.get("/api/batch/jobs/{job_id}", response_model=ResponseModel)
+async def get_batch_job(job_id: str):
+    """获取批量任务状态"""
+    try:
+        job = batch_jobs.get(job_id)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return ResponseModel(success=True, message="获取批量任务状态成功", data=job.summary())
+
+
+@app.get("/api/batch/jobs/{job_id}/results", response_model=ResponseModel)
+async def get_batch_job_results(job_id: str):
+    """获取批量任务结果（按提交顺序，未完成的请求结果为空）"""
+    try:
+        job = batch_jobs.get(job_id)
+        results = batch_jobs.results(job_id)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return ResponseModel(
+        success=job.status == "completed",
+        message="获取批量任务结果成功" if job.finished else f"批量任务尚未完成（{job.status}）",
+        data={"job": job.summary(), "results": results}
+    )
+
+
+@app.post("/api/batch/jobs/{job_id}/cancel", response_model=ResponseModel)
+async def cancel_batch_job(job_id: str):
+    """取消批量任务"""
+    try:
+        job = await batch_jobs.cancel(job_id)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"取消批量任务失败：{str(e)}")
+    return ResponseModel(success=True, message="已请求取消批量任务", data=job.summary())
+
 app.mount("/", StaticFiles(directory="static", html=True), name="static")
 
 if __name__ == "__main__":
@@ -870,8 +1422,6 @@ if __name__ == "__main__":
     learning_tree_instance  # 初始化learning tree
     print("Initializing Settings...")
     settings_manager  # 初始化settings manager
-    print("Initializing Knowledge Graph Generator...")
-    knowledge_graph_generator  # 初始化知识图谱生成器
     print("Initializing Tutorial Manager...")
     tutorial_manager  # 初始化tutorial manager
     print(f"Tutorial save directory: {tutorial_manager.save_dir}")
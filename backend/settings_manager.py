@@ -1,6 +1,6 @@
-import json
 import os
 from typing import Dict, Any
+from agent.settings_store import SettingsStore, settings_store, thaw
 
 
 class SettingsManager:
@@ -14,6 +14,11 @@ class SettingsManager:
             settings_dir,
             "user_settings.json"
         )
+        # 读写都经过设置存储，与LLM配置共用同一份内存快照
+        if os.path.normpath(self.user_settings_file) == os.path.normpath(settings_store.path):
+            self.store = settings_store
+        else:
+            self.store = SettingsStore(self.user_settings_file)
         self.default_settings = {
             "default_provider": "openai",
             "theme": "light",
@@ -25,18 +30,16 @@ class SettingsManager:
         
         # 初始化设置文件
         if not os.path.exists(self.user_settings_file):
-            self.save_user_settings({
+            self.store.save({
                 "global": self.default_settings
             })
 
     def load_global_settings(self) -> Dict[str, Any]:
         """加载全局设置"""
-        try:
-            with open(self.user_settings_file, 'r', encoding='utf-8') as f:
-                settings = json.load(f)
-                return settings.get("global", self.default_settings)
-        except (FileNotFoundError, json.JSONDecodeError):
+        settings = self.store.snapshot().data
+        if "global" not in settings:
             return self.default_settings.copy()
+        return thaw(settings["global"])
 
     def save_global_settings(self, settings: Dict[str, Any]) -> None:
         """保存全局设置"""
@@ -49,20 +52,17 @@ class SettingsManager:
         default: Dict[str, Any] = None
     ) -> Dict[str, Any]:
         """加载所有用户设置"""
-        try:
-            with open(self.user_settings_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
+        settings = self.store.snapshot().data
+        if not settings:
             return default if default is not None else {}
+        return thaw(settings)
 
     def save_user_settings(self, settings: Dict[str, Any]) -> None:
         """保存用户设置"""
-        os.makedirs(self.settings_dir, exist_ok=True)
-        with open(self.user_settings_file, 'r', encoding='utf-8') as f:
-            or_settings = json.load(f)
+        # 写入前确认基于文件的最新内容
+        or_settings = self.store.snapshot(refresh=True).thaw()
         or_settings["global"][settings["global"]["default_provider"]] = settings["global"][settings["global"]["default_provider"]]
-        with open(self.user_settings_file, 'w', encoding='utf-8') as f:
-            json.dump(or_settings, f, ensure_ascii=False, indent=2)
+        self.store.save(or_settings)
 
     def update_settings(
         self,
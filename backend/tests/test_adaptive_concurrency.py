@@ -0,0 +1,21 @@
+from agent.adaptive_concurrency import AdaptiveConcurrencyController
+from agent.admission import ConcurrencyGate, ConcurrencyLimits
+
+
+def test_configured_max_concurrent_above_max_limit_is_kept():
+    controller = AdaptiveConcurrencyController()
+    gate = ConcurrencyGate("ollama", ConcurrencyLimits(max_concurrent=32))
+    state = controller._state(gate)
+    assert state.limit == 32 and gate.limit == 32
+    controller.configure({})
+    assert gate.limit == 32
+    assert controller._clamp(gate, 40) == 32
+
+
+def test_limit_is_clamped_to_max_limit():
+    controller = AdaptiveConcurrencyController()
+    gate = ConcurrencyGate("ollama", ConcurrencyLimits(max_concurrent=4))
+    controller._state(gate)
+    assert gate.limit == 4
+    assert controller._clamp(gate, 20) == 8
+    assert controller._clamp(gate, 0) == 1
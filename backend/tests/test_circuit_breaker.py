@@ -0,0 +1,70 @@
+import asyncio
+import contextvars
+import pytest
+from agent.circuit_breaker import CircuitBreakerManager
+from agent.errors import ProviderAPIError, ProviderTimeout
+
+request_id = contextvars.ContextVar("request_id", default=None)
+
+
+def make_manager(first_token=0.2, idle=0.2):
+    manager = CircuitBreakerManager()
+    manager.configure({"timeouts": {"default": {"first_token": first_token, "idle": idle}}})
+    return manager
+
+
+async def tokens(delays, seen=None):
+    for index, delay in enumerate(delays):
+        await asyncio.sleep(delay)
+        if seen is not None:
+            seen.append((request_id.get(), asyncio.current_task()))
+        yield str(index)
+
+
+def collect(manager, stream):
+    async def run():
+        return [token async for token in manager.deadlines("test", "m", stream)]
+    return asyncio.run(run())
+
+
+def test_tokens_pass_through_in_the_consuming_task():
+    seen = []
+
+    async def run():
+        request_id.set("r1")
+        consumer = asyncio.current_task()
+        output = [token async for token in make_manager().deadlines("test", "m", tokens([0, 0.01, 0], seen))]
+        return output, consumer
+
+    output, consumer = asyncio.run(run())
+    assert output == ["0", "1", "2"]
+    assert seen == [("r1", consumer)] * 3
+
+
+def test_first_token_timeout():
+    with pytest.raises(ProviderTimeout) as info:
+        collect(make_manager(first_token=0.05), tokens([0.5]))
+    assert info.value.phase == "first_token"
+
+
+def test_idle_timeout():
+    manager = make_manager(idle=0.05)
+    with pytest.raises(ProviderTimeout) as info:
+        collect(manager, tokens([0, 0.5]))
+    assert info.value.phase == "idle"
+    assert manager.timeout_counts["test"] == {"idle": 1}
+
+
+def test_zero_disables_timeout():
+    assert collect(make_manager(first_token=0, idle=0), tokens([0.05, 0.05])) == ["0", "1"]
+
+
+def test_failure_classification():
+    manager = make_manager()
+    breaker = manager.get("test")
+    manager.configure({"min_calls": 2, "failure_rate": 0.5})
+    breaker.record("error", ProviderAPIError(400, "bad request"))
+    breaker.record("error", ProviderAPIError(503, "unavailable"))
+    assert breaker.state == "closed"
+    breaker.record("error", asyncio.TimeoutError())
+    assert breaker.state == "open"
@@ -0,0 +1,31 @@
+import asyncio
+from types import SimpleNamespace
+from agent.tools import exercise_generator as generator_module
+from agent.tools.exercise_generator import ExerciseGenerator
+
+
+class StubLLM:
+    _llm_type = "stub"
+    config = SimpleNamespace(model_name="stub")
+
+
+def test_parse_exercises():
+    output = "<选择题|1+1=?///A. 1///B. 2|B>\n说明文字\n<判断题|2>1|正确>\n<坏格式|缺少答案>"
+    exercises = ExerciseGenerator.parse_exercises(output, 5)
+    assert [exercise["type_"] for exercise in exercises] == ["选择", "判断"]
+    assert exercises[0]["options"] == {"A": "A. 1", "B": "B. 2"}
+    assert ExerciseGenerator.parse_exercises(output, 1) == exercises[:1]
+
+
+def test_generation_failure_returns_fallback_list(monkeypatch):
+    async def fail(*args, **kwargs):
+        raise RuntimeError("provider down")
+
+    monkeypatch.setattr(generator_module.structured_output, "generate", fail)
+    generator = ExerciseGenerator(StubLLM())
+    exercises = asyncio.run(generator.generate_batch("递归", ["选择题", "判断题"], count=5))
+    assert isinstance(exercises, list) and len(exercises) == 1
+    assert set(exercises[0]) == {"question", "options", "answer", "type_"}
+    assert exercises[0]["type_"] == "选择"
+    assert ExerciseGenerator.is_fallback(exercises)
+    assert not ExerciseGenerator.is_fallback(ExerciseGenerator.parse_exercises("<判断题|2>1|正确>", 5))
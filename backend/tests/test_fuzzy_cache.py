@@ -0,0 +1,24 @@
+from agent.fuzzy_cache import FuzzyRequestCache, normalize_text
+
+
+def test_normalize_text_folds_width_case_and_punctuation():
+    assert normalize_text("Ｐｙｔｈｏｎ 的 列表！", ["的"]) == normalize_text("python列表")
+
+
+def test_near_duplicate_hit():
+    cache = FuzzyRequestCache()
+    cache.store("concept_analyze", "Python 列表推导式", {"definition": "d"}, {"level": 3})
+    assert cache.lookup("concept_analyze", "python的列表推导式", {"level": 3}) == {"definition": "d"}
+    assert cache.lookup("concept_analyze", "python的列表推导式", {"level": 4}) is None
+    assert cache.lookup("concept_analyze", "二叉树的遍历", {"level": 3}) is None
+
+
+def test_returned_values_are_copies():
+    cache = FuzzyRequestCache()
+    value = {"definition": "d", "nodes": [1]}
+    cache.store("concept_analyze", "Python 列表推导式", value)
+    value["nodes"].append(2)
+    hit = cache.lookup("concept_analyze", "Python 列表推导式")
+    hit["concept"] = "changed"
+    hit["nodes"].append(3)
+    assert cache.lookup("concept_analyze", "Python 列表推导式") == {"definition": "d", "nodes": [1]}
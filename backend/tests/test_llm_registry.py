@@ -0,0 +1,60 @@
+import pytest
+from agent import llm_registry as registry_module
+from agent.llm_registry import LLMRegistry
+
+PROVIDER_MODELS = {
+    "ollama": "deepseek-r1:8b",
+    "deepseek": "deepseek-chat",
+    "openai": "gpt-3.5-turbo",
+    "openrouter": "deepseek/deepseek-r1-0528:free"
+}
+
+
+@pytest.fixture
+def settings(monkeypatch):
+    settings = {"default_provider": "ollama"}
+    monkeypatch.setattr(registry_module, "get_user_settings", lambda: settings)
+    monkeypatch.setattr(registry_module, "get_provider_config", lambda provider: {"model_name": PROVIDER_MODELS[provider]})
+    return settings
+
+
+@pytest.fixture
+def registry(settings):
+    return LLMRegistry()
+
+
+def test_unset_model_uses_default_provider(registry):
+    assert registry.resolve(None) == ("ollama", "deepseek-r1:8b")
+    assert registry.resolve("undefined") == ("ollama", "deepseek-r1:8b")
+
+
+def test_explicit_provider_selector(registry):
+    assert registry.resolve("deepseek::deepseek-reasoner") == ("deepseek", "deepseek-reasoner")
+    assert registry.resolve("openrouter::openai/gpt-4o") == ("openrouter", "openai/gpt-4o")
+    assert registry.resolve("openai::") == ("openai", "gpt-3.5-turbo")
+    assert registry.resolve("deepseek") == ("deepseek", "deepseek-chat")
+    with pytest.raises(ValueError):
+        registry.resolve("unknown::model")
+
+
+def test_openrouter_model_id_is_not_split(registry):
+    assert registry.resolve("deepseek/deepseek-r1-0528:free") == ("openrouter", "deepseek/deepseek-r1-0528:free")
+
+
+def test_ollama_tag_is_not_a_provider(registry):
+    assert registry.resolve("qwen2.5:7b") == ("ollama", "qwen2.5:7b")
+
+
+def test_legacy_provider_prefix(registry):
+    assert registry.resolve("deepseek/deepseek-reasoner") == ("deepseek", "deepseek-reasoner")
+
+
+def test_slash_ids_belong_to_openrouter_when_it_is_the_default(registry, settings):
+    settings["default_provider"] = "openrouter"
+    assert registry.resolve("openai/gpt-4o") == ("openrouter", "openai/gpt-4o")
+
+
+def test_task_route(registry):
+    registry.configure({"routes": {"concept_analyze": "deepseek::deepseek-chat"}})
+    assert registry.resolve(None, task="concept_analyze") == ("deepseek", "deepseek-chat")
+    assert registry.resolve("gpt-3.5-turbo", task="concept_analyze") == ("openai", "gpt-3.5-turbo")
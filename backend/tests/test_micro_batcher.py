@@ -0,0 +1,69 @@
+import asyncio
+import json
+from agent.micro_batcher import MicroBatcher, PendingBatch, PendingRequest, pack_prompt, split_outputs
+
+
+def test_pack_prompt_numbers_inputs():
+    prompt = pack_prompt("说明", ["  a  ", "b"])
+    assert prompt.startswith("说明")
+    assert '<input id="1">\na\n</input>' in prompt
+    assert '<input id="2">\nb\n</input>' in prompt
+
+
+def test_split_outputs_accepts_quote_and_space_variants():
+    text = '<task id="1">one</task>\n<task id=\'2\'> two </task><task id = 3>\nthree\n</task>'
+    assert split_outputs(text) == {1: "one", 2: "two", 3: "three"}
+
+
+def test_split_outputs_out_of_order_and_surrounding_text():
+    text = '好的：\n<task id="2">b</task>\n说明文字\n<task id="1">a</task>'
+    assert split_outputs(text) == {1: "a", 2: "b"}
+
+
+def test_split_outputs_missing_and_unclosed_tasks():
+    text = '<task id="1">a</task><task id="3">c'
+    assert split_outputs(text) == {1: "a"}
+
+
+def test_split_outputs_duplicate_id_keeps_first():
+    text = '<task id="1">first</task><task id="1">second</task>'
+    assert split_outputs(text) == {1: "first"}
+
+
+def demultiplex(text, count, parse=json.loads):
+    """用count个请求拆分text，返回各请求的结果和分组统计"""
+    async def run():
+        batcher = MicroBatcher()
+        loop = asyncio.get_running_loop()
+        batch = PendingBatch(group="concept_analyze", llm=None, instructions="")
+        batch.requests = [PendingRequest(str(index), parse, loop.create_future()) for index in range(count)]
+        batcher._demultiplex(batch, text)
+        return [request.future.result() for request in batch.requests], batcher.stats["concept_analyze"]
+    return asyncio.run(run())
+
+
+def test_demultiplex_assigns_outputs_by_id():
+    results, stats = demultiplex('<task id="2">{"b": 2}</task><task id="1">{"a": 1}</task>', 2)
+    assert results == [{"a": 1}, {"b": 2}]
+    assert stats["fallbacks"] == 0
+    assert stats["calls_saved"] == 1
+
+
+def test_demultiplex_missing_task_falls_back():
+    results, stats = demultiplex('<task id="1">{"a": 1}</task><task id="3">{"c": 3}</task>', 3)
+    assert results == [{"a": 1}, None, {"c": 3}]
+    assert stats["fallbacks"] == 1
+    assert stats["calls_saved"] == 1
+
+
+def test_demultiplex_duplicate_task_uses_first_and_falls_back_for_missing():
+    results, stats = demultiplex('<task id="1">{"a": 1}</task><task id="1">{"a": 2}</task>', 2)
+    assert results == [{"a": 1}, None]
+    assert stats["fallbacks"] == 1
+    assert stats["calls_saved"] == 0
+
+
+def test_demultiplex_parse_errors_and_empty_results_fall_back():
+    results, stats = demultiplex('<task id="1">not json</task><task id="2">{}</task><task id="3">[1]</task>', 3)
+    assert results == [None, None, [1]]
+    assert stats["fallbacks"] == 2
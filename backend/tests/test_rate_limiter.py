@@ -0,0 +1,46 @@
+import asyncio
+import pytest
+from agent.rate_limiter import ProviderRateLimiter, RateLimitConfig
+
+
+def make_limiter(**config):
+    return ProviderRateLimiter("deepseek", "test", RateLimitConfig(**config))
+
+
+def test_release_refunds_unsent_request_and_tokens():
+    limiter = make_limiter(rpm=10, tpm=1000)
+    reservation = asyncio.run(limiter.reserve("m", 300))
+    assert limiter.tokens.tokens == pytest.approx(700, abs=1)
+    reservation.release()
+    assert limiter.tokens.tokens == pytest.approx(1000, abs=1)
+    assert limiter.requests.tokens == pytest.approx(10, abs=1)
+    reservation.release()
+    assert limiter.tokens.tokens == pytest.approx(1000, abs=1)
+
+
+def test_release_after_sending_keeps_the_request():
+    limiter = make_limiter(rpm=10, tpm=1000)
+    reservation = asyncio.run(limiter.reserve("m", 300))
+    reservation.sent = True
+    reservation.release()
+    assert limiter.tokens.tokens == pytest.approx(1000, abs=1)
+    assert limiter.requests.tokens == pytest.approx(9, abs=1)
+
+
+def test_settle_uses_actual_usage_once():
+    limiter = make_limiter(tpm=1000)
+    reservation = asyncio.run(limiter.reserve("m", 300))
+    reservation.settle(50)
+    reservation.release()
+    assert limiter.tokens.tokens == pytest.approx(950, abs=1)
+
+
+def test_retry_does_not_take_tokens_again():
+    limiter = make_limiter(rpm=10, tpm=1000, max_retries=1)
+    reservation = asyncio.run(limiter.reserve("m", 300))
+    reservation.sent = True
+    assert reservation.can_retry
+    asyncio.run(reservation.retry())
+    assert not reservation.can_retry
+    assert limiter.tokens.tokens == pytest.approx(700, abs=1)
+    assert limiter.requests.tokens == pytest.approx(8, abs=1)
@@ -0,0 +1,75 @@
+from agent.reasoning_filter import ReasoningFilter
+
+
+def run(chunks, keep=False):
+    """逐块输入，返回（输出的正文, 收到的推理内容, 过滤器）"""
+    received = []
+    reasoning = ReasoningFilter("ollama", "test", keep=keep, on_reasoning=received.append)
+    output = "".join(reasoning.feed(chunk) for chunk in chunks) + reasoning.flush()
+    return output, "".join(received), reasoning
+
+
+def test_content_without_tags_passes_through():
+    output, received, reasoning = run(["Hello", " world"])
+    assert output == "Hello world"
+    assert received == ""
+    assert reasoning.reasoning_tokens == 0
+
+
+def test_reasoning_is_stripped_with_following_blank_lines():
+    output, received, reasoning = run(["<think>step 1</think>\n\nAnswer"])
+    assert output == "Answer"
+    assert received == "step 1"
+    assert reasoning.reasoning_tokens > 0
+    assert 0 < reasoning.share < 1
+
+
+def test_tags_split_across_chunks():
+    output, received, _ = run(["<th", "ink", ">ste", "p 1</", "thi", "nk>", "\n", "\nAns", "wer"])
+    assert output == "Answer"
+    assert received == "step 1"
+
+
+def test_every_character_split():
+    text = "<think>a < b</think>\n\nx <y> z"
+    output, received, _ = run(list(text))
+    assert output == "x <y> z"
+    assert received == "a < b"
+
+
+def test_partial_tag_that_is_not_a_tag_is_released():
+    reasoning = ReasoningFilter("ollama", "test")
+    assert reasoning.feed("a <th") == "a "
+    assert reasoning.feed("ing>") == "<thing>"
+
+
+def test_stray_close_tag_is_removed():
+    output, received, _ = run(["reasoning without open tag</think>\n\nAnswer"])
+    assert output == "reasoning without open tag\n\nAnswer"
+    assert received == ""
+
+
+def test_keep_mode_returns_original_text():
+    text = "<think>step 1</think>\n\nAnswer"
+    output, received, _ = run([text[:4], text[4:15], text[15:]], keep=True)
+    assert output == text
+    assert received == "step 1"
+
+
+def test_flush_releases_pending_partial_tag():
+    reasoning = ReasoningFilter("ollama", "test")
+    assert reasoning.feed("Answer <thi") == "Answer "
+    assert reasoning.flush() == "<thi"
+    assert reasoning.flush() == ""
+
+
+def test_flush_inside_unterminated_reasoning():
+    received = []
+    reasoning = ReasoningFilter("ollama", "test", on_reasoning=received.append)
+    assert reasoning.feed("<think>still thinking </thi") == ""
+    assert reasoning.flush() == ""
+    assert "".join(received) == "still thinking </thi"
+
+    kept = ReasoningFilter("ollama", "test", keep=True)
+    assert kept.feed("<think>still thinking </thi") == "<think>still thinking "
+    assert kept.flush() == "</thi"
@@ -0,0 +1,59 @@
+from agent.structured_output import IncrementalItemScanner
+
+
+def feed_chunks(scanner, chunks):
+    items = []
+    for chunk in chunks:
+        items.extend(scanner.feed(chunk))
+    return items
+
+
+def test_items_returned_as_soon_as_they_close():
+    scanner = IncrementalItemScanner("nodes")
+    assert scanner.feed('{"nodes": [{"id": 1},') == [{"id": 1}]
+    assert scanner.feed(' {"id": 2}') == [{"id": 2}]
+    assert scanner.feed("]}") == []
+    assert scanner.state == "done"
+
+
+def test_split_at_every_character():
+    text = '{"nodes": [{"id": 1, "child": {"name": "a"}}, {"id": 2}], "edges": []}'
+    scanner = IncrementalItemScanner("nodes")
+    assert feed_chunks(scanner, list(text)) == [{"id": 1, "child": {"name": "a"}}, {"id": 2}]
+
+
+def test_key_split_across_chunks():
+    scanner = IncrementalItemScanner("nodes")
+    assert feed_chunks(scanner, ['{"no', 'des"', ' :', ' [{"id": 1}]}']) == [{"id": 1}]
+
+
+def test_braces_and_quotes_inside_strings():
+    text = '{"nodes": [{"label": "a } b { c", "note": "say \\"}\\" here"}, {"id": 2}]}'
+    scanner = IncrementalItemScanner("nodes")
+    assert feed_chunks(scanner, [text[:20], text[20:33], text[33:]]) == [
+        {"label": "a } b { c", "note": 'say "}" here'},
+        {"id": 2}
+    ]
+
+
+def test_escaped_backslash_before_closing_quote():
+    scanner = IncrementalItemScanner("nodes")
+    assert scanner.feed('{"nodes": [{"path": "C:\\\\"}, {"id": 2}]}') == [{"path": "C:\\"}, {"id": 2}]
+
+
+def test_key_used_for_non_array_is_skipped():
+    scanner = IncrementalItemScanner("nodes")
+    text = '{"title": "nodes", "meta": {"nodes": 3}, "nodes": [{"id": 1}]}'
+    assert feed_chunks(scanner, [text[:25], text[25:]]) == [{"id": 1}]
+
+
+def test_invalid_item_is_counted_and_skipped():
+    scanner = IncrementalItemScanner("nodes")
+    assert scanner.feed('{"nodes": [{"id": 1,}, {"id": 2}]}') == [{"id": 2}]
+    assert scanner.invalid == 1
+
+
+def test_text_after_array_is_ignored():
+    scanner = IncrementalItemScanner("nodes")
+    assert scanner.feed('{"nodes": []}, "more": [{"id": 1}]') == []
+    assert scanner.feed('{"nodes": [{"id": 9}]}') == []